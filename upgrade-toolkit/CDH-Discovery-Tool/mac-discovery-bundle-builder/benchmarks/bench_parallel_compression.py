@@ -0,0 +1,144 @@
+# Copyright 2022 Cloudera, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the workload tarballs written by ParallelCompressionWriter with single-threaded tarfile "w:gz", the way
+they were written before. Synthetic Spark event logs are generated into a scratch directory, archived with every
+codec and thread count, and read back to check that the archives hold the same bytes.
+
+    python3 benchmarks/bench_parallel_compression.py --size-mb=400 --threads=1,4,8
+"""
+
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parallel_compression import archive_suffixes, open_archive
+
+spark_events = ["SparkListenerTaskStart", "SparkListenerTaskEnd", "SparkListenerStageCompleted",
+                "SparkListenerExecutorAdded"]
+event_log_size = 8 * 1024 * 1024
+
+
+def generate_event_logs(source_dir, size):
+    """
+    Writes Spark event logs of event_log_size bytes into source_dir until they add up to size bytes.
+    """
+    random.seed(1)
+    written = 0
+    application = 0
+    while written < size:
+        with open(os.path.join(source_dir, f"application_1690000000000_{application:04d}"), "w") as event_log:
+            task = 0
+            while event_log.tell() < min(event_log_size, size - written):
+                event_log.write(json.dumps({
+                    "Event": random.choice(spark_events),
+                    "Stage ID": random.randint(0, 400),
+                    "Task Info": {"Task ID": task, "Host": f"worker-{random.randint(1, 300)}.example.com",
+                                  "Launch Time": 1690000000000 + task * random.randint(1, 50),
+                                  "Executor ID": str(random.randint(1, 200))},
+                    "Task Metrics": {"Executor Run Time": random.randint(0, 100000),
+                                     "Result Size": random.randint(0, 1 << 20),
+                                     "Shuffle Read Metrics": {"Remote Bytes Read": random.randint(0, 1 << 30)}}
+                }) + "\n")
+                task += 1
+            written += event_log.tell()
+        application += 1
+    return written
+
+
+def archive_with_tarfile(source_dir, output_file_path):
+    with tarfile.open(output_file_path, "w:gz") as tar:
+        for file_name in sorted(os.listdir(source_dir)):
+            tar.add(os.path.join(source_dir, file_name), file_name)
+
+
+def archive_in_parallel(source_dir, output_file_path, codec, threads):
+    with open_archive(output_file_path, codec, threads) as tar:
+        for file_name in sorted(os.listdir(source_dir)):
+            tar.add(os.path.join(source_dir, file_name), file_name)
+
+
+def read_archive(output_file_path):
+    """
+    Returns the size of every file in the archive, decompressing it the way the WXM uploader and tar would.
+    """
+    if output_file_path.endswith(archive_suffixes["zstd"]):
+        import pyarrow as pa
+
+        with pa.CompressedInputStream(pa.OSFile(output_file_path), "zstd") as stream:
+            fileobj = io.BytesIO(stream.read())
+        tar = tarfile.open(fileobj=fileobj, mode="r")
+    else:
+        tar = tarfile.open(output_file_path, "r:gz")
+    with tar:
+        return {member.name: len(tar.extractfile(member).read()) for member in tar if member.isfile()}
+
+
+def run(name, archive, output_file_path, source_size, expected_files):
+    started = time.monotonic()
+    archive(output_file_path)
+    elapsed = time.monotonic() - started
+    archive_size = os.path.getsize(output_file_path)
+    identical = read_archive(output_file_path) == expected_files
+    print(f"{name:28s} {elapsed:7.1f} s {archive_size / 2 ** 20:8.1f} MiB  ratio {source_size / archive_size:5.2f}"
+          f"  {source_size / 2 ** 20 / elapsed:7.1f} MiB/s  read back {'ok' if identical else 'DIFFERENT'}")
+    os.remove(output_file_path)
+    return identical
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--size-mb', action='store', type='int', dest='size_mb', default=400,
+                      help='Size of the generated event logs in MiB. Defaults to 400.')
+    parser.add_option('--threads', action='store', dest='threads', default=f"1,{os.cpu_count() or 1}",
+                      help='Comma separated thread counts to compress with. Defaults to 1 and the number of CPUs.')
+    parser.add_option('--codecs', action='store', dest='codecs', default='gzip,zstd',
+                      help='Comma separated codecs to compress with. Defaults to gzip,zstd.')
+    parser.add_option('--work-dir', action='store', dest='work_dir', default=None,
+                      help='Scratch directory for the event logs and archives. Defaults to a new temp directory.')
+    (options, args) = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(dir=options.work_dir, prefix="bench_parallel_compression_")
+    try:
+        source_dir = os.path.join(work_dir, "event_logs")
+        os.makedirs(source_dir)
+        source_size = generate_event_logs(source_dir, options.size_mb * 1024 * 1024)
+        expected_files = {file_name: os.path.getsize(os.path.join(source_dir, file_name))
+                          for file_name in os.listdir(source_dir)}
+        print(f"{len(expected_files)} event logs, {source_size / 2 ** 20:.1f} MiB, {os.cpu_count()} CPUs")
+        identical = run("tarfile w:gz (before)", lambda path: archive_with_tarfile(source_dir, path),
+                        os.path.join(work_dir, "tarfile.tar.gz"), source_size, expected_files)
+        for codec in options.codecs.split(","):
+            for threads in map(int, options.threads.split(",")):
+                output_file_path = os.path.join(work_dir, f"parallel{archive_suffixes[codec]}")
+                identical &= run(f"parallel {codec}, {threads} threads",
+                                 lambda path: archive_in_parallel(source_dir, path, codec, threads),
+                                 output_file_path, source_size, expected_files)
+    finally:
+        shutil.rmtree(work_dir)
+    sys.exit(0 if identical else 1)
+
+
+if __name__ == '__main__':
+    main()
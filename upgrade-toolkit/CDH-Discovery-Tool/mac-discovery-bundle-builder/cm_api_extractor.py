@@ -12,21 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import cm_client
+from cm_client.rest import RESTClientObject
 
-log = logging.getLogger('main')
-
+from cm_topology_cache import CmTopologyCache
+from discovery_bundle_builder_utils import AdaptiveRequestLimiter, write_json
 
-def dump_json(path, api_response):
-    json_dict = cm_client.ApiClient().sanitize_for_serialization(api_response)
-    f = open(path, "w")
-    f.write(json.dumps(json_dict))
-    log.debug(f"Api response stored in: {path}")
+log = logging.getLogger('main')
 
 
 def create_directory(dir_path):
@@ -35,34 +32,50 @@ def create_directory(dir_path):
 
 
 class CmApiExtractor:
-    def __init__(self, output_dir, sensitive_values_redacted):
+    def __init__(self, output_dir, sensitive_values_redacted, topology=None, max_workers=8, role_configs="full",
+                 config_source="api", compression=None):
         self.api_output_dir = os.path.join(output_dir, 'api_diagnostics')
-        self.hosts_resource_api = cm_client.HostsResourceApi()
-        self.clusters_resource = cm_client.ClustersResourceApi()
-        self.cloudera_manager_resource = cm_client.ClouderaManagerResourceApi()
-        self.services_resource = cm_client.ServicesResourceApi()
-        self.roles_resource = cm_client.RolesResourceApi()
-        self.role_config_groups_resource = cm_client.RoleConfigGroupsResourceApi()
+        self.topology = topology or CmTopologyCache()
+        self.max_workers = max_workers
+        self.role_configs = role_configs
+        self.config_source = config_source
+        self.compression = compression
+        # Config reads are spread over max_workers threads sharing one client and connection pool
+        api_client = cm_client.ApiClient()
+        api_client.rest_client = RESTClientObject(maxsize=max_workers)
+        self.request_limiter = AdaptiveRequestLimiter(max_workers)
+        self.executor = None
+        self.hosts_resource_api = cm_client.HostsResourceApi(api_client)
+        self.clusters_resource = cm_client.ClustersResourceApi(api_client)
+        self.cloudera_manager_resource = cm_client.ClouderaManagerResourceApi(api_client)
+        self.services_resource = cm_client.ServicesResourceApi(api_client)
+        self.roles_resource = cm_client.RolesResourceApi(api_client)
+        self.role_config_groups_resource = cm_client.RoleConfigGroupsResourceApi(api_client)
         self.view_parameter = "EXPORT_REDACTED" if sensitive_values_redacted else "EXPORT"
 
+    def dump_json(self, path, api_response):
+        write_json(path, api_response, self.compression)
+
     def collect_cm_api_diagnostic(self):
         log.info("CM API collection started.")
         create_directory(self.api_output_dir)
         self.collect_cm_deployment(self.api_output_dir)
         self.collect_hosts()
-        self.collect_cluster_info()
+        # Service, role and role config group configs are exported concurrently, leaving the with block waits for them
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="cm_api") as self.executor:
+            self.collect_cluster_info()
         log.info("CM API collection finished.")
 
     def collect_cm_deployment(self, output_dir):
         api_response = self.cloudera_manager_resource.get_deployment2(view=self.view_parameter)
-        dump_json(os.path.join(output_dir, "cm_deployment.json"), api_response)
+        self.dump_json(os.path.join(output_dir, "cm_deployment.json"), api_response)
 
     def collect_hosts(self):
         log.debug("Read host information.")
         hosts_output_dir = os.path.join(self.api_output_dir, "host")
         create_directory(hosts_output_dir)
         api_response = self.hosts_resource_api.read_hosts(view='FULL')
-        dump_json(os.path.join(hosts_output_dir, "read_hosts.json"), api_response)
+        self.dump_json(os.path.join(hosts_output_dir, "read_hosts.json"), api_response)
 
     def collect_cluster_info(self):
         log.debug("Collect cluster information")
@@ -72,45 +85,50 @@ class CmApiExtractor:
         self.collect_cm_config(clusters_output_dir)
         self.collect_cm_version(clusters_output_dir)
         api_response = self.clusters_resource.read_clusters(view=self.view_parameter)
-        dump_json(os.path.join(clusters_output_dir, "clusters.json"), api_response)
+        self.dump_json(os.path.join(clusters_output_dir, "clusters.json"), api_response)
 
         cluster_names = list(map(lambda cluster: cluster.display_name, api_response.items))
         for cluster_name in cluster_names:
             create_directory(os.path.join(clusters_output_dir, cluster_name.replace(" ", "_")))
             self.list_of_hosts_per_cluster(os.path.join(clusters_output_dir, cluster_name.replace(" ", "_")),
                                            cluster_name)
-            self.export_cluster(os.path.join(clusters_output_dir, cluster_name.replace(" ", "_")), cluster_name)
+            cluster_export = self.export_cluster(os.path.join(clusters_output_dir, cluster_name.replace(" ", "_")),
+                                                 cluster_name)
             self.collect_services(os.path.join(clusters_output_dir, cluster_name.replace(" ", "_")), cluster_name)
-            self.collect_all_service_configs(os.path.join(clusters_output_dir, cluster_name.replace(" ", "_")),
-                                             cluster_name)
+            if self.config_source == "export":
+                self.collect_configs_from_export(os.path.join(clusters_output_dir, cluster_name.replace(" ", "_")),
+                                                 cluster_name, cluster_export)
+            else:
+                self.collect_all_service_configs(os.path.join(clusters_output_dir, cluster_name.replace(" ", "_")),
+                                                 cluster_name)
 
     def collect_kerberos_info(self, output_dir):
         api_response = self.cloudera_manager_resource.get_kerberos_info()
-        dump_json(os.path.join(output_dir, "kerberos_info.json"), api_response)
+        self.dump_json(os.path.join(output_dir, "kerberos_info.json"), api_response)
 
     def collect_cm_config(self, output_dir):
         api_response = self.cloudera_manager_resource.get_config(view='FULL')
-        dump_json(os.path.join(output_dir, "cm_config.json"), api_response)
+        self.dump_json(os.path.join(output_dir, "cm_config.json"), api_response)
 
     def collect_cm_version(self, output_dir):
         api_response = self.cloudera_manager_resource.get_version()
-        dump_json(os.path.join(output_dir, "cm_version.json"), api_response)
+        self.dump_json(os.path.join(output_dir, "cm_version.json"), api_response)
 
     def list_of_hosts_per_cluster(self, output_dir, cluster_name):
         api_response = self.clusters_resource.list_hosts(cluster_name)
-        dump_json(os.path.join(output_dir, "list_of_hosts.json"), api_response)
+        self.dump_json(os.path.join(output_dir, "list_of_hosts.json"), api_response)
 
     def export_cluster(self, output_dir, cluster_name):
         api_response = self.clusters_resource.export(cluster_name)
-        dump_json(os.path.join(output_dir, "cluster_export.json"), api_response)
+        self.dump_json(os.path.join(output_dir, "cluster_export.json"), api_response)
+        return api_response
 
     def collect_services(self, output_dir, cluster_name):
         api_response = self.services_resource.read_services(cluster_name=cluster_name, view='FULL')
-        dump_json(os.path.join(output_dir, "services.json"), api_response)
+        self.dump_json(os.path.join(output_dir, "services.json"), api_response)
 
     def collect_all_service_configs(self, output_dir, cluster_name):
-        services_response = self.services_resource.read_services(cluster_name=cluster_name)
-        for service in services_response.items:
+        for service in self.topology.get_services(cluster_name):
             service_configs_dir = os.path.join(output_dir, "configs", service.type, "service")
             roles_configs_dir = os.path.join(output_dir, "configs", service.type, "role")
             role_config_groups_configs_dir = os.path.join(output_dir, "configs", service.type, "role_config_group")
@@ -118,25 +136,75 @@ class CmApiExtractor:
             create_directory(roles_configs_dir)
             create_directory(role_config_groups_configs_dir)
 
-            api_response = self.services_resource.read_service_config(cluster_name=cluster_name,
-                                                                      service_name=service.name, view="FULL")
-            dump_json(os.path.join(service_configs_dir, f"{service.name}.json"), api_response)
+            self.executor.submit(self.export_config, os.path.join(service_configs_dir, f"{service.name}.json"),
+                                 self.services_resource.read_service_config, cluster_name=cluster_name,
+                                 service_name=service.name, view="FULL")
             self.collect_role_configs(roles_configs_dir, cluster_name, service.name)
             self.collect_role_config_groups_configs(role_config_groups_configs_dir, cluster_name, service.name)
 
+    def collect_configs_from_export(self, output_dir, cluster_name, cluster_export):
+        """
+        Writes the service and role config group configs from the cluster template returned by export, which holds
+        the values differing from the defaults. Only the role level overrides, missing from the template, are read
+        from the API.
+        """
+        log.debug(f"Building service and role config group configs of {cluster_name} from the cluster export")
+        instantiator = cluster_export.instantiator
+        variables = {variable.name: variable.value for variable in (instantiator.variables or [])} \
+            if instantiator else {}
+        role_config_group_names = {info.rcg_ref_name: info.name for info in (instantiator.role_config_groups or [])} \
+            if instantiator else {}
+        for template_service in cluster_export.services or []:
+            service_configs_dir = os.path.join(output_dir, "configs", template_service.service_type, "service")
+            roles_configs_dir = os.path.join(output_dir, "configs", template_service.service_type, "role")
+            role_config_groups_configs_dir = os.path.join(output_dir, "configs", template_service.service_type,
+                                                          "role_config_group")
+            create_directory(service_configs_dir)
+            create_directory(roles_configs_dir)
+            create_directory(role_config_groups_configs_dir)
+
+            self.dump_json(os.path.join(service_configs_dir, f"{template_service.ref_name}.json"),
+                           self.to_config_list(template_service.service_configs, variables))
+            for role_config_group in template_service.role_config_groups or []:
+                role_config_group_name = role_config_group_names.get(role_config_group.ref_name,
+                                                                     role_config_group.ref_name)
+                self.dump_json(os.path.join(role_config_groups_configs_dir, f"{role_config_group_name}.json"),
+                               self.to_config_list(role_config_group.configs, variables))
+            for role in self.topology.get_roles(cluster_name, template_service.ref_name):
+                self.executor.submit(self.export_config, os.path.join(roles_configs_dir, f"{role.name}.json"),
+                                     self.roles_resource.read_role_config, cluster_name=cluster_name,
+                                     service_name=template_service.ref_name, role_name=role.name, view="SUMMARY")
+
+    @staticmethod
+    def to_config_list(template_configs, variables):
+        return cm_client.ApiConfigList(items=[
+            cm_client.ApiConfig(name=config.name,
+                                value=variables.get(config.variable) if config.variable else config.value)
+            for config in template_configs or []])
+
     def collect_role_configs(self, output_dir, cluster_name, service_name):
-        roles_response = self.roles_resource.read_roles(cluster_name=cluster_name, service_name=service_name)
-        for role in roles_response.items:
-            api_response = self.roles_resource.read_role_config(cluster_name=cluster_name, service_name=service_name,
-                                                                role_name=role.name, view="FULL")
-            dump_json(os.path.join(output_dir, f"{role.name}.json"), api_response)
+        # The summary view only lists the values set on the role itself, the ones inherited from the role config
+        # group are already exported with it
+        view = "SUMMARY" if self.role_configs == "overrides" else "FULL"
+        for role in self.topology.get_roles(cluster_name, service_name):
+            self.executor.submit(self.export_config, os.path.join(output_dir, f"{role.name}.json"),
+                                 self.roles_resource.read_role_config, cluster_name=cluster_name,
+                                 service_name=service_name, role_name=role.name, view=view)
 
     def collect_role_config_groups_configs(self, output_dir, cluster_name, service_name):
-        role_config_groups_response = self.role_config_groups_resource.read_role_config_groups(
-            cluster_name=cluster_name, service_name=service_name)
-        for role_config_group in role_config_groups_response.items:
-            api_response = self.role_config_groups_resource.read_config(cluster_name=cluster_name,
-                                                                        service_name=service_name,
-                                                                        role_config_group_name=role_config_group.name,
-                                                                        view="FULL")
-            dump_json(os.path.join(output_dir, f"{role_config_group.name}.json"), api_response)
+        for role_config_group in self.topology.get_role_config_groups(cluster_name, service_name):
+            self.executor.submit(self.export_config, os.path.join(output_dir, f"{role_config_group.name}.json"),
+                                 self.role_config_groups_resource.read_config, cluster_name=cluster_name,
+                                 service_name=service_name, role_config_group_name=role_config_group.name,
+                                 view="FULL")
+
+    def export_config(self, output_path, read_config, **kwargs):
+        try:
+            api_response = self.request_limiter.call(read_config, **kwargs)
+        except Exception as error:
+            log.warning(f"Unable to export config to {output_path}: {error}")
+            return
+        if kwargs.get("view") == "SUMMARY" and "role_name" in kwargs and not api_response.items:
+            log.debug(f"Role {kwargs['role_name']} has no overrides, skipping.")
+            return
+        self.dump_json(output_path, api_response)
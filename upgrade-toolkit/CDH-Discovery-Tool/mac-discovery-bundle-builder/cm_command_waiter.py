@@ -0,0 +1,75 @@
+# Copyright 2022 Cloudera, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import time
+
+import cm_client
+
+log = logging.getLogger('main')
+
+
+class CmCommandFailedError(Exception):
+    def __init__(self, command):
+        super().__init__(f"Command {command.name} ({command.id}) failed: {command.result_message}")
+        self.command = command
+
+
+class CmCommandWaiter:
+    """
+    Waits for CM commands to finish. read_command is polled with a delay starting at initial_delay seconds, doubled
+    after every poll up to max_delay, and reset whenever the progress of the child commands changes. A failed command
+    raises CmCommandFailedError and running longer than timeout seconds raises TimeoutError.
+    """
+
+    def __init__(self, commands_resource=None, initial_delay=1, max_delay=60, timeout=None):
+        self.commands_resource = commands_resource or cm_client.CommandsResourceApi()
+        self.initial_delay = initial_delay
+        self.max_delay = max(max_delay, initial_delay)
+        self.timeout = timeout
+
+    def wait(self, command_id):
+        log.info("Waiting for %s command to succeed.", command_id)
+        started = time.monotonic()
+        delay = self.initial_delay
+        last_progress = None
+        while True:
+            command = self.commands_resource.read_command(command_id=command_id)
+            if not command.active:
+                if not command.success:
+                    raise CmCommandFailedError(command)
+                log.info(f"Command {command.name} ({command_id}) finished in {time.monotonic() - started:.0f} "
+                         f"seconds.")
+                return command
+            progress = self.describe_progress(command)
+            if progress != last_progress:
+                log.info(f"Command {command.name} ({command_id}) is running: {progress}")
+                last_progress = progress
+                delay = self.initial_delay
+            if self.timeout is not None and time.monotonic() - started + delay > self.timeout:
+                raise TimeoutError(f"Command {command.name} ({command_id}) did not finish in {self.timeout} seconds")
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+
+    @staticmethod
+    def describe_progress(command):
+        children = command.children.items if command.children and command.children.items else []
+        if not children:
+            return command.result_message or "no progress reported"
+        finished = [child for child in children if not child.active]
+        failed = [child for child in finished if not child.success]
+        progress = f"{len(finished)}/{len(children)} steps finished"
+        if failed:
+            progress += f", {len(failed)} failed ({', '.join(child.name for child in failed)})"
+        return progress
@@ -15,13 +15,51 @@
 import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
 
 import cm_client
+from cm_client.rest import RESTClientObject
+
+from cm_topology_cache import CmTopologyCache
+from discovery_bundle_builder_utils import AdaptiveRequestLimiter, find_bundle_file, load_json, write_json
 
 log = logging.getLogger('main')
 
 desired_rollup = 'HOURLY'
+metrics_state_file_name = 'metrics_state.json'
+timestamp_format = '%Y-%m-%dT%H:%M:%S'
+
+
+def merge_time_series(previous_json, new_json, start_timestamp):
+    """
+    Merges the points of a previously collected ApiTimeSeriesResponseList into a newly fetched one. Series are matched
+    by statement, metric and entity, points by timestamp with the new ones taking precedence, and points older than
+    start_timestamp are dropped.
+    """
+    start = start_timestamp.strftime(timestamp_format)
+    new_items = new_json.setdefault('items', [])
+    for index, previous_item in enumerate(previous_json.get('items') or []):
+        if index >= len(new_items):
+            new_items.append(dict(previous_item, timeSeries=[]))
+        new_series = new_items[index].setdefault('timeSeries', [])
+        series_by_key = {(series['metadata'].get('metricName'), series['metadata'].get('entityName')): series
+                         for series in new_series}
+        for previous_series in previous_item.get('timeSeries') or []:
+            key = (previous_series['metadata'].get('metricName'), previous_series['metadata'].get('entityName'))
+            series = series_by_key.get(key)
+            if series is None:
+                series = dict(previous_series, data=[])
+                new_series.append(series)
+            points = {point['timestamp']: point for point in previous_series.get('data') or []
+                      if point['timestamp'][:len(start)] >= start}
+            points.update({point['timestamp']: point for point in series.get('data') or []})
+            series['data'] = [points[timestamp] for timestamp in sorted(points)]
+            if series['data']:
+                series['metadata']['startTime'] = series['data'][0]['timestamp']
+        new_items[index]['timeSeries'] = [series for series in new_series if series.get('data')]
+    return new_json
 
 
 def create_directory(dir_path):
@@ -30,37 +68,117 @@ def create_directory(dir_path):
 
 
 class CmMetricsExtractor:
-    def __init__(self, output_dir, cluster_names, start_timestamp, end_timestamp):
+    def __init__(self, output_dir, cluster_names, start_timestamp, end_timestamp, max_workers=8, host_batch_size=50,
+                 topology=None, previous_bundle_dir=None, compression=None):
         self.metrics_output_dir = os.path.join(output_dir, 'metrics')
-        self.time_series_resource_api = cm_client.TimeSeriesResourceApi()
-        self.clusters_resource_api = cm_client.ClustersResourceApi()
-        self.hosts_resource_api = cm_client.HostsResourceApi()
-        self.services_resource_api = cm_client.ServicesResourceApi()
+        self.previous_metrics_dir = os.path.join(previous_bundle_dir, 'metrics') if previous_bundle_dir else None
+        self.previous_state = self.__load_previous_state()
+        self.state = {}
+        self.compression = compression
+        self.max_workers = max_workers
+        self.host_batch_size = max(host_batch_size, 1)
+        self.topology = topology or CmTopologyCache()
+        # One client for all the queries, with a connection pool as large as the number of workers
+        self.api_client = cm_client.ApiClient()
+        self.api_client.rest_client = RESTClientObject(maxsize=max_workers)
+        self.request_limiter = AdaptiveRequestLimiter(max_workers)
+        self.executor = None
+        self.futures = []
+        self.time_series_resource_api = cm_client.TimeSeriesResourceApi(self.api_client)
+        self.clusters_resource_api = cm_client.ClustersResourceApi(self.api_client)
+        self.hosts_resource_api = cm_client.HostsResourceApi(self.api_client)
+        self.services_resource_api = cm_client.ServicesResourceApi(self.api_client)
         self.cluster_names = cluster_names
         self.start_timestamp = start_timestamp
         self.end_timestamp = end_timestamp
 
-    def dump_json(self, path, api_response):
-        json_dict = cm_client.ApiClient().sanitize_for_serialization(api_response)
-        f = open(path, "w")
-        f.write(json.dumps(json_dict))
+    def __load_previous_state(self):
+        if not self.previous_metrics_dir:
+            return {}
+        state_path = os.path.join(self.previous_metrics_dir, metrics_state_file_name)
+        if not os.path.exists(state_path):
+            log.warning(f"No {metrics_state_file_name} found in {self.previous_metrics_dir}, collecting the full time range.")
+            return {}
+        with open(state_path) as f:
+            previous_state = json.load(f)
+        log.info(f"Incremental metrics collection from {self.previous_metrics_dir}, "
+                 f"{len(previous_state)} metric files collected previously.")
+        return previous_state
+
+    def __save_state(self):
+        create_directory(self.metrics_output_dir)
+        with open(os.path.join(self.metrics_output_dir, metrics_state_file_name), "w") as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+
+    def get_previous_collection(self, output_file_path, query):
+        """
+        Returns the start of the window still to be fetched and the previous bundle's copy of output_file_path, if
+        that was collected with the same query and its end is within the current time range. The window restarts at
+        the beginning of the last collected hour, as its rollup may have been incomplete.
+        """
+        relative_path = os.path.relpath(output_file_path, self.metrics_output_dir)
+        previous = self.previous_state.get(relative_path)
+        if not previous or previous['query'] != query:
+            return self.start_timestamp, None
+        previous_path = find_bundle_file(os.path.join(self.previous_metrics_dir, relative_path))
+        previous_end = datetime.strptime(previous['end_timestamp'], timestamp_format)
+        if not os.path.exists(previous_path) or not self.start_timestamp < previous_end <= self.end_timestamp:
+            return self.start_timestamp, None
+        return previous_end.replace(minute=0, second=0, microsecond=0), previous_path
+
+    def store_time_series(self, output_file_path, query, api_response, previous_path=None):
+        if previous_path:
+            api_response = merge_time_series(load_json(previous_path),
+                                             self.api_client.sanitize_for_serialization(api_response),
+                                             self.start_timestamp)
+        write_json(output_file_path, api_response, self.compression)
+        self.state[os.path.relpath(output_file_path, self.metrics_output_dir)] = {
+            "query": query,
+            "end_timestamp": self.end_timestamp.strftime(timestamp_format)
+        }
 
     def collect_metrics(self):
-        log.info("CM metrics collection started.")
-        self.collect_host_metrics()
-        self.collect_host_specific_role_cpu_metrics()
-        for cluster_name in self.cluster_names:
-            self.collect_hive_workload_metrics(cluster_name)
-            self.collect_spark_workload_metrics(cluster_name)
-            self.collect_mapreduce_workload_metrics(cluster_name)
-            self.collect_hdfs_metrics(cluster_name)
-            self.collect_yarn_metrics(cluster_name)
-            self.collect_impala_metrics(cluster_name)
-            self.collect_kudu_metrics(cluster_name)
-            self.collect_solr_metrics(cluster_name)
-            self.collect_hue_metrics(cluster_name)
+        log.info(f"CM metrics collection started with {self.max_workers} workers.")
+        # Queries are submitted to the executor by the collect_* methods and run concurrently, leaving the with block
+        # waits for all of them
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="cm_metrics") as self.executor:
+            self.collect_host_metrics()
+            self.collect_host_specific_role_cpu_metrics()
+            for cluster_name in self.cluster_names:
+                self.collect_hive_workload_metrics(cluster_name)
+                self.collect_spark_workload_metrics(cluster_name)
+                self.collect_mapreduce_workload_metrics(cluster_name)
+                self.collect_hdfs_metrics(cluster_name)
+                self.collect_yarn_metrics(cluster_name)
+                self.collect_impala_metrics(cluster_name)
+                self.collect_kudu_metrics(cluster_name)
+                self.collect_solr_metrics(cluster_name)
+                self.collect_hue_metrics(cluster_name)
+        for future in self.futures:
+            if future.exception():
+                log.error("CM metrics query failed", exc_info=future.exception())
+        self.futures = []
+        self.__save_state()
         log.info("CM metrics collection finished.")
 
+    def submit(self, fn, *args):
+        self.futures.append(self.executor.submit(fn, *args))
+
+    def query_time_series(self, query, _from=None):
+        return self.request_limiter.call(self.time_series_resource_api.query_time_series,
+                                         desired_rollup=desired_rollup,
+                                         _from=_from or self.start_timestamp,
+                                         must_use_desired_rollup=True,
+                                         query=query,
+                                         to=self.end_timestamp)
+
+    def collect_time_series(self, query, output_file_path):
+        try:
+            window_start, previous_path = self.get_previous_collection(output_file_path, query)
+            self.store_time_series(output_file_path, query, self.query_time_series(query, window_start), previous_path)
+        except Exception as error:
+            log.warning(f"Unable to fetch {output_file_path}: {error}")
+
     def collect_host_metrics(self):
         log.debug("Collecting host related metrics.")
         hosts_api_response = self.hosts_resource_api.read_hosts(view="FULL")
@@ -75,20 +193,62 @@ class CmMetricsExtractor:
             "total_bytes_receive_rate_across_network_interfaces",
             "total_bytes_transmit_rate_across_network_interfaces"
         ]
-        for host in hosts_api_response.items:
-            output_path = os.path.join(os.path.join(self.metrics_output_dir, "host", host.hostname))
-            create_directory(output_path)
+        hosts = hosts_api_response.items
+        for host in hosts:
+            create_directory(os.path.join(self.metrics_output_dir, "host", host.hostname))
+        for block_start in range(0, len(hosts), self.host_batch_size):
+            self.submit(self.collect_host_metrics_batch,
+                        hosts[block_start:block_start + self.host_batch_size], metrics)
+
+    def get_host_metric_query(self, host, metric):
+        return "SELECT " \
+               f"{metric} " \
+               f"WHERE category = 'host' AND entityName='{host.host_id}'"
+
+    def collect_host_metrics_batch(self, hosts, metrics):
+        """
+        Queries all the metrics of a block of hosts at once and splits the response into one file per host and
+        metric, in the same layout as a single host and metric query. Falls back to one query per host and metric if
+        the batched query fails.
+        """
+        log.debug(f"Collecting host related metrics from {len(hosts)} hosts: {', '.join(h.hostname for h in hosts)}")
+        host_ids = ", ".join(f"'{host.host_id}'" for host in hosts)
+        query = f"SELECT {', '.join(metrics)} WHERE category = 'host' AND entityName IN ({host_ids})"
+        previous_collections = {
+            (host.host_id, metric): self.get_previous_collection(
+                os.path.join(self.metrics_output_dir, "host", host.hostname, f"{metric}.json"),
+                self.get_host_metric_query(host, metric))
+            for host in hosts for metric in metrics
+        }
+        try:
+            responses = self.query_time_series(query, min(start for start, _ in previous_collections.values()))
+        except Exception as error:
+            log.warning(f"Batched host metrics query failed for {len(hosts)} hosts, "
+                        f"falling back to one query per host and metric: {error}")
+            for host in hosts:
+                for metric in metrics:
+                    self.collect_time_series(self.get_host_metric_query(host, metric),
+                                             os.path.join(self.metrics_output_dir, "host", host.hostname,
+                                                          f"{metric}.json"))
+            return
+
+        time_series_by_host_metric = {}
+        warnings = []
+        for response in responses.items:
+            warnings.extend(response.warnings or [])
+            for time_series in response.time_series or []:
+                host_id = (time_series.metadata.attributes or {}).get('hostId', time_series.metadata.entity_name)
+                time_series_by_host_metric.setdefault((host_id, time_series.metadata.metric_name), []) \
+                    .append(time_series)
+        for host in hosts:
             for metric in metrics:
-                log.debug(f"Collecting host related {metric} metric from cluster: {host.hostname}")
-                query = "SELECT " \
-                        f"{metric} " \
-                        f"WHERE category = 'host' AND entityName='{host.host_id}'"
-                host_cpu_metrics = self.time_series_resource_api.query_time_series(desired_rollup=desired_rollup,
-                                                                                   _from=self.start_timestamp,
-                                                                                   must_use_desired_rollup=True,
-                                                                                   query=query,
-                                                                                   to=self.end_timestamp)
-                self.dump_json(os.path.join(output_path, f"{metric}.json"), host_cpu_metrics)
+                host_metrics = cm_client.ApiTimeSeriesResponseList(items=[cm_client.ApiTimeSeriesResponse(
+                    time_series=time_series_by_host_metric.get((host.host_id, metric), []),
+                    warnings=warnings,
+                    time_series_query=self.get_host_metric_query(host, metric))])
+                self.store_time_series(os.path.join(self.metrics_output_dir, "host", host.hostname, f"{metric}.json"),
+                                       self.get_host_metric_query(host, metric), host_metrics,
+                                       previous_collections[(host.host_id, metric)][1])
 
     def collect_host_specific_role_cpu_metrics(self):
         log.debug("Collecting host related metrics.")
@@ -107,20 +267,17 @@ class CmMetricsExtractor:
                     '(cpu_user_with_descendants_rate / getHostFact(numCores, 1) * 100) + (cpu_system_with_descendants_rate / getHostFact(numCores, 1) * 100) AS role_total_cpu_usage ' \
                     'WHERE category = role and serviceType = YARN ' \
                     f'AND hostId = {host.host_id}; '
-            host_cpu_metrics = self.time_series_resource_api.query_time_series(desired_rollup=desired_rollup,
-                                                                               _from=self.start_timestamp,
-                                                                               must_use_desired_rollup=True,
-                                                                               query=query,
-                                                                               to=self.end_timestamp)
-            self.dump_json(os.path.join(output_path, "role_cpu_usage_rate.json"), host_cpu_metrics)
+            self.submit(self.collect_time_series, query, os.path.join(output_path, "role_cpu_usage_rate.json"))
 
     def get_service_by_type(self, cluster_name, service_type):
         if service_type == 'MAPREDUCE':
             return service_type
-        services_response = self.services_resource_api.read_services(cluster_name)
-        return next(filter(lambda service: service.type == service_type, services_response.items), None)
+        return self.topology.get_service_by_type(cluster_name, service_type)
 
     def collect_service_metrics(self, cluster_name, service_type, query, metric_name):
+        self.submit(self.fetch_service_metrics, cluster_name, service_type, query, metric_name)
+
+    def fetch_service_metrics(self, cluster_name, service_type, query, metric_name):
         service = self.get_service_by_type(cluster_name, service_type)
         if not service:
             log.debug(f"{service_type} service is not found on cluster: {cluster_name}")
@@ -128,14 +285,11 @@ class CmMetricsExtractor:
         log.debug(
             f"Collecting {service_type} related {metric_name} metric from cluster: {cluster_name}")
         try:
-            metrics = self.time_series_resource_api.query_time_series(desired_rollup=desired_rollup,
-                                                                      _from=self.start_timestamp,
-                                                                      must_use_desired_rollup=True,
-                                                                      query=query,
-                                                                      to=self.end_timestamp)
             output_path = os.path.join(self.metrics_output_dir, "cluster", cluster_name.replace(" ", "_"), "service", service_type)
             create_directory(output_path)
-            self.dump_json(os.path.join(output_path, f"{metric_name}.json"), metrics)
+            output_file_path = os.path.join(output_path, f"{metric_name}.json")
+            window_start, previous_path = self.get_previous_collection(output_file_path, query)
+            self.store_time_series(output_file_path, query, self.query_time_series(query, window_start), previous_path)
         except:
             log.warning(f"Unable to fetch {metric_name} from {cluster_name}")
 
@@ -0,0 +1,79 @@
+# Copyright 2022 Cloudera, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import threading
+
+import cm_client
+
+log = logging.getLogger('main')
+
+
+class CmTopologyCache:
+    """
+    Clusters, services, roles and hosts of the CM deployment, fetched with a single get_deployment2 call on first use
+    and shared by all the extractors of a run. refresh() fetches the deployment again.
+    """
+
+    def __init__(self, cloudera_manager_resource=None):
+        self.cloudera_manager_resource = cloudera_manager_resource or cm_client.ClouderaManagerResourceApi()
+        self.deployment = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        with self.lock:
+            log.debug("Fetching CM deployment topology.")
+            self.deployment = self.cloudera_manager_resource.get_deployment2()
+            return self.deployment
+
+    def get_deployment(self):
+        with self.lock:
+            if self.deployment is None:
+                log.debug("Fetching CM deployment topology.")
+                self.deployment = self.cloudera_manager_resource.get_deployment2()
+            return self.deployment
+
+    def get_clusters(self):
+        return self.get_deployment().clusters or []
+
+    def get_hosts(self):
+        return self.get_deployment().hosts or []
+
+    def get_cluster(self, cluster_name):
+        """
+        Looks up a cluster by its name or display name.
+        """
+        return next(filter(lambda cluster: cluster_name in (cluster.name, cluster.display_name), self.get_clusters()),
+                    None)
+
+    def get_services(self, cluster_name):
+        cluster = self.get_cluster(cluster_name)
+        return (cluster.services or []) if cluster else []
+
+    def get_service_by_type(self, cluster_name, service_type):
+        return next(filter(lambda service: service.type == service_type, self.get_services(cluster_name)), None)
+
+    def get_service(self, cluster_name, service_name):
+        return next(filter(lambda service: service.name == service_name, self.get_services(cluster_name)), None)
+
+    def get_roles(self, cluster_name, service_name):
+        service = self.get_service(cluster_name, service_name)
+        return (service.roles or []) if service else []
+
+    def get_role_config_groups(self, cluster_name, service_name):
+        service = self.get_service(cluster_name, service_name)
+        return (service.role_config_groups or []) if service else []
+
+    def get_host(self, host_id):
+        return next(filter(lambda host: host.host_id == host_id, self.get_hosts()), None)
@@ -12,35 +12,79 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import logging
+import multiprocessing
 import os
 import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from urllib.parse import urlparse
-from zipfile import ZipFile
+from zipfile import BadZipFile, ZipFile
 
 import cm_client
 import requests as requests
 from cm_client import ApiCollectDiagnosticDataArguments
 
+from cm_command_waiter import CmCommandFailedError, CmCommandWaiter
+
 log = logging.getLogger('main')
 
+download_chunk_size = 1024 * 1024
+min_download_range_size = 16 * 1024 * 1024
+default_download_dir_name = "diagnostic_bundle_download"
+selected_sysstats_files = {"lscpu_stdout", "lsb_release_stdout", "java_version_stdout", "java_version_stderr",
+                           "df_stdout", "krb5_stdout"}
+
 
 def create_directory(dir_path):
     path = Path(dir_path)
     path.mkdir(parents=True, exist_ok=True)
 
 
+def is_selected_member(member_name):
+    """
+    Tells whether a diagnostic bundle member is read later on: the host statistics copied by collect_host_info and
+    the Impala profiles collected by ImpalaProfilesExtractor.
+    """
+    path_parts = member_name.split("/")
+    return (len(path_parts) > 1 and path_parts[-2] == "sysstats" and path_parts[-1] in selected_sysstats_files) \
+        or path_parts[-1].startswith("impala_profile")
+
+
+def extract_nested_zip(bundle_path, member_name, output_dir, selective):
+    """
+    Extracts the nested zip member_name of the bundle, then its content next to it. In selective mode only the
+    selected members are extracted and the nested zip is removed afterwards.
+    """
+    with ZipFile(bundle_path, 'r') as bundle:
+        nested_zip_path = bundle.extract(member_name, output_dir)
+    with ZipFile(nested_zip_path, 'r') as nested_zip:
+        members = list(filter(is_selected_member, nested_zip.namelist())) if selective else None
+        nested_zip.extractall(os.path.dirname(nested_zip_path), members)
+    if selective:
+        os.remove(nested_zip_path)
+
+
 class DiagnosticBundleExtractor:
-    def __init__(self, output_dir, start_timestamp, end_timestamp):
+    def __init__(self, output_dir, start_timestamp, end_timestamp, command_id=None, download_dir=None,
+                 download_workers=4, download_retries=5, extract_mode="selective", extract_workers=None,
+                 command_waiter=None):
         self.output_dir = output_dir
+        self.extract_mode = extract_mode
+        self.extract_workers = extract_workers or os.cpu_count()
+        self.command_id = command_id
+        self.download_dir = download_dir or os.path.join(output_dir, default_download_dir_name)
+        self.remove_download_dir = download_dir is None
+        self.download_workers = download_workers
+        self.download_retries = download_retries
         self.extracted_diag_bundle_path = os.path.join(output_dir, 'extracted_raw_diagnostic_bundle')
         self.bundle_output_dir = os.path.join(output_dir, 'bundle')
         self.start_timestamp = start_timestamp
         self.end_timestamp = end_timestamp
         self.clusters_resource_api = cm_client.ClouderaManagerResourceApi()
-        self.command_resource_api = cm_client.CommandsResourceApi()
+        self.command_waiter = command_waiter or CmCommandWaiter()
         self.hosts_resource_api = cm_client.HostsResourceApi()
         self.setup_output_dirs()
 
@@ -50,52 +94,173 @@ class DiagnosticBundleExtractor:
 
     def collect_diagnostic_bundle(self):
         log.info("Diagnostic bundle collection started.")
-        self.fetch_diagnostic_bundle()
+        try:
+            self.fetch_diagnostic_bundle()
+        except (CmCommandFailedError, TimeoutError) as error:
+            log.error(f"Unable to collect diagnostic bundle. {error}")
+            raise
         self.collect_host_info()
         log.info("Diagnostic bundle collection finished.")
 
     def fetch_diagnostic_bundle(self):
-        arguments = ApiCollectDiagnosticDataArguments(
-            start_time=self.start_timestamp.replace(microsecond=0).isoformat(),
-            end_time=self.end_timestamp.replace(microsecond=0).isoformat())
-        api_response = self.clusters_resource_api.collect_diagnostic_data_command(body=arguments)
-        command_id = int(api_response.id)
-        self.wait_for_command_to_finish(command_id)
+        if self.command_id:
+            log.info("Using the diagnostic bundle of command %s.", self.command_id)
+            command_id = int(self.command_id)
+        else:
+            arguments = ApiCollectDiagnosticDataArguments(
+                start_time=self.start_timestamp.replace(microsecond=0).isoformat(),
+                end_time=self.end_timestamp.replace(microsecond=0).isoformat())
+            api_response = self.clusters_resource_api.collect_diagnostic_data_command(body=arguments)
+            command_id = int(api_response.id)
+        self.command_waiter.wait(command_id)
         self.unzip_diagnostic_bundle(command_id)
         log.debug("Diagnostic bundle collection finished.")
 
-    def wait_for_command_to_finish(self, command_id):
-        log.info("Waiting for %s command to succeed.", command_id)
-        while True:
-            command_response = self.command_resource_api.read_command(command_id=command_id)
-            log.info("Command %s is active: %s", command_id, command_response.active)
-            if not command_response.active:
-                if command_response.success:
-                    log.debug("Command finished successfully")
-                    break
-                else:
-                    log.error("Command is not finished with id: %s. Unable to collect diagnostic bundles", command_id)
-                    exit(-1)
-            time.sleep(15)
-
     def unzip_diagnostic_bundle(self, command_id):
         log.debug("Diagnostic bundle available remotely, downloading from CM.")
-        diagnostic_bundle_local_path = os.path.join(self.output_dir, f"{command_id}-scm-command-result.zip")
-        config = cm_client.configuration
-        api_url = urlparse(config.host)
-        with requests.get(f"{api_url.scheme}://{api_url.netloc}/cmf/command/{command_id}/download",
-                          auth=(config.username, config.password), verify=False, stream=True) as r:
-            r.raise_for_status()
-            with open(diagnostic_bundle_local_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
+        diagnostic_bundle_local_path = self.download_diagnostic_bundle(command_id)
         log.debug("Unzipping diagnostic bundle from: %s", diagnostic_bundle_local_path)
+        selective = self.extract_mode == "selective"
+        started = time.monotonic()
         with ZipFile(diagnostic_bundle_local_path, 'r') as zipObj:
-            zipObj.extractall(self.extracted_diag_bundle_path)
-            log.debug("Diagnostic bundle unzipped at: %s", self.extracted_diag_bundle_path)
-        for sub_zip_folder in Path(self.extracted_diag_bundle_path).rglob("*.zip"):
-            ZipFile(sub_zip_folder, 'r').extractall(Path(sub_zip_folder).parent.absolute())
+            nested_zips = [name for name in zipObj.namelist() if name.endswith(".zip")]
+            members = [name for name in zipObj.namelist()
+                       if not name.endswith(".zip") and (not selective or is_selected_member(name))]
+            zipObj.extractall(self.extracted_diag_bundle_path, members)
+        nested_zip_tasks = [(diagnostic_bundle_local_path, nested_zip, self.extracted_diag_bundle_path, selective)
+                            for nested_zip in nested_zips]
+        workers = min(self.extract_workers, len(nested_zips))
+        if workers > 1:
+            # The host zips are independent of each other, decompressing them is spread across processes
+            with multiprocessing.get_context('spawn').Pool(workers) as pool:
+                pool.starmap(extract_nested_zip, nested_zip_tasks)
+        else:
+            for nested_zip_task in nested_zip_tasks:
+                extract_nested_zip(*nested_zip_task)
+        log.info(f"Diagnostic bundle unzipped ({self.extract_mode}) with {len(nested_zips)} nested zips at "
+                 f"{self.extracted_diag_bundle_path} in {time.monotonic() - started:.0f} seconds.")
         os.remove(diagnostic_bundle_local_path)
+        if self.remove_download_dir and not os.listdir(self.download_dir):
+            os.rmdir(self.download_dir)
+
+    def download_diagnostic_bundle(self, command_id):
+        """
+        Downloads the bundle of the command into the download dir, split into byte ranges fetched in parallel. Every
+        range is appended to its own part file, so an interrupted download is resumed by a rerun for the same command
+        id. The joined zip is only returned once its size and the CRC of every member are verified.
+        """
+        # The bundle holds sensitive cluster diagnostics, only the user running the tool may read it
+        os.makedirs(self.download_dir, mode=0o700, exist_ok=True)
+        bundle_path = os.path.join(self.download_dir, f"{command_id}-scm-command-result.zip")
+        state_path = f"{bundle_path}.ranges.json"
+        if os.path.exists(bundle_path) and not os.path.exists(state_path):
+            log.info("Reusing the diagnostic bundle downloaded before: %s", bundle_path)
+            try:
+                self.verify_diagnostic_bundle(bundle_path, os.path.getsize(bundle_path))
+                return bundle_path
+            except IOError as error:
+                log.warning(f"{error}, downloading it again.")
+
+        config = cm_client.configuration
+        api_url = urlparse(config.host)
+        url = f"{api_url.scheme}://{api_url.netloc}/cmf/command/{command_id}/download"
+        session = requests.Session()
+        session.auth = (config.username, config.password)
+        session.verify = False
+        session.mount(url, requests.adapters.HTTPAdapter(pool_maxsize=self.download_workers))
+
+        with session.get(url, headers={"Range": "bytes=0-0"}, stream=True) as r:
+            r.raise_for_status()
+            ranges_supported = r.status_code == 206
+            size = int(r.headers["Content-Range"].split("/")[-1]) if ranges_supported \
+                else int(r.headers.get("Content-Length", -1))
+        if not ranges_supported:
+            log.info("CM does not serve byte ranges, downloading the diagnostic bundle in a single stream.")
+            ranges = [(0, size - 1)]
+        else:
+            ranges = self.load_download_ranges(state_path, size)
+            if not ranges:
+                for stale_part_path in Path(self.download_dir).glob(f"{os.path.basename(bundle_path)}.part*"):
+                    os.remove(stale_part_path)
+                ranges = self.split_download_ranges(size)
+            with open(state_path, "w") as state_file:
+                json.dump({"size": size, "ranges": ranges}, state_file)
+        log.info(f"Downloading {size} bytes of diagnostic bundle in {len(ranges)} ranges.")
+
+        part_paths = [f"{bundle_path}.part{index}" for index in range(len(ranges))]
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.download_workers, thread_name_prefix="diag_bundle_download") as executor:
+            list(executor.map(lambda args: self.download_range(session, url, ranges_supported, *args),
+                              zip(ranges, part_paths)))
+        log.info(f"Downloaded diagnostic bundle in {time.monotonic() - started:.0f} seconds.")
+
+        os.replace(part_paths[0], bundle_path)
+        with open(bundle_path, "ab") as bundle_file:
+            for part_path in part_paths[1:]:
+                with open(part_path, "rb") as part_file:
+                    shutil.copyfileobj(part_file, bundle_file, download_chunk_size)
+                os.remove(part_path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        self.verify_diagnostic_bundle(bundle_path, size)
+        return bundle_path
+
+    def split_download_ranges(self, size):
+        range_size = max(min_download_range_size, -(-size // self.download_workers))
+        return [(start, min(start + range_size, size) - 1) for start in range(0, size, range_size)]
+
+    @staticmethod
+    def load_download_ranges(state_path, size):
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+        if state["size"] != size:
+            log.warning("The diagnostic bundle size changed since the previous download, starting over.")
+            return None
+        log.info("Resuming the previous download of the diagnostic bundle.")
+        return [tuple(download_range) for download_range in state["ranges"]]
+
+    def download_range(self, session, url, ranges_supported, download_range, part_path):
+        start, end = download_range
+        for attempt in range(self.download_retries + 1):
+            downloaded = os.path.getsize(part_path) if ranges_supported and os.path.exists(part_path) else 0
+            if ranges_supported and start + downloaded > end:
+                return
+            headers = {"Range": f"bytes={start + downloaded}-{end}"} if ranges_supported else {}
+            try:
+                with session.get(url, headers=headers, stream=True, timeout=60) as r:
+                    r.raise_for_status()
+                    if ranges_supported and r.status_code != 206:
+                        raise IOError(f"CM answered the range request of {start}-{end} with {r.status_code}")
+                    with open(part_path, "ab" if ranges_supported else "wb") as part_file:
+                        for chunk in r.iter_content(chunk_size=download_chunk_size):
+                            part_file.write(chunk)
+                if not ranges_supported:
+                    return
+            except requests.RequestException as error:
+                if attempt == self.download_retries:
+                    raise
+                log.warning(f"Download of diagnostic bundle range {start}-{end} interrupted, retrying: {error}")
+                time.sleep(2 ** attempt)
+
+    @staticmethod
+    def verify_diagnostic_bundle(bundle_path, size):
+        """
+        Checks the size of the download and the CRC-32 of every member, a corrupt bundle is removed so that the next
+        run downloads it again.
+        """
+        actual_size = os.path.getsize(bundle_path)
+        try:
+            if size >= 0 and actual_size != size:
+                raise IOError(f"expected {size} bytes, got {actual_size}")
+            with ZipFile(bundle_path, 'r') as zipObj:
+                corrupt_member = zipObj.testzip()
+            if corrupt_member:
+                raise IOError(f"CRC check failed for {corrupt_member}")
+        except (IOError, BadZipFile) as error:
+            os.remove(bundle_path)
+            raise IOError(f"Downloaded diagnostic bundle {bundle_path} is corrupt: {error}")
 
     def collect_host_info(self):
         list_hosts = self.hosts_resource_api.read_hosts().items
@@ -19,19 +19,21 @@ import os
 import re
 import sys
 from optparse import OptionParser
-from threading import Thread
 
 import cm_client
 import urllib3
 import yaml
 
 from cm_api_extractor import CmApiExtractor
+from cm_command_waiter import CmCommandWaiter
 from cm_metrics_extractor import CmMetricsExtractor
+from cm_topology_cache import CmTopologyCache
 from diagnostic_bundle_extractor import DiagnosticBundleExtractor
 from discovery_bundle_builder_utils import create_directory
 from hdfs_fs_image_extractor import HdfsFsImageExtractor
 from hive_metastore_extractor import HiveMetastoreExtractor
 from sentry_policies_extractor import SentryPoliciesExtractor
+from task_graph import TaskGraph
 from workload_extractor import ImpalaProfilesExtractor
 from workload_extractor import YarnWorkloadExtractor
 
@@ -94,6 +96,134 @@ if __name__ == '__main__':
                       metavar='<sensitive_values_redacted>',
                       help='Option to disable redaction. If option not set, it defaults to redacting sensitive values.')
 
+    parser.add_option('--bundle-compression', action='store', type='choice',
+                      dest='bundle_compression', default='none',
+                      choices=['none', 'gzip', 'zstd'],
+                      metavar='<none|gzip|zstd>',
+                      help='Compress the JSON and CSV files of the bundle (.gz or .zst suffix). The reports builder reads compressed and plain files. Defaults to none.')
+
+    parser.add_option('--previous-bundle', action='store',
+                      dest='previous_bundle', default=None,
+                      metavar='<previous_bundle_dir>',
+                      help='Discovery bundle directory of a previous run. CM metrics already collected there are reused and only the time range collected since is fetched and merged in. Workload logs unchanged since then are taken from it instead of HDFS.')
+
+    parser.add_option('--cm-metrics-workers', action='store', type='int',
+                      dest='cm_metrics_workers', default=8,
+                      metavar='<cm_metrics_workers>',
+                      help='Maximum number of concurrent time-series queries sent to Cloudera Manager. The concurrency is reduced automatically while CM answers with server errors or slowly. Defaults to 8.')
+
+    parser.add_option('--cm-metrics-host-batch-size', action='store', type='int',
+                      dest='cm_metrics_host_batch_size', default=50,
+                      metavar='<cm_metrics_host_batch_size>',
+                      help='Number of hosts whose metrics are fetched with a single time-series query. Defaults to 50.')
+
+    parser.add_option('--cm-api-workers', action='store', type='int',
+                      dest='cm_api_workers', default=8,
+                      metavar='<cm_api_workers>',
+                      help='Number of service, role and role config group configurations exported from Cloudera Manager concurrently. Defaults to 8.')
+
+    parser.add_option('--role-configs', action='store', type='choice',
+                      dest='role_configs', default='full',
+                      choices=['full', 'overrides'],
+                      metavar='<full|overrides>',
+                      help='Role configurations to export. overrides only stores the values set on the role itself and skips roles identical to their role config group. Defaults to full.')
+
+    parser.add_option('--config-source', action='store', type='choice',
+                      dest='config_source', default='api',
+                      choices=['api', 'export'],
+                      metavar='<api|export>',
+                      help='Source of the service and role config group configurations. export builds them from the cluster export, which only holds non-default values, and reads just the role overrides from the API. Defaults to api.')
+
+    parser.add_option('--hdfs-report-format', action='store', type='choice',
+                      dest='hdfs_report_format', default='csv',
+                      choices=['csv', 'parquet'],
+                      metavar='<csv|parquet>',
+                      help='Format of the fsimage dump stored in the bundle. Parquet is compressed and keeps only the columns needed by the HDFS reports. Defaults to csv.')
+
+    parser.add_option('--hdfs-report-workers', action='store', type='int',
+                      dest='hdfs_report_workers', default=4,
+                      metavar='<hdfs_report_workers>',
+                      help='Number of clusters to fetch and convert the FSImage from concurrently. Defaults to 4.')
+
+    parser.add_option('--fs-image-reader', action='store', type='choice',
+                      dest='fs_image_reader', default='oiv',
+                      choices=['oiv', 'native'],
+                      metavar='<oiv|native>',
+                      help='Tool used to decode the fetched FSImage. native decodes it in parallel processes straight into Parquet and implies --hdfs-report-format=parquet, falling back to oiv if the image can not be read. Defaults to oiv.')
+
+    parser.add_option('--fs-image-reader-workers', action='store', type='int',
+                      dest='fs_image_reader_workers', default=None,
+                      metavar='<fs_image_reader_workers>',
+                      help='Number of processes used by the native FSImage reader for each cluster. Defaults to the number of CPUs divided by the number of clusters read concurrently (--hdfs-report-workers).')
+
+    parser.add_option('--diagnostic-bundle-command-id', action='store', type='int',
+                      dest='diagnostic_bundle_command_id', default=None,
+                      metavar='<diagnostic_bundle_command_id>',
+                      help='Id of a diagnostic data collection command started before. Its bundle is downloaded instead of collecting a new one, resuming a partial download left in the download directory.')
+
+    parser.add_option('--diagnostic-bundle-download-dir', action='store',
+                      dest='diagnostic_bundle_download_dir', default=None,
+                      metavar='<diagnostic_bundle_download_dir>',
+                      help='Directory the diagnostic bundle is downloaded to, created readable by the current user only. Pass the same directory on a rerun to resume an interrupted download. Defaults to diagnostic_bundle_download in the output directory, removed once the bundle is extracted.')
+
+    parser.add_option('--diagnostic-bundle-download-workers', action='store', type='int',
+                      dest='diagnostic_bundle_download_workers', default=4,
+                      metavar='<diagnostic_bundle_download_workers>',
+                      help='Number of byte ranges of the diagnostic bundle downloaded in parallel. Defaults to 4.')
+
+    parser.add_option('--diagnostic-bundle-extract', action='store', type='choice',
+                      dest='diagnostic_bundle_extract', default='selective',
+                      choices=['selective', 'full'],
+                      metavar='<selective|full>',
+                      help='Members of the diagnostic bundle to extract. selective only extracts the host statistics and Impala profiles used by the bundle builder, full extracts every nested host zip. Defaults to selective.')
+
+    parser.add_option('--diagnostic-bundle-extract-workers', action='store', type='int',
+                      dest='diagnostic_bundle_extract_workers', default=None,
+                      metavar='<diagnostic_bundle_extract_workers>',
+                      help='Number of processes extracting the nested zips of the diagnostic bundle. Defaults to the number of CPUs.')
+
+    parser.add_option('--cm-command-max-poll-interval', action='store', type='int',
+                      dest='cm_command_max_poll_interval', default=60,
+                      metavar='<cm_command_max_poll_interval>',
+                      help='Maximum number of seconds between two status checks of a running CM command. Checks start after 1 second and back off exponentially up to this interval. Defaults to 60.')
+
+    parser.add_option('--hdfs-transfer', action='store', type='choice',
+                      dest='hdfs_transfer', default='webhdfs',
+                      choices=['webhdfs', 'shell'],
+                      metavar='<webhdfs|shell>',
+                      help='How the workload logs are listed and downloaded from HDFS. webhdfs uses a single WebHDFS client and falls back to shell if WebHDFS is not available, shell runs the hdfs command line. Defaults to webhdfs.')
+
+    parser.add_option('--hdfs-transfer-workers', action='store', type='int',
+                      dest='hdfs_transfer_workers', default=8,
+                      metavar='<hdfs_transfer_workers>',
+                      help='Number of HDFS files (webhdfs) or hdfs dfs -get batches (shell) of the workload logs downloaded in parallel. Defaults to 8.')
+
+    parser.add_option('--webhdfs-ca-bundle', action='store',
+                      dest='webhdfs_ca_bundle', default=None,
+                      metavar='<webhdfs_ca_bundle>',
+                      help='PEM file of the CA certificates WebHDFS over HTTPS is verified against. Defaults to the truststore of ssl-client.xml, read with keytool, or the system CA certificates if there is none.')
+
+    parser.add_option('--webhdfs-insecure', action='store_true',
+                      dest='webhdfs_insecure', default=False,
+                      help='Do not verify the TLS certificates of WebHDFS over HTTPS.')
+
+    parser.add_option('--workload-archive-codec', action='store', type='choice',
+                      dest='workload_archive_codec', default='gzip',
+                      choices=['gzip', 'zstd'],
+                      metavar='<gzip|zstd>',
+                      help='Compression of the workload log archives. gzip writes .tar.gz archives that can be uploaded to WXM, zstd writes smaller .tar.zst archives faster, these are not uploaded by the reports builder. Defaults to gzip.')
+
+    parser.add_option('--workload-archive-threads', action='store', type='int',
+                      dest='workload_archive_threads', default=None,
+                      metavar='<workload_archive_threads>',
+                      help='Number of threads compressing each workload log archive. Defaults to the number of CPUs.')
+
+    parser.add_option('--workload-archive-mode', action='store', type='choice',
+                      dest='workload_archive_mode', default='staged',
+                      choices=['staged', 'streamed'],
+                      metavar='<staged|streamed>',
+                      help='staged downloads the workload logs into the bundle and archives them from there, streamed reads them from HDFS straight into the archives without a local copy, so the bundle only holds the archives. Workload logs of --previous-bundle are only reused when staged. Defaults to staged.')
+
     (options, args) = parser.parse_args()
     if not options.cm_host:  # if cm details is not given
         parser.error('--cm-host not given')
@@ -105,6 +235,8 @@ if __name__ == '__main__':
     module, cm_host, output_dir, time_range_in_days, sensitive_values_redacted, collect_wxm_service_logs = options.module, options.cm_host, options.output_dir, options.time_range_in_days, options.sensitive_values_redacted, options.collect_wxm_service_logs
 
     output_dir = output_dir + "_" + dt_string
+    if options.previous_bundle and os.path.realpath(options.previous_bundle) == os.path.realpath(output_dir):
+        parser.error('--previous-bundle must not be the output directory of this run')
 
     create_directory(f'{output_dir}/logs')
     with open(os.path.join(root_path, 'config', 'log-config.yaml'), 'r') as stream:
@@ -129,6 +261,30 @@ if __name__ == '__main__':
     log.info("*** time-range: %s", time_range_in_days)
     log.info("*** disable-redaction: %s", (not sensitive_values_redacted))
     log.info("*** collect-wxm-service-logs: %s", collect_wxm_service_logs)
+    log.info("*** bundle-compression: %s", options.bundle_compression)
+    log.info("*** previous-bundle: %s", options.previous_bundle)
+    log.info("*** cm-metrics-workers: %s", options.cm_metrics_workers)
+    log.info("*** cm-metrics-host-batch-size: %s", options.cm_metrics_host_batch_size)
+    log.info("*** cm-api-workers: %s", options.cm_api_workers)
+    log.info("*** role-configs: %s", options.role_configs)
+    log.info("*** config-source: %s", options.config_source)
+    log.info("*** hdfs-report-format: %s", options.hdfs_report_format)
+    log.info("*** hdfs-report-workers: %s", options.hdfs_report_workers)
+    log.info("*** fs-image-reader: %s", options.fs_image_reader)
+    log.info("*** fs-image-reader-workers: %s", options.fs_image_reader_workers)
+    log.info("*** diagnostic-bundle-command-id: %s", options.diagnostic_bundle_command_id)
+    log.info("*** diagnostic-bundle-download-dir: %s", options.diagnostic_bundle_download_dir)
+    log.info("*** diagnostic-bundle-download-workers: %s", options.diagnostic_bundle_download_workers)
+    log.info("*** diagnostic-bundle-extract: %s", options.diagnostic_bundle_extract)
+    log.info("*** diagnostic-bundle-extract-workers: %s", options.diagnostic_bundle_extract_workers)
+    log.info("*** cm-command-max-poll-interval: %s", options.cm_command_max_poll_interval)
+    log.info("*** hdfs-transfer: %s", options.hdfs_transfer)
+    log.info("*** hdfs-transfer-workers: %s", options.hdfs_transfer_workers)
+    log.info("*** webhdfs-ca-bundle: %s", options.webhdfs_ca_bundle)
+    log.info("*** webhdfs-insecure: %s", options.webhdfs_insecure)
+    log.info("*** workload-archive-codec: %s", options.workload_archive_codec)
+    log.info("*** workload-archive-threads: %s", options.workload_archive_threads)
+    log.info("*** workload-archive-mode: %s", options.workload_archive_mode)
     log.info("*** INVOCATION PARAMETERS END   ***")
 
 
@@ -152,29 +308,50 @@ if __name__ == '__main__':
 
     cluster_names = list(map(lambda cluster: cluster.display_name, clusters_response.items))
 
-    threads = []
+    bundle_compression = None if options.bundle_compression == 'none' else options.bundle_compression
+
+    # Clusters, services and roles are looked up by all the extractors, fetch them once per run
+    topology = CmTopologyCache()
+
+    # Modules run concurrently, the ones reading the output of another module start once it has finished
+    task_graph = TaskGraph()
 
     if module == 'all' or module == 'cm_metrics':
-        cm_metrics_extractor = CmMetricsExtractor(output_dir, cluster_names, start_timestamp, end_timestamp)
-        threads.append(Thread(target=cm_metrics_extractor.collect_metrics, name="metrics_thread"))
+        cm_metrics_extractor = CmMetricsExtractor(output_dir, cluster_names, start_timestamp, end_timestamp,
+                                                  options.cm_metrics_workers, options.cm_metrics_host_batch_size, topology,
+                                                  options.previous_bundle, bundle_compression)
+        task_graph.add("metrics_thread", cm_metrics_extractor.collect_metrics)
 
     if module == 'all' or module == 'diagnostic_bundle':
-        diagnostic_bundle_extractor = DiagnosticBundleExtractor(output_dir, start_timestamp, end_timestamp)
-        threads.append(Thread(target=diagnostic_bundle_extractor.collect_diagnostic_bundle, name="diag_bundle_thread"))
+        diagnostic_bundle_extractor = DiagnosticBundleExtractor(output_dir, start_timestamp, end_timestamp,
+                                                                options.diagnostic_bundle_command_id,
+                                                                options.diagnostic_bundle_download_dir,
+                                                                options.diagnostic_bundle_download_workers,
+                                                                extract_mode=options.diagnostic_bundle_extract,
+                                                                extract_workers=options.diagnostic_bundle_extract_workers,
+                                                                command_waiter=CmCommandWaiter(
+                                                                    max_delay=options.cm_command_max_poll_interval))
+        task_graph.add("diag_bundle_thread", diagnostic_bundle_extractor.collect_diagnostic_bundle)
 
     if module == 'all' or module == 'cm_api':
-        cm_api_extractor = CmApiExtractor(output_dir, sensitive_values_redacted)
-        threads.append(Thread(target=cm_api_extractor.collect_cm_api_diagnostic, name="cm_api_thread"))
+        cm_api_extractor = CmApiExtractor(output_dir, sensitive_values_redacted, topology, options.cm_api_workers,
+                                          options.role_configs, options.config_source, bundle_compression)
+        task_graph.add("cm_api_thread", cm_api_extractor.collect_cm_api_diagnostic)
 
     if module == 'all' or module == 'hdfs_report':
-        hdfs_extractor = HdfsFsImageExtractor(output_dir)
-        threads.append(Thread(target=hdfs_extractor.collect_fs_image_reports, name="hdfs_report_thread"))
+        hdfs_report_format = 'parquet' if options.fs_image_reader == 'native' else options.hdfs_report_format
+        hdfs_extractor = HdfsFsImageExtractor(output_dir, hdfs_report_format, options.hdfs_report_workers,
+                                              options.fs_image_reader, options.fs_image_reader_workers, topology,
+                                              bundle_compression)
+        task_graph.add("hdfs_report_thread", hdfs_extractor.collect_fs_image_reports)
 
     if module == 'all' or module == 'hive_metastore':
-        HiveMetastoreExtractor(output_dir, db_driver_path).extract_hive_metastore()
+        hive_metastore_extractor = HiveMetastoreExtractor(output_dir, db_driver_path, topology, bundle_compression)
+        task_graph.add("hive_ms_thread", hive_metastore_extractor.extract_hive_metastore)
 
     if module == 'all' or module == 'sentry_extractor':
-        SentryPoliciesExtractor(output_dir, db_driver_path).extract_sentry_policies()
+        sentry_policies_extractor = SentryPoliciesExtractor(output_dir, db_driver_path, topology, bundle_compression)
+        task_graph.add("sentry_thread", sentry_policies_extractor.extract_sentry_policies)
 
     yarn_workloads_to_collect = []
 
@@ -188,19 +365,22 @@ if __name__ == '__main__':
         yarn_workloads_to_collect.append("tez")
 
     if yarn_workloads_to_collect:
-        threads.append(Thread(target=YarnWorkloadExtractor(output_dir, time_range_in_days).collect_workloads,
-                              args=(yarn_workloads_to_collect,),
-                              name="yarn_workloads_collector"))
-
-    for thread in threads:
-        thread.start()
-    for thread in threads:
-        thread.join()
-
-    # Following modules depend on the diagnostic bundle export
+        yarn_workload_extractor = YarnWorkloadExtractor(output_dir, time_range_in_days, topology,
+                                                        options.hdfs_transfer, options.hdfs_transfer_workers,
+                                                        options.previous_bundle, options.workload_archive_codec,
+                                                        options.workload_archive_threads, options.workload_archive_mode,
+                                                        False if options.webhdfs_insecure else options.webhdfs_ca_bundle)
+        task_graph.add("yarn_workloads_collector", yarn_workload_extractor.collect_workloads,
+                       args=(yarn_workloads_to_collect,))
+
+    # The Impala profiles are read from the exported diagnostic bundle
     if collect_wxm_service_logs:
-        impala_workload_extractor = ImpalaProfilesExtractor(output_dir)
-        Thread(target=impala_workload_extractor.collect_impala_profiles, name="impala_profiles_thread").start()
+        impala_workload_extractor = ImpalaProfilesExtractor(output_dir, topology, options.workload_archive_codec,
+                                                            options.workload_archive_threads)
+        task_graph.add("impala_profiles_thread", impala_workload_extractor.collect_impala_profiles,
+                       depends_on=[task for task in ["diag_bundle_thread"] if task in task_graph])
+
+    task_graph.run()
 
     log.info(f"Finished discovery bundle extraction, results available at: {output_dir}")
 
@@ -12,16 +12,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+import gzip
+import io
+import json
 import logging
 import os
 import os.path
 import subprocess
-import tarfile
+import threading
+import time
 from pathlib import Path
 
+from parallel_compression import archive_suffixes, open_archive
+
 root_path = os.path.dirname(os.path.realpath(__file__))
 log = logging.getLogger('main')
 
+compression_suffixes = {"gzip": ".gz", "zstd": ".zst"}
+# jaydebeapi starts the JVM with the first connection, connecting on several threads at once could start it twice
+jdbc_connect_lock = threading.Lock()
+
 
 def create_directory(dir_path):
     path = Path(dir_path)
@@ -30,29 +41,156 @@ def create_directory(dir_path):
         path.mkdir(parents=True, exist_ok=True)
 
 
-def _make_tarfile(output_file_path, source_dir, exclude=None):
+class ApiModelJSONEncoder(json.JSONEncoder):
+    """
+    Serializes cm_client models the same way as ApiClient.sanitize_for_serialization, but one object at a time while
+    the output is being written, so the whole response is never copied into a dict.
+    """
+
+    def default(self, obj):
+        if hasattr(obj, 'swagger_types'):
+            return {obj.attribute_map[attribute]: getattr(obj, attribute) for attribute in obj.swagger_types
+                    if getattr(obj, attribute) is not None}
+        if isinstance(obj, (datetime.datetime, datetime.date)):
+            return obj.isoformat()
+        return json.JSONEncoder.default(self, obj)
+
+
+def open_bundle_file(path, mode="r", compression=None, newline=None):
+    """
+    Opens a bundle file as text for reading ("r") or writing ("w"). gzip and zstd compressed files are written when
+    compression is set and read based on their .gz or .zst suffix, zstd streams are provided by pyarrow.
+    """
+    if mode == "r":
+        compression = next((name for name, suffix in compression_suffixes.items() if path.endswith(suffix)), None)
+    if compression == "gzip":
+        return gzip.open(path, f"{mode}t", encoding="utf-8", newline=newline)
+    if compression == "zstd":
+        import pyarrow as pa
+
+        stream = pa.CompressedOutputStream(path, "zstd") if mode == "w" \
+            else pa.CompressedInputStream(pa.OSFile(path), "zstd")
+        return io.TextIOWrapper(stream, encoding="utf-8", newline=newline)
+    return open(path, mode, encoding="utf-8", newline=newline)
+
+
+def get_bundle_file_path(path, compression=None):
+    return f"{path}{compression_suffixes[compression]}" if compression else path
+
+
+def find_bundle_file(path):
+    """
+    Returns path, or its compressed variant if only that one exists.
+    """
+    if not os.path.exists(path):
+        for suffix in compression_suffixes.values():
+            if os.path.exists(f"{path}{suffix}"):
+                return f"{path}{suffix}"
+    return path
+
+
+def write_json(path, content, compression=None):
+    """
+    Streams content, a cm_client model or plain JSON types, to path, compressed and suffixed with .gz or .zst if
+    compression is set. Returns the path of the written file.
+    """
+    path = get_bundle_file_path(path, compression)
+    with open_bundle_file(path, "w", compression) as output_file:
+        json.dump(content, output_file, cls=ApiModelJSONEncoder)
+    log.debug(f"Api response stored in: {path}")
+    return path
+
+
+def load_json(path):
+    with open_bundle_file(find_bundle_file(path)) as f:
+        return json.load(f)
+
+
+class AdaptiveRequestLimiter:
+    """
+    Bounds the number of concurrent requests sent to a service. The limit is halved whenever the service answers with
+    a 5xx error or a response takes longer than slow_response_seconds, and grows back by one after every
+    max_concurrency fast successful responses. Failed 5xx requests are retried with exponential backoff.
+    """
+
+    def __init__(self, max_concurrency, slow_response_seconds=30, retries=4, backoff_seconds=2):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.slow_response_seconds = slow_response_seconds
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.limit = self.max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def call(self, function, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.__acquire()
+            started = time.monotonic()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                status = getattr(error, 'status', None)
+                overloaded = status is not None and status >= 500
+                self.__release(healthy=not overloaded)
+                if not overloaded or attempt >= self.retries:
+                    raise
+                delay = self.backoff_seconds * 2 ** attempt
+                attempt += 1
+                log.warning(f"Request failed with HTTP {status}, retrying in {delay} seconds "
+                            f"(attempt {attempt}/{self.retries}, concurrency limit: {self.limit})")
+                time.sleep(delay)
+                continue
+            self.__release(healthy=time.monotonic() - started < self.slow_response_seconds)
+            return result
+
+    def __acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def __release(self, healthy):
+        with self.condition:
+            self.in_flight -= 1
+            if healthy:
+                self.successes += 1
+                if self.successes >= self.max_concurrency and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.successes = 0
+            else:
+                if self.limit > 1:
+                    log.debug(f"Reducing concurrency limit to {max(self.limit // 2, 1)}")
+                self.limit = max(self.limit // 2, 1)
+                self.successes = 0
+            self.condition.notify_all()
+
+
+def _make_tarfile(output_file_path, source_dir, exclude=None, codec="gzip", threads=None):
     log.info("Creating tarball at " + output_file_path + " from " + source_dir)
     files = os.listdir(source_dir)
     log.debug("Files: {}".format(' '.join(map(str, files))))
-    with tarfile.open(output_file_path, "w:gz") as tar:
+    with open_archive(output_file_path, codec, threads) as tar:
         for f in files:
             tar.add(os.path.join(source_dir, f),
                     os.path.basename(f))
     log.info("Tarball created at: %s" % output_file_path)
 
 
-def run_cmd(args_list):
+def run_cmd(args_list, capture_output=False):
     """
-    run linux commands
+    run linux commands, stdout and stderr are only returned if capture_output is set
     """
     # import subprocess
-    result = subprocess.run(args_list)
+    result = subprocess.run(args_list, stdout=subprocess.PIPE if capture_output else None,
+                            stderr=subprocess.PIPE if capture_output else None, universal_newlines=True)
     s_output = result.stdout
     s_err = result.stderr
     s_return = result.returncode
     log.info(f"Executed system command: {' '.join(args_list)}")
     if s_output:
-        log.debug(f"STDOUT: {s_output}")
+        log.debug(f"STDOUT: {len(s_output.splitlines())} lines")
     if s_err:
         if args_list[0] == 'hdfs' and s_return == 0: # hdfs client by default writes everything to STDERR, causing false positive ERROR messages in log if not manually changed to debug
             log.debug(f"STDERR: {s_err}")
@@ -61,19 +199,6 @@ def run_cmd(args_list):
     return s_return, s_output, s_err
 
 
-def check_if_dir_exists(hdfs_config_dir, target_dir):
-    (ret, out, err) = run_cmd(['hdfs', '--config', hdfs_config_dir, 'dfs', '-test', '-d', target_dir])
-    dir_exits = ret == 0
-    log.info(f"Target directory {target_dir} exits in HDFS: {dir_exits}")
-    return dir_exits
-
-
-def copy_to_local(src_hdfs_dir, output_dir, hdfs_config_dir):
-    path = Path(output_dir)
-    path.mkdir(parents=True, exist_ok=True)
-    run_cmd(['hdfs', '--config', hdfs_config_dir, 'dfs', '-get', src_hdfs_dir, output_dir])
-
-
 def retrieve_hdfs_username_group(hdfs_config_dir):
     log.debug("Retrieving HDFS username and groups")
     run_cmd(['hdfs', '--config', hdfs_config_dir, 'groups'])
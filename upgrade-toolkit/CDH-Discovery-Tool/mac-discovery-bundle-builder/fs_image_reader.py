@@ -0,0 +1,574 @@
+# Copyright 2022 Cloudera, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reader for the protobuf based fsimage format (HDFSIMG1) that converts the INODE and INODE_DIR sections directly into
+the Parquet fsimage dump used by the HDFS reports, without going through 'hdfs oiv' and a text CSV.
+
+Sections are decoded in parallel worker processes. Images saved with parallel sections (dfs.image.parallel.save)
+are split along their INODE_SUB and INODE_DIR_SUB sub-sections, uncompressed images without them are split by
+walking the message lengths. Children that were renamed or moved below snapshottable directories are listed as
+references (DirEntry refChildren) and resolved to their inodes through the INODE_REFERENCE section.
+"""
+
+import logging
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+log = logging.getLogger('main')
+
+fs_image_magic = b"HDFSIMG1"
+root_inode_id = 16385
+inode_type_file = 1
+inode_type_directory = 2
+read_buffer_size = 4 * 1024 * 1024
+part_batch_size = 1000000
+
+supported_codecs = {
+    "": None,
+    "org.apache.hadoop.io.compress.GzipCodec": 16 + zlib.MAX_WBITS,
+    "org.apache.hadoop.io.compress.DefaultCodec": zlib.MAX_WBITS
+}
+
+
+class FsImageFormatError(Exception):
+    pass
+
+
+def fs_image_parquet_schema():
+    return pa.schema([
+        ('ParentPath', pa.dictionary(pa.int32(), pa.string())),
+        ('Name', pa.string()),
+        ('Replication', pa.int32()),
+        ('ModificationTime', pa.int64()),
+        ('PreferredBlockSize', pa.int64()),
+        ('BlocksCount', pa.int64()),
+        ('FileSize', pa.int64())
+    ])
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _skip_field(buf, pos, wire_type):
+    if wire_type == 0:
+        _, pos = _read_varint(buf, pos)
+    elif wire_type == 1:
+        pos += 8
+    elif wire_type == 2:
+        length, pos = _read_varint(buf, pos)
+        pos += length
+    elif wire_type == 5:
+        pos += 4
+    else:
+        raise FsImageFormatError(f"Unsupported protobuf wire type: {wire_type}")
+    return pos
+
+
+def _read_packed_varints(buf, pos, end):
+    values = []
+    while pos < end:
+        value, pos = _read_varint(buf, pos)
+        values.append(value)
+    return values
+
+
+class DelimitedMessageReader:
+    """
+    Reads length delimited protobuf messages from a byte range of the image, decompressing it if needed.
+    """
+
+    def __init__(self, image_path, offset, length, codec):
+        self.file = open(image_path, 'rb')
+        self.file.seek(offset)
+        self.remaining = length
+        self.decompressor = zlib.decompressobj(supported_codecs[codec]) if supported_codecs[codec] else None
+        self.buffer = bytearray()
+        self.pos = 0
+
+    def close(self):
+        self.file.close()
+
+    def __fill(self, size):
+        while len(self.buffer) - self.pos < size:
+            if self.remaining <= 0:
+                return False
+            data = self.file.read(min(read_buffer_size, self.remaining))
+            if not data:
+                return False
+            self.remaining -= len(data)
+            if self.decompressor:
+                data = self.decompressor.decompress(data)
+            if self.pos > read_buffer_size:
+                del self.buffer[:self.pos]
+                self.pos = 0
+            self.buffer.extend(data)
+        return True
+
+    def next_message(self):
+        if not self.__fill(1):
+            return None
+        self.__fill(10)
+        length, self.pos = _read_varint(self.buffer, self.pos)
+        if not self.__fill(length):
+            raise FsImageFormatError("Unexpected end of section")
+        message = bytes(self.buffer[self.pos:self.pos + length])
+        self.pos += length
+        return message
+
+    def skip_message(self):
+        """
+        Skips the next message without copying it, returns its size including the length prefix or None at the end.
+        """
+        if not self.__fill(1):
+            return None
+        self.__fill(10)
+        start = self.pos
+        length, self.pos = _read_varint(self.buffer, self.pos)
+        if not self.__fill(length):
+            raise FsImageFormatError("Unexpected end of section")
+        self.pos += length
+        return self.pos - start
+
+
+def read_file_summary(image_path):
+    with open(image_path, 'rb') as image:
+        if image.read(len(fs_image_magic)) != fs_image_magic:
+            raise FsImageFormatError(f"{image_path} is not a protobuf fsimage")
+        image.seek(-4, os.SEEK_END)
+        summary_length = struct.unpack('>i', image.read(4))[0]
+        image.seek(-4 - summary_length, os.SEEK_END)
+        summary = image.read(summary_length)
+    length, pos = _read_varint(summary, 0)
+    end = pos + length
+    codec = ""
+    sections = []
+    while pos < end:
+        key, pos = _read_varint(summary, pos)
+        field, wire_type = key >> 3, key & 7
+        if field == 3 and wire_type == 2:
+            length, pos = _read_varint(summary, pos)
+            codec = summary[pos:pos + length].decode('utf-8')
+            pos += length
+        elif field == 4 and wire_type == 2:
+            length, pos = _read_varint(summary, pos)
+            sections.append(_parse_section(summary, pos, pos + length))
+            pos += length
+        else:
+            pos = _skip_field(summary, pos, wire_type)
+    if codec not in supported_codecs:
+        raise FsImageFormatError(f"Unsupported fsimage compression codec: {codec}")
+    return codec, sections
+
+
+def _parse_section(buf, pos, end):
+    section = {"name": "", "length": 0, "offset": 0}
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+        if field == 1 and wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            section["name"] = buf[pos:pos + length].decode('utf-8')
+            pos += length
+        elif field == 2 and wire_type == 0:
+            section["length"], pos = _read_varint(buf, pos)
+        elif field == 3 and wire_type == 0:
+            section["offset"], pos = _read_varint(buf, pos)
+        else:
+            pos = _skip_field(buf, pos, wire_type)
+    return section
+
+
+def _parse_inode_section_header(message):
+    pos = 0
+    last_inode_id = 0
+    while pos < len(message):
+        key, pos = _read_varint(message, pos)
+        if key == (1 << 3):
+            last_inode_id, pos = _read_varint(message, pos)
+        else:
+            pos = _skip_field(message, pos, key & 7)
+    return last_inode_id
+
+
+def _parse_inode(message):
+    """
+    Returns (id, type, name, replication, modification time, preferred block size, blocks count, file size).
+    """
+    pos = 0
+    end = len(message)
+    inode_id = inode_type = 0
+    name = b""
+    body_start = body_end = 0
+    while pos < end:
+        key, pos = _read_varint(message, pos)
+        field, wire_type = key >> 3, key & 7
+        if field == 1 and wire_type == 0:
+            inode_type, pos = _read_varint(message, pos)
+        elif field == 2 and wire_type == 0:
+            inode_id, pos = _read_varint(message, pos)
+        elif field == 3 and wire_type == 2:
+            length, pos = _read_varint(message, pos)
+            name = message[pos:pos + length]
+            pos += length
+        elif field in (4, 5) and wire_type == 2:
+            length, pos = _read_varint(message, pos)
+            body_start, body_end = pos, pos + length
+            pos += length
+        else:
+            pos = _skip_field(message, pos, wire_type)
+
+    replication = modification_time = preferred_block_size = blocks_count = file_size = 0
+    pos = body_start
+    while pos < body_end:
+        key, pos = _read_varint(message, pos)
+        field, wire_type = key >> 3, key & 7
+        if inode_type == inode_type_file and field == 1 and wire_type == 0:
+            replication, pos = _read_varint(message, pos)
+        elif inode_type == inode_type_file and field == 2 and wire_type == 0:
+            modification_time, pos = _read_varint(message, pos)
+        elif inode_type == inode_type_file and field == 4 and wire_type == 0:
+            preferred_block_size, pos = _read_varint(message, pos)
+        elif inode_type == inode_type_file and field == 6 and wire_type == 2:
+            length, pos = _read_varint(message, pos)
+            blocks_count += 1
+            file_size += _parse_block_size(message, pos, pos + length)
+            pos += length
+        elif inode_type == inode_type_directory and field == 1 and wire_type == 0:
+            modification_time, pos = _read_varint(message, pos)
+        else:
+            pos = _skip_field(message, pos, wire_type)
+    return (inode_id, inode_type, name.decode('utf-8', errors='replace'), replication, modification_time,
+            preferred_block_size, blocks_count, file_size)
+
+
+def _parse_block_size(buf, pos, end):
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        if key == (3 << 3):
+            num_bytes, pos = _read_varint(buf, pos)
+            return num_bytes
+        pos = _skip_field(buf, pos, key & 7)
+    return 0
+
+
+def _parse_dir_entry(message):
+    """
+    Returns (parent, children, reference children), the latter are indexes into the INODE_REFERENCE section.
+    """
+    pos = 0
+    end = len(message)
+    parent = 0
+    children = []
+    reference_children = []
+    while pos < end:
+        key, pos = _read_varint(message, pos)
+        field, wire_type = key >> 3, key & 7
+        if field == 1 and wire_type == 0:
+            parent, pos = _read_varint(message, pos)
+        elif field == 2 and wire_type == 2:
+            length, pos = _read_varint(message, pos)
+            children.extend(_read_packed_varints(message, pos, pos + length))
+            pos += length
+        elif field == 2 and wire_type == 0:
+            child, pos = _read_varint(message, pos)
+            children.append(child)
+        elif field == 3 and wire_type == 2:
+            length, pos = _read_varint(message, pos)
+            reference_children.extend(_read_packed_varints(message, pos, pos + length))
+            pos += length
+        elif field == 3 and wire_type == 0:
+            reference_child, pos = _read_varint(message, pos)
+            reference_children.append(reference_child)
+        else:
+            pos = _skip_field(message, pos, wire_type)
+    return parent, children, reference_children
+
+
+def _parse_reference(message):
+    """
+    Returns the id of the inode an INodeReference refers to.
+    """
+    pos = 0
+    while pos < len(message):
+        key, pos = _read_varint(message, pos)
+        if key == (1 << 3):
+            referred_id, pos = _read_varint(message, pos)
+            return referred_id
+        pos = _skip_field(message, pos, key & 7)
+    return 0
+
+
+part_schema = pa.schema([
+    ('Id', pa.int64()),
+    ('Type', pa.int8()),
+    ('Name', pa.string()),
+    ('Replication', pa.int32()),
+    ('ModificationTime', pa.int64()),
+    ('PreferredBlockSize', pa.int64()),
+    ('BlocksCount', pa.int64()),
+    ('FileSize', pa.int64())
+])
+
+
+def _decode_inodes(task):
+    """
+    Worker: decodes the INode messages of a byte range into a Parquet part file without paths.
+    """
+    image_path, offset, length, codec, has_header, part_path = task
+    reader = DelimitedMessageReader(image_path, offset, length, codec)
+    writer = pq.ParquetWriter(part_path, part_schema)
+    rows = []
+    count = 0
+    try:
+        if has_header:
+            reader.next_message()
+        while True:
+            message = reader.next_message()
+            if message is None:
+                break
+            rows.append(_parse_inode(message))
+            if len(rows) >= part_batch_size:
+                count += _write_part_rows(writer, rows)
+                rows = []
+        count += _write_part_rows(writer, rows)
+    finally:
+        writer.close()
+        reader.close()
+    return count
+
+
+def _write_part_rows(writer, rows):
+    if rows:
+        columns = list(zip(*rows))
+        writer.write_table(pa.Table.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, part_schema)], schema=part_schema))
+    return len(rows)
+
+
+def _decode_directories(task):
+    """
+    Worker: decodes the DirEntry messages of a byte range into the shared child -> parent memory mapped array.
+    Reference children are resolved to the inodes they refer to with the referred ids stored at references_path.
+    """
+    image_path, offset, length, codec, parents_path, parents_size, references_path = task
+    parents = np.memmap(parents_path, dtype='int64', mode='r+', shape=(parents_size,))
+    references = np.load(references_path, mmap_mode='r') if references_path else np.zeros(0, dtype='int64')
+    reader = DelimitedMessageReader(image_path, offset, length, codec)
+    count = 0
+    try:
+        while True:
+            message = reader.next_message()
+            if message is None:
+                break
+            parent, children, reference_children = _parse_dir_entry(message)
+            if reference_children:
+                children.extend(references[reference_children].tolist())
+            if children:
+                parents[np.array(children, dtype='int64') - root_inode_id] = parent
+                count += len(children)
+    finally:
+        reader.close()
+        parents.flush()
+    return count
+
+
+class FsImageReader:
+    def __init__(self, image_path, workers=None, chunk_size=1000000):
+        self.image_path = image_path
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.codec, self.sections = read_file_summary(image_path)
+
+    def write_parquet(self, output_path):
+        """
+        Writes the fsimage dump of the image to output_path in the same Parquet layout as the converted oiv CSV.
+        """
+        scratch_dir = tempfile.mkdtemp(prefix="fs_image_reader_", dir=os.path.dirname(os.path.abspath(output_path)))
+        try:
+            inode_section = self.__get_section("INODE")
+            last_inode_id = self.__read_last_inode_id(inode_section)
+            parents_size = last_inode_id - root_inode_id + 1
+            parents_path = os.path.join(scratch_dir, "parents.bin")
+            np.memmap(parents_path, dtype='int64', mode='w+', shape=(parents_size,)).flush()
+
+            inode_tasks = [(self.image_path, offset, length, self.codec, has_header,
+                            os.path.join(scratch_dir, f"inodes-{index}.parquet"))
+                           for index, (offset, length, has_header) in enumerate(self.__split("INODE", True))]
+            references_path = self.__write_references(scratch_dir)
+            directory_tasks = [(self.image_path, offset, length, self.codec, parents_path, parents_size,
+                                references_path)
+                               for offset, length, _ in self.__split("INODE_DIR", False)]
+            log.info(f"Decoding {self.image_path} with {self.workers} workers: {len(inode_tasks)} INODE and "
+                     f"{len(directory_tasks)} INODE_DIR ranges, last inode id: {last_inode_id}")
+            with multiprocessing.get_context('spawn').Pool(self.workers) as pool:
+                inode_results = pool.map_async(_decode_inodes, inode_tasks, chunksize=1)
+                directory_results = pool.map_async(_decode_directories, directory_tasks, chunksize=1)
+                inodes = sum(inode_results.get())
+                children = sum(directory_results.get())
+            log.info(f"Decoded {inodes} inodes and {children} directory entries from {self.image_path}")
+
+            parents = np.memmap(parents_path, dtype='int64', mode='r', shape=(parents_size,))
+            part_paths = [task[-1] for task in inode_tasks]
+            directory_paths = self.__build_directory_paths(part_paths, parents)
+            self.__write_output(part_paths, parents, directory_paths, output_path)
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    def __get_section(self, name):
+        section = next(filter(lambda s: s["name"] == name, self.sections), None)
+        if not section:
+            raise FsImageFormatError(f"{name} section is missing from {self.image_path}")
+        return section
+
+    def __write_references(self, scratch_dir):
+        """
+        Stores the referred inode ids of the INODE_REFERENCE section, indexed like the references, in the scratch
+        directory for the directory workers. Returns the path, or None if the image has no references.
+        """
+        section = next(filter(lambda s: s["name"] == "INODE_REFERENCE", self.sections), None)
+        if not section or not section["length"]:
+            return None
+        reader = DelimitedMessageReader(self.image_path, section["offset"], section["length"], self.codec)
+        referred_ids = []
+        try:
+            while True:
+                message = reader.next_message()
+                if message is None:
+                    break
+                referred_ids.append(_parse_reference(message))
+        finally:
+            reader.close()
+        log.info(f"Read {len(referred_ids)} inode references from {self.image_path}")
+        references_path = os.path.join(scratch_dir, "references.npy")
+        np.save(references_path, np.array(referred_ids, dtype='int64'))
+        return references_path
+
+    def __read_last_inode_id(self, inode_section):
+        reader = DelimitedMessageReader(self.image_path, inode_section["offset"], inode_section["length"], self.codec)
+        try:
+            return _parse_inode_section_header(reader.next_message())
+        finally:
+            reader.close()
+
+    def __split(self, name, has_header):
+        """
+        Returns (offset, length, has_header) byte ranges covering the section that can be decoded independently.
+        """
+        sub_sections = [s for s in self.sections if s["name"] == f"{name}_SUB"]
+        if sub_sections:
+            return [(s["offset"], s["length"], has_header and index == 0) for index, s in enumerate(sub_sections)]
+        section = self.__get_section(name)
+        if self.codec or self.workers == 1:
+            return [(section["offset"], section["length"], has_header)]
+        return self.__split_by_message_lengths(section, has_header)
+
+    def __split_by_message_lengths(self, section, has_header):
+        target_length = max(section["length"] // (self.workers * 4), 1)
+        reader = DelimitedMessageReader(self.image_path, section["offset"], section["length"], self.codec)
+        ranges = []
+        try:
+            range_start = 0
+            position = 0
+            if has_header:
+                position += reader.skip_message()
+            while True:
+                size = reader.skip_message()
+                if size is None:
+                    break
+                position += size
+                if position - range_start >= target_length:
+                    ranges.append((section["offset"] + range_start, position - range_start,
+                                   has_header and range_start == 0))
+                    range_start = position
+            if position > range_start or not ranges:
+                ranges.append((section["offset"] + range_start, position - range_start,
+                               has_header and range_start == 0))
+        finally:
+            reader.close()
+        return ranges
+
+    def __iter_parts(self, part_paths, columns):
+        for part_path in part_paths:
+            for batch in pq.ParquetFile(part_path).iter_batches(batch_size=self.chunk_size, columns=columns):
+                yield batch.to_pandas()
+
+    def __build_directory_paths(self, part_paths, parents):
+        names = {}
+        for df in self.__iter_parts(part_paths, ['Id', 'Type', 'Name']):
+            directories = df[df['Type'] == inode_type_directory]
+            names.update(zip(directories['Id'].values.tolist(), directories['Name'].values.tolist()))
+        paths = {root_inode_id: '/'}
+        for directory_id in names:
+            unresolved = []
+            current = directory_id
+            while current not in paths:
+                parent = int(parents[current - root_inode_id]) if current in names else 0
+                if parent == 0:
+                    break
+                unresolved.append(current)
+                current = parent
+            parent_path = paths.get(current)
+            for unresolved_id in reversed(unresolved):
+                if parent_path is not None:
+                    parent_path = (parent_path if parent_path != '/' else '') + '/' + names[unresolved_id]
+                paths[unresolved_id] = parent_path
+        log.debug(f"Resolved the path of {len(paths)} directories")
+        return pd.Series(paths)
+
+    def __write_output(self, part_paths, parents, directory_paths, output_path):
+        schema = fs_image_parquet_schema()
+        orphans = 0
+        writer = pq.ParquetWriter(output_path, schema, compression='zstd', use_dictionary=['ParentPath'])
+        try:
+            for df in self.__iter_parts(part_paths, None):
+                ids = df['Id'].values
+                parent_paths = pd.Series(np.asarray(parents[ids - root_inode_id])).map(directory_paths)
+                parent_paths[ids == root_inode_id] = '/'
+                resolved = parent_paths.notna().values
+                orphans += int((~resolved).sum())
+                df = df[resolved]
+                writer.write_table(pa.Table.from_arrays([
+                    pa.array(parent_paths[resolved].values, type=pa.string()).dictionary_encode(),
+                    pa.array(df['Name'].values, type=pa.string()),
+                    pa.array(df['Replication'].values, type=pa.int32()),
+                    pa.array(df['ModificationTime'].values, type=pa.int64()),
+                    pa.array(df['PreferredBlockSize'].values, type=pa.int64()),
+                    pa.array(df['BlocksCount'].values, type=pa.int64()),
+                    pa.array(df['FileSize'].values, type=pa.int64())
+                ], schema=schema))
+        finally:
+            writer.close()
+        if orphans:
+            log.warning(f"{orphans} inodes of {self.image_path} are not reachable from the root directory "
+                        f"(e.g. deleted, but kept by snapshots) and were skipped")
+        log.info(f"Parquet fsimage created at: {output_path}")
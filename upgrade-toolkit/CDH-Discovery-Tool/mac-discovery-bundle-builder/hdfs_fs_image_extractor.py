@@ -13,32 +13,66 @@
 # limitations under the License.
 
 import csv
+import json
 import logging.config
 import os
 import os.path
+import numpy as np
 import pandas as pd
 import shutil
 import tempfile
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
 import cm_client
 
-from discovery_bundle_builder_utils import create_directory, run_cmd
+from cm_topology_cache import CmTopologyCache
+from discovery_bundle_builder_utils import create_directory, get_bundle_file_path, open_bundle_file, run_cmd
 
 log = logging.getLogger('main')
 
+fs_image_chunk_size = 1000000
+
 
 class HdfsFsImageExtractor:
-    def __init__(self, output_dir):
+    def __init__(self, output_dir, output_format="csv", max_workers=4, fs_image_reader="oiv",
+                 fs_image_reader_workers=None, topology=None, compression=None):
         self.output_dir = output_dir
+        self.compression = compression
+        self.output_format = output_format
+        self.max_workers = max_workers
+        self.fs_image_reader = fs_image_reader
+        self.fs_image_reader_workers = fs_image_reader_workers
         self.services_resource = cm_client.ServicesResourceApi()
+        self.topology = topology or CmTopologyCache()
 
     def collect_fs_image_reports(self):
-        cm_deployment = cm_client.ClouderaManagerResourceApi().get_deployment2()
-        for cluster in cm_deployment.clusters:
-            self.collect_fs_image_report_from_cluster(cluster)
+        clusters = self.topology.get_clusters()
+        log.info(f"Collecting FSImage reports from {len(clusters)} clusters "
+                 f"with {self.max_workers} workers.")
+        if self.fs_image_reader == "native" and not self.fs_image_reader_workers:
+            # Every cluster read concurrently starts its own pool of reader processes, together they use all the CPUs
+            concurrent_clusters = max(min(self.max_workers, len(clusters)), 1)
+            self.fs_image_reader_workers = max((os.cpu_count() or 1) // concurrent_clusters, 1)
+            log.info(f"The native FSImage reader uses {self.fs_image_reader_workers} processes for each cluster.")
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hdfs_report") as executor:
+            list(executor.map(self.collect_fs_image_report_with_timing, clusters))
+
+    def collect_fs_image_report_with_timing(self, cluster):
+        log.info(f"FSImage report collection started on {cluster.display_name}.")
+        started = time.monotonic()
+        try:
+            hdfs_fs_path = self.collect_fs_image_report_from_cluster(cluster)
+        except Exception as error:
+            log.error(f"FSImage report collection failed on {cluster.display_name} after "
+                      f"{time.monotonic() - started:.0f} seconds: {error}")
+            return
+        log.info(f"FSImage report collection finished on {cluster.display_name} in "
+                 f"{time.monotonic() - started:.0f} seconds. Result: {hdfs_fs_path}")
+        return hdfs_fs_path
 
     def collect_fs_image_report_from_cluster(self, cluster):
         cluster_name = cluster.display_name
@@ -47,67 +81,174 @@ class HdfsFsImageExtractor:
         if not hdfs_service:
             log.debug(f"HDFS is not deployed on cluster service deployed on cluster: {cluster_name}")
             return
-        client_config_path = self.fetch_client_config(cluster_name, hdfs_service.name)
-        hdfs_policies_output_dir = os.path.join(self.output_dir, "workload", cluster.display_name.replace(" ", "_"), "service",
+        scratch_dir = tempfile.mkdtemp(prefix=f"hdfs_report_{cluster_name.replace(' ', '_')}_")
+        try:
+            client_config_path = self.fetch_client_config(cluster_name, hdfs_service.name, scratch_dir)
+            return self.collect_fs_image(cluster_name, hdfs_service, client_config_path)
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    def collect_fs_image(self, cluster_name, hdfs_service, client_config_path):
+        hdfs_policies_output_dir = os.path.join(self.output_dir, "workload", cluster_name.replace(" ", "_"), "service",
                                                 hdfs_service.name)
         create_directory(hdfs_policies_output_dir)
 
         fs_image_path = os.path.join(hdfs_policies_output_dir,
                                      f"dfs_image_{cluster_name.replace(' ', '_')}_{datetime.utcnow().isoformat()}")
+        step_started = time.monotonic()
         run_cmd(['hdfs', '--config', client_config_path, 'dfsadmin', '-fetchImage', fs_image_path])
+        log.info(f"Fetched FSImage of {cluster_name} in {time.monotonic() - step_started:.0f} seconds.")
 
         # if previous command fails, necessary input file for the following command will be missing, output meaningful error message instead
+        if os.path.exists(fs_image_path) and self.fs_image_reader == "native":
+            hdfs_fs_parquet_path = self.read_fs_image(cluster_name, fs_image_path, hdfs_policies_output_dir)
+            if hdfs_fs_parquet_path:
+                return hdfs_fs_parquet_path
         if os.path.exists(fs_image_path):
             hdfs_fs_csv_path = os.path.join(hdfs_policies_output_dir, "hdfs_fs.csv")
+            step_started = time.monotonic()
             run_cmd(
                 ['hdfs', 'oiv', '-p', 'Delimited', '-delimiter', '","', '-i',
                  fs_image_path, '-o', hdfs_fs_csv_path])
             os.remove(fs_image_path)
-            try:
-                """
-                'hdfs iov' has a bug which generates broken CSV in case filenames have commas
-                in them. Below code checks if CSV is valid, and if it's not fixes it.
-                """
-                pd.read_csv(hdfs_fs_csv_path)
-            except pd.errors.ParserError:
+            log.info(f"Converted FSImage of {cluster_name} to CSV in {time.monotonic() - step_started:.0f} seconds.")
+            if self.output_format == "parquet":
                 self.fix_broken_hdfs_csv(hdfs_fs_csv_path)
-                pd.read_csv(hdfs_fs_csv_path) # Try to read csv again to verify it is fixed
-            return hdfs_fs_csv_path
+                hdfs_fs_parquet_path = os.path.join(hdfs_policies_output_dir, "hdfs_fs.parquet")
+                self.convert_to_parquet(hdfs_fs_csv_path, hdfs_fs_parquet_path)
+                os.remove(hdfs_fs_csv_path)
+                return hdfs_fs_parquet_path
+            return self.fix_broken_hdfs_csv(hdfs_fs_csv_path, self.compression)
         else:
             log.error("No local FSImage copy could be created due to previous error - skipping CSV conversion!")
             return
 
-    def fix_broken_hdfs_csv(self, input_file_path):
-        with open(input_file_path, mode='r', encoding='utf-8') as infile:
-            reader = csv.reader(infile)
+    def read_fs_image(self, cluster_name, fs_image_path, output_dir):
+        """
+        Decodes the fetched FSImage with the built-in reader straight into hdfs_fs.parquet. Returns None if the image
+        can not be read this way, so the caller can fall back to 'hdfs oiv'.
+        """
+        from fs_image_reader import FsImageReader, FsImageFormatError
 
-            header = next(reader)
-            header_length = len(header)
+        hdfs_fs_parquet_path = os.path.join(output_dir, "hdfs_fs.parquet")
+        step_started = time.monotonic()
+        try:
+            FsImageReader(fs_image_path, self.fs_image_reader_workers, fs_image_chunk_size) \
+                .write_parquet(hdfs_fs_parquet_path)
+        except FsImageFormatError as error:
+            log.warning(f"Unable to read the FSImage of {cluster_name} natively, falling back to 'hdfs oiv': {error}")
+            return
+        except Exception:
+            log.exception(f"The built-in reader failed on the FSImage of {cluster_name}, falling back to 'hdfs oiv'")
+            if os.path.exists(hdfs_fs_parquet_path):
+                os.remove(hdfs_fs_parquet_path)
+            return
+        os.remove(fs_image_path)
+        log.info(f"Converted FSImage of {cluster_name} to Parquet in {time.monotonic() - step_started:.0f} seconds.")
+        return hdfs_fs_parquet_path
 
-            """
-            Since the input_file may be pretty large we need to "stream" the results from one file to another to save RAM.
-            Instead of saving input_file contents into memory.
-            """
-            with tempfile.NamedTemporaryFile(mode='w+', newline='', encoding='utf-8', delete=False) as outfile:
-                writer = csv.writer(outfile)
-                writer.writerow(header)  # Write header
+    def convert_to_parquet(self, hdfs_fs_csv_path, hdfs_fs_parquet_path):
+        """
+        Converts the oiv CSV into a zstd compressed Parquet file keeping only the columns used by the HDFS reports.
+        Paths are split into a dictionary encoded ParentPath and a Name, sizes and modification times (epoch millis)
+        are stored as int64. oiv prints the modification times in the local timezone of this host, they are converted
+        to UTC like the ones written by the native reader.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        from tzlocal import get_localzone_name
+        from fs_image_reader import fs_image_parquet_schema
 
+        log.info(f"Converting {hdfs_fs_csv_path} to {hdfs_fs_parquet_path}")
+        schema = fs_image_parquet_schema()
+        columns = ['Path', 'Replication', 'ModificationTime', 'PreferredBlockSize', 'BlocksCount', 'FileSize']
+        local_timezone = get_localzone_name()
+        writer = pq.ParquetWriter(hdfs_fs_parquet_path, schema, compression='zstd', use_dictionary=['ParentPath'])
+        try:
+            for chunk in pd.read_csv(hdfs_fs_csv_path, usecols=columns, chunksize=fs_image_chunk_size):
+                paths = chunk['Path'].astype(str)
+                # Times repeated when the clocks go back are taken as standard time, skipped ones are moved forward
+                modification_times = pd.to_datetime(chunk['ModificationTime']).dt.tz_localize(
+                    local_timezone, ambiguous=np.zeros(len(chunk), dtype=bool), nonexistent='shift_forward')
+                modification_times = modification_times.dt.tz_convert('UTC').dt.tz_localize(None) \
+                    .values.astype('int64') // 10 ** 6
+                writer.write_table(pa.Table.from_arrays([
+                    pa.array(paths.str.replace(r'/[^/]*$', '', regex=True).replace('', '/')).dictionary_encode(),
+                    pa.array(paths.str.rpartition('/')[2]),
+                    pa.array(chunk['Replication'].values, type=pa.int32()),
+                    pa.array(modification_times, type=pa.int64()),
+                    pa.array(chunk['PreferredBlockSize'].values, type=pa.int64()),
+                    pa.array(chunk['BlocksCount'].values, type=pa.int64()),
+                    pa.array(chunk['FileSize'].values, type=pa.int64())
+                ], schema=schema))
+        finally:
+            writer.close()
+        log.info(f"Parquet fsimage created at: {hdfs_fs_parquet_path}")
+
+    def fix_broken_hdfs_csv(self, input_file_path, compression=None):
+        """
+        'hdfs oiv' has a bug which generates broken CSV in case filenames have commas in them. Rows with extra cells
+        get the leading cells merged back into the path, rows with missing cells are dropped. Unless the file is
+        rewritten compressed anyway, it is checked first and only rewritten if a row has to be changed. The counts are
+        written to hdfs_fs_repair.json next to it. Returns the path of the result.
+        """
+        output_dir = os.path.dirname(input_file_path)
+        output_file_path = get_bundle_file_path(input_file_path, compression)
+        repair_summary = {"lines": 0, "repaired_lines": 0, "skipped_lines": 0}
+        if compression or not self.count_clean_csv_lines(input_file_path, repair_summary):
+            repair_summary["lines"] = 0
+            temp_file_fd, temp_file_path = tempfile.mkstemp(dir=output_dir)
+            os.close(temp_file_fd)
+            shutil.copymode(input_file_path, temp_file_path)
+            with open(input_file_path, mode='r', newline='', encoding='utf-8') as infile, \
+                    open_bundle_file(temp_file_path, "w", compression, newline='') as outfile:
+                reader = csv.reader(infile)
+                writer = csv.writer(outfile, lineterminator="\n")
+                header = next(reader)
+                header_length = len(header)
+                writer.writerow(header)
                 for row in reader:
+                    repair_summary["lines"] += 1
                     if len(row) > header_length:
                         # Merge cells to match header length
                         extra_cells = ','.join(row[:len(row) - header_length + 1])
-                        corrected_row = [extra_cells] + row[len(row) - header_length + 1:]
-                        writer.writerow(corrected_row)
-                    else:
-                        writer.writerow(row)
+                        row = [extra_cells] + row[len(row) - header_length + 1:]
+                        repair_summary["repaired_lines"] += 1
+                    elif len(row) < header_length:
+                        log.debug(f"Skipping line {reader.line_num} of {input_file_path}, it has {len(row)} fields "
+                                  f"instead of {header_length}")
+                        repair_summary["skipped_lines"] += 1
+                        continue
+                    writer.writerow(row)
+            os.replace(temp_file_path, output_file_path)
+            if output_file_path != input_file_path:
+                os.remove(input_file_path)
+
+        if repair_summary["repaired_lines"] or repair_summary["skipped_lines"]:
+            log.warning(f"Repaired {repair_summary['repaired_lines']} and skipped {repair_summary['skipped_lines']} "
+                        f"lines of {input_file_path}")
+        with open(os.path.join(output_dir, "hdfs_fs_repair.json"), "w") as summary_file:
+            json.dump(repair_summary, summary_file)
+        return output_file_path
 
-            os.rename(outfile.name, input_file_path)
+    @staticmethod
+    def count_clean_csv_lines(input_file_path, repair_summary):
+        """
+        Counts the lines of the CSV into repair_summary, returns False as soon as a row does not match the header.
+        """
+        with open(input_file_path, mode='r', newline='', encoding='utf-8') as infile:
+            reader = csv.reader(infile)
+            header_length = len(next(reader))
+            for row in reader:
+                if len(row) != header_length:
+                    return False
+                repair_summary["lines"] += 1
+        return True
 
-    def fetch_client_config(self, cluster_name, hdfs_service_name):
+    def fetch_client_config(self, cluster_name, hdfs_service_name, client_config_dir):
         response = self.services_resource.get_client_config(cluster_name=cluster_name,
                                                             service_name=hdfs_service_name,
                                                             _preload_content=False)
-        client_config_dir = os.path.join("/tmp", "hdfs_report", cluster_name.replace(" ", "_"))
         create_directory(client_config_dir)
         with open(os.path.join(client_config_dir, "client_config.zip"), 'wb') as fd:
             fd.write(response.data)
@@ -0,0 +1,503 @@
+# Copyright 2022 Cloudera, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import datetime
+import getpass
+import hashlib
+import io
+import json
+import logging
+import os
+import posixpath
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+import urllib3
+from hdfs import HdfsError, InsecureClient
+from hdfs.ext.kerberos import KerberosClient
+
+from discovery_bundle_builder_utils import create_directory, run_cmd
+
+log = logging.getLogger('main')
+
+transfer_chunk_size = 1024 * 1024
+stream_buffer_size = 8 * 1024 * 1024
+shell_get_batch_size = 200
+
+# modification_time is in milliseconds since the epoch, as returned by WebHDFS
+HdfsFileStatus = namedtuple('HdfsFileStatus', ['path', 'type', 'length', 'modification_time'])
+
+
+def read_hadoop_config(client_config_dir, file_names=("core-site.xml", "hdfs-site.xml")):
+    config = {}
+    for file_name in file_names:
+        config_path = os.path.join(client_config_dir, file_name)
+        if not os.path.exists(config_path):
+            continue
+        for prop in ElementTree.parse(config_path).getroot().iter("property"):
+            config[prop.findtext("name")] = prop.findtext("value")
+    return config
+
+
+def get_webhdfs_urls(config):
+    """
+    Returns the WebHDFS URLs of the NameNodes of the default file system, all of them in case of HA.
+    """
+    scheme = "https" if config.get("dfs.http.policy") == "HTTPS_ONLY" else "http"
+    address_key = f"dfs.namenode.{scheme}-address"
+    default_fs_host = urlparse(config.get("fs.defaultFS", "")).hostname
+    namenodes = config.get(f"dfs.ha.namenodes.{default_fs_host}")
+    if namenodes:
+        addresses = [config[f"{address_key}.{default_fs_host}.{namenode.strip()}"] for namenode in namenodes.split(",")]
+    else:
+        addresses = [config.get(f"{address_key}.{default_fs_host}") or config[address_key]]
+    return [f"{scheme}://{address.replace('0.0.0.0', default_fs_host)}" for address in addresses]
+
+
+def get_truststore_ca_bundle(client_config_dir):
+    """
+    Returns a PEM file with the certificates of the truststore configured in the ssl-client.xml of the client config,
+    the one 'hdfs dfs' verifies the NameNodes against. A JKS or PKCS12 truststore is converted with keytool into the
+    client config directory. Returns None if there is no truststore or it can not be converted.
+    """
+    try:
+        config = read_hadoop_config(client_config_dir, ("ssl-client.xml",))
+    except ElementTree.ParseError as error:
+        log.warning(f"Unable to read ssl-client.xml of {client_config_dir}: {error}")
+        return None
+    location = config.get("ssl.client.truststore.location")
+    if not location or not os.path.exists(location):
+        return None
+    store_type = config.get("ssl.client.truststore.type", "jks").lower()
+    if store_type == "pem" or location.endswith(".pem"):
+        return location
+    keytool = shutil.which("keytool") or os.path.join(os.environ.get("JAVA_HOME", ""), "bin", "keytool")
+    try:
+        # The password is passed on stdin, keytool prompts for it when it is not given on the command line
+        result = subprocess.run([keytool, "-list", "-rfc", "-keystore", location, "-storetype", store_type],
+                                input=f"{config.get('ssl.client.truststore.password', '')}\n",
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    except OSError as error:
+        log.warning(f"Unable to run keytool to read the truststore {location}: {error}")
+        return None
+    certificates = re.findall(r"-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----", result.stdout, re.DOTALL)
+    if not certificates:
+        log.warning(f"No certificates could be read from the truststore {location}: {result.stderr.strip()}")
+        return None
+    ca_bundle_path = os.path.join(client_config_dir, "truststore.pem")
+    with open(ca_bundle_path, "w") as ca_bundle:
+        ca_bundle.write("\n".join(certificates) + "\n")
+    log.debug(f"Read {len(certificates)} certificates from the truststore {location} into {ca_bundle_path}")
+    return ca_bundle_path
+
+
+def create_hdfs_transfer(client_config_dir, transfer_mode="webhdfs", max_workers=8, verify=None):
+    """
+    Returns the transfer engine of transfer_mode for the cluster of the client config, falling back to the hdfs
+    command line if WebHDFS is disabled or can not be reached. verify is the CA bundle WebHDFS over HTTPS is verified
+    against, or False to skip the verification. By default the truststore of ssl-client.xml is used if there is one,
+    otherwise the system CA certificates.
+    """
+    if transfer_mode == "webhdfs":
+        if verify is None:
+            verify = get_truststore_ca_bundle(client_config_dir) or True
+        elif verify is False:
+            log.warning("TLS certificates of WebHDFS are not verified.")
+        try:
+            return WebHdfsTransfer(client_config_dir, max_workers, verify=verify)
+        except (KeyError, HdfsError, requests.RequestException) as error:
+            log.warning(f"WebHDFS is not available, falling back to the hdfs command line: {error}")
+    return HdfsShellTransfer(client_config_dir, max_workers)
+
+
+class WebHdfsTransfer:
+    """
+    Lists and downloads HDFS files through WebHDFS with a single client, whose connection pool is shared by
+    max_workers threads. Files are downloaded one by one, a failed download is retried on its own.
+    """
+
+    def __init__(self, client_config_dir, max_workers=8, retries=3, verify=True):
+        config = read_hadoop_config(client_config_dir)
+        if config.get("dfs.webhdfs.enabled", "true") != "true":
+            raise HdfsError("dfs.webhdfs.enabled is false")
+        self.max_workers = max_workers
+        self.retries = retries
+        session = requests.Session()
+        session.verify = verify
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        url = ";".join(get_webhdfs_urls(config))
+        if config.get("hadoop.security.authentication") == "kerberos":
+            log.debug("Kerberos is enabled, using the requests-kerberos python module for WebHDFS.")
+            self.client = KerberosClient(url, max_concurrency=max_workers, session=session)
+        else:
+            self.client = InsecureClient(url, user=getpass.getuser(), session=session)
+        self.client.status("/")
+        log.info(f"Transferring HDFS files through WebHDFS: {url}")
+
+    def list_status(self, path):
+        """
+        Lists a directory, returns an empty list if it does not exist.
+        """
+        try:
+            return [HdfsFileStatus(posixpath.join(path, name), status["type"], status["length"],
+                                   status["modificationTime"])
+                    for name, status in self.client.list(path, status=True)]
+        except HdfsError as error:
+            log.debug(f"Unable to list {path}: {error}")
+            return []
+
+    def walk(self, paths):
+        """
+        Returns the files below the paths, the directories of each level are listed concurrently.
+        """
+        files = []
+        directories = list(paths)
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="webhdfs_list") as executor:
+            while directories:
+                listings = list(executor.map(self.list_status, directories))
+                directories = []
+                for listing in listings:
+                    for status in listing:
+                        if status.type == "DIRECTORY":
+                            directories.append(status.path)
+                        else:
+                            files.append(status)
+        return files
+
+    def download(self, files, hdfs_parent, local_dir):
+        """
+        Downloads the files into local_dir, keeping their path relative to hdfs_parent. Returns the number of files
+        that could not be downloaded.
+        """
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="webhdfs_download") as executor:
+            results = list(executor.map(
+                lambda file: self.download_file(file, os.path.join(local_dir, posixpath.relpath(file.path, hdfs_parent))),
+                files))
+        failed = results.count(False)
+        log.info(f"Downloaded {len(files) - failed} files ({sum(file.length for file in files)} bytes) of "
+                 f"{hdfs_parent} in {time.monotonic() - started:.0f} seconds, {failed} failed.")
+        return failed
+
+    def download_file(self, file, local_path):
+        create_directory(os.path.dirname(local_path))
+        for attempt in range(self.retries + 1):
+            try:
+                with self.client.read(file.path, chunk_size=transfer_chunk_size) as reader, \
+                        open(f"{local_path}.part", "wb") as local_file:
+                    for chunk in reader:
+                        local_file.write(chunk)
+                if os.path.getsize(f"{local_path}.part") != file.length:
+                    raise IOError(f"expected {file.length} bytes, got {os.path.getsize(f'{local_path}.part')}")
+                os.replace(f"{local_path}.part", local_path)
+                os.utime(local_path, (file.modification_time / 1000, file.modification_time / 1000))
+                return True
+            except (HdfsError, IOError, requests.RequestException) as error:
+                if attempt == self.retries:
+                    log.error(f"Unable to download {file.path}: {error}")
+                    return False
+                log.warning(f"Download of {file.path} failed, retrying: {error}")
+                time.sleep(2 ** attempt)
+
+    def iter_files(self, files):
+        """
+        Yields (file, file object) for the files, to archive them without a local copy. A file object is only
+        readable until the next one is yielded. Files up to stream_buffer_size bytes are read ahead into memory by
+        max_workers threads, larger ones are streamed when their turn comes. Unreadable files are logged and skipped.
+        """
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="webhdfs_read") as executor:
+            for file in files:
+                pending.append((file, executor.submit(self.read_file, file)
+                                if file.length <= stream_buffer_size else None))
+                if len(pending) > self.max_workers:
+                    yield from self.__next_file(pending)
+            while pending:
+                yield from self.__next_file(pending)
+
+    def __next_file(self, pending):
+        file, content = pending.popleft()
+        if content is None:
+            with WebHdfsStreamReader(self.client, file, self.retries) as reader:
+                yield file, reader
+        elif content.result() is not None:
+            yield file, io.BytesIO(content.result())
+
+    def read_file(self, file):
+        for attempt in range(self.retries + 1):
+            try:
+                with self.client.read(file.path, length=file.length) as reader:
+                    content = reader.read()
+                if len(content) != file.length:
+                    raise IOError(f"expected {file.length} bytes, got {len(content)}")
+                return content
+            except (HdfsError, IOError, requests.RequestException, urllib3.exceptions.HTTPError) as error:
+                if attempt == self.retries:
+                    log.error(f"Unable to read {file.path}: {error}")
+                    return None
+                log.warning(f"Read of {file.path} failed, retrying: {error}")
+                time.sleep(2 ** attempt)
+
+
+class WebHdfsStreamReader:
+    """
+    File object streaming the first file.length bytes of an HDFS file through WebHDFS, a failed read is resumed at
+    the offset reached. read(size) always returns size bytes up to the length, as tarfile expects. If the file can
+    not be read to its length the rest is filled with zeros, so an archive member being written keeps its size.
+    """
+
+    def __init__(self, client, file, retries=3):
+        self.client = client
+        self.file = file
+        self.retries = retries
+        self.offset = 0
+        self.response = None
+        self.reader = None
+        self.failed = False
+
+    def read(self, size=-1):
+        remaining = self.file.length - self.offset
+        size = remaining if size is None or size < 0 else min(size, remaining)
+        chunks = []
+        while size > 0:
+            chunk = self.__read_chunk(size)
+            chunks.append(chunk)
+            self.offset += len(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def __read_chunk(self, size):
+        attempt = 0
+        while not self.failed:
+            try:
+                if self.response is None:
+                    self.response = self.client.read(self.file.path, offset=self.offset,
+                                                     length=self.file.length - self.offset)
+                    self.reader = self.response.__enter__()
+                chunk = self.reader.read(size)
+                if not chunk:
+                    raise IOError(f"unexpected end of file at {self.offset} of {self.file.length} bytes")
+                return chunk
+            except (HdfsError, IOError, requests.RequestException, urllib3.exceptions.HTTPError) as error:
+                self.close()
+                if attempt == self.retries:
+                    log.error(f"Unable to read {self.file.path}, the rest of the file is replaced with zeros: {error}")
+                    self.failed = True
+                    break
+                log.warning(f"Read of {self.file.path} failed at {self.offset} bytes, resuming: {error}")
+                time.sleep(2 ** attempt)
+                attempt += 1
+        return bytes(size)
+
+    def close(self):
+        if self.response is not None:
+            response, self.response, self.reader = self.response, None, None
+            try:
+                response.__exit__(None, None, None)
+            except Exception as error:
+                log.debug(f"Unable to close the WebHDFS response of {self.file.path}: {error}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class HdfsShellTransfer:
+    """
+    Lists and downloads HDFS files with the hdfs command line. Every listing is a single JVM, downloads are batched
+    into one 'hdfs dfs -get' per local directory and shell_get_batch_size files, max_workers of them at once.
+    """
+
+    def __init__(self, client_config_dir, max_workers=8):
+        self.client_config_dir = client_config_dir
+        self.max_workers = max_workers
+
+    def list_status(self, path):
+        return self.__list(path, recursive=False)
+
+    def walk(self, paths):
+        return [status for path in paths for status in self.__list(path, recursive=True) if status.type == "FILE"]
+
+    def download(self, files, hdfs_parent, local_dir):
+        tasks = self.__batch(files, lambda file: os.path.dirname(
+            os.path.join(local_dir, posixpath.relpath(file.path, hdfs_parent))))
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hdfs_get") as executor:
+            results = list(executor.map(lambda task: self.__get(*task), tasks))
+        return sum(len(batch_files) for (target_dir, batch_files), success in zip(tasks, results) if not success)
+
+    def iter_files(self, files):
+        """
+        Yields (file, file object) for the files like WebHdfsTransfer.iter_files. The hdfs command line can not
+        stream many files, the batches of download are fetched into temporary directories instead, max_workers ahead,
+        and each one is removed once its files have been yielded.
+        """
+        tasks = self.__batch(files, lambda file: posixpath.dirname(file.path))
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hdfs_get") as executor:
+            for hdfs_dir, batch_files in tasks:
+                pending.append((batch_files, executor.submit(self.__get_to_temporary_dir, batch_files)))
+                if len(pending) > self.max_workers:
+                    yield from self.__yield_batch(*pending.popleft())
+            while pending:
+                yield from self.__yield_batch(*pending.popleft())
+
+    def __get_to_temporary_dir(self, files):
+        temporary_dir = tempfile.mkdtemp(prefix="hdfs_get_")
+        self.__get(temporary_dir, files)
+        return temporary_dir
+
+    @staticmethod
+    def __yield_batch(files, temporary_dir):
+        try:
+            for file in files:
+                local_path = os.path.join(temporary_dir.result(), posixpath.basename(file.path))
+                if not os.path.exists(local_path) or os.path.getsize(local_path) != file.length:
+                    log.error(f"Unable to read {file.path}")
+                    continue
+                with open(local_path, "rb") as local_file:
+                    yield file, local_file
+        finally:
+            shutil.rmtree(temporary_dir.result(), ignore_errors=True)
+
+    @staticmethod
+    def __batch(files, key):
+        groups = {}
+        for file in files:
+            groups.setdefault(key(file), []).append(file)
+        return [(group_key, group_files[start:start + shell_get_batch_size])
+                for group_key, group_files in groups.items()
+                for start in range(0, len(group_files), shell_get_batch_size)]
+
+    def __get(self, target_dir, files):
+        create_directory(target_dir)
+        (ret, out, err) = run_cmd(['hdfs', '--config', self.client_config_dir, 'dfs', '-get', '-f'] +
+                                  [file.path for file in files] + [target_dir])
+        for file in files:
+            local_path = os.path.join(target_dir, posixpath.basename(file.path))
+            if os.path.exists(local_path):
+                os.utime(local_path, (file.modification_time / 1000, file.modification_time / 1000))
+        return ret == 0
+
+    def __list(self, path, recursive):
+        (ret, out, err) = run_cmd(['hdfs', '--config', self.client_config_dir, 'dfs', '-ls'] +
+                                  (['-R'] if recursive else []) + [path], capture_output=True)
+        if ret != 0:
+            return []
+        statuses = []
+        for line in out.splitlines():
+            fields = line.split(None, 7)
+            if len(fields) != 8 or fields[0][0] not in "-d":
+                continue
+            modification_time = datetime.datetime.strptime(f"{fields[5]} {fields[6]}", "%Y-%m-%d %H:%M")
+            statuses.append(HdfsFileStatus(fields[7], "DIRECTORY" if fields[0][0] == "d" else "FILE",
+                                           int(fields[4]), int(modification_time.timestamp() * 1000)))
+        return statuses
+
+
+class TransferManifest:
+    """
+    HDFS path, size, modification time and sha256 of every workload file downloaded into the bundle, stored in
+    workload/workload_manifest.json. Files unchanged in size and modification time since the previous bundle are
+    hard linked, or copied, from there instead of being downloaded again.
+    """
+
+    file_name = os.path.join("workload", "workload_manifest.json")
+
+    def __init__(self, output_dir, previous_bundle_dir=None):
+        self.output_dir = output_dir
+        self.previous_bundle_dir = previous_bundle_dir
+        self.previous_entries = self.__load(previous_bundle_dir) if previous_bundle_dir else {}
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def sync(self, hdfs_transfer, files, hdfs_parent, local_dir):
+        """
+        Brings the files into local_dir like hdfs_transfer.download, only downloading the new and changed ones.
+        """
+        downloads = []
+        for file in files:
+            local_path = os.path.join(local_dir, posixpath.relpath(file.path, hdfs_parent))
+            if not self.__reuse_previous(file, local_path):
+                downloads.append((file, local_path))
+        hdfs_transfer.download([file for file, local_path in downloads], hdfs_parent, local_dir)
+        for file, local_path in downloads:
+            if os.path.exists(local_path) and os.path.getsize(local_path) == file.length:
+                self.__add(local_path, file, self.__sha256(local_path))
+        if self.previous_bundle_dir:
+            log.info(f"{len(files) - len(downloads)} files of {hdfs_parent} reused from the previous bundle, "
+                     f"{len(downloads)} new or changed.")
+
+    def save(self):
+        manifest_path = os.path.join(self.output_dir, self.file_name)
+        create_directory(os.path.dirname(manifest_path))
+        with self.lock, open(manifest_path, "w") as manifest_file:
+            json.dump(self.entries, manifest_file, indent=1, sort_keys=True)
+        log.info(f"Workload manifest of {len(self.entries)} files stored in: {manifest_path}")
+
+    def __reuse_previous(self, file, local_path):
+        key = os.path.relpath(local_path, self.output_dir)
+        previous_entry = self.previous_entries.get(key)
+        if not previous_entry or (previous_entry["path"], previous_entry["length"], previous_entry["modification_time"]) \
+                != (file.path, file.length, file.modification_time):
+            return False
+        previous_path = os.path.join(self.previous_bundle_dir, key)
+        if not os.path.exists(previous_path) or os.path.getsize(previous_path) != file.length:
+            return False
+        create_directory(os.path.dirname(local_path))
+        if os.path.exists(local_path) and os.path.samefile(previous_path, local_path):
+            self.__add(local_path, file, previous_entry["sha256"])
+            return True
+        try:
+            os.link(previous_path, local_path)
+        except OSError:
+            shutil.copy2(previous_path, local_path)
+        self.__add(local_path, file, previous_entry["sha256"])
+        return True
+
+    def __add(self, local_path, file, sha256):
+        with self.lock:
+            self.entries[os.path.relpath(local_path, self.output_dir)] = {
+                "path": file.path, "length": file.length, "modification_time": file.modification_time,
+                "sha256": sha256}
+
+    @staticmethod
+    def __sha256(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as local_file:
+            for chunk in iter(lambda: local_file.read(transfer_chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def __load(previous_bundle_dir):
+        manifest_path = os.path.join(previous_bundle_dir, TransferManifest.file_name)
+        if not os.path.exists(manifest_path):
+            log.warning(f"No workload manifest in {previous_bundle_dir}, all workload files are downloaded.")
+            return {}
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
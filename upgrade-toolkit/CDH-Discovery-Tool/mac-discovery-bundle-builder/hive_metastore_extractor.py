@@ -20,6 +20,9 @@ from pathlib import Path
 import cm_client
 import jaydebeapi
 
+from cm_topology_cache import CmTopologyCache
+from discovery_bundle_builder_utils import get_bundle_file_path, jdbc_connect_lock, open_bundle_file
+
 root_path = os.path.dirname(os.path.realpath(__file__))
 log = logging.getLogger('main')
 
@@ -54,25 +57,27 @@ def create_directory(dir_path):
     path.mkdir(parents=True, exist_ok=True)
 
 
-def write_csv(columns, rows, output):
-    csv_file = open(output, mode='w')
-    writer = csv.writer(csv_file, delimiter=',', lineterminator="\n")
-    writer.writerow(columns)
-    for row in rows:
-        writer.writerow(row)
+def write_csv(columns, rows, output, compression=None):
+    output = get_bundle_file_path(output, compression)
+    with open_bundle_file(output, "w", compression, newline='') as csv_file:
+        writer = csv.writer(csv_file, delimiter=',', lineterminator="\n")
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
     log.debug(f"CSV write finished, results at: {output}")
 
 
 class HiveMetastoreExtractor:
-    def __init__(self, output_dir, db_driver_path):
+    def __init__(self, output_dir, db_driver_path, topology=None, compression=None):
         self.output_dir = output_dir
+        self.compression = compression
         self.services_resource = cm_client.ServicesResourceApi()
-        self.cloudera_manager_resource = cm_client.ClouderaManagerResourceApi()
+        self.topology = topology or CmTopologyCache()
         self.db_driver_path = db_driver_path
 
     def extract_hive_metastore(self):
         log.info("Started Hive metastore extraction")
-        clusters = self.cloudera_manager_resource.get_deployment2().clusters
+        clusters = self.topology.get_clusters()
         for cluster in clusters:
             for service in cluster.services:
                 hive_metastore_role = next(filter(lambda rcg: rcg.type == "HIVEMETASTORE", service.roles), None)
@@ -104,17 +109,18 @@ class HiveMetastoreExtractor:
             log.error(f"Unsupported database type: {db_type}, exiting thread.")
             exit(-1)
         log.debug(f"Connecting to {db_name} database on {db_host}")
-        conn = jaydebeapi.connect(
-            db_constant['driver_class'],
-            db_constant['jdbc_format'].format(db_type=db_type, db_host=db_host, db_port=db_port, db_name=db_name),
-            [f'{db_user}', f'{db_password}'],
-            self.db_driver_path)
+        with jdbc_connect_lock:
+            conn = jaydebeapi.connect(
+                db_constant['driver_class'],
+                db_constant['jdbc_format'].format(db_type=db_type, db_host=db_host, db_port=db_port, db_name=db_name),
+                [f'{db_user}', f'{db_password}'],
+                self.db_driver_path)
         curs = conn.cursor()
         log.debug(f"Executing query: {db_constant['query']}")
         curs.execute(db_constant['query'])
         columns = [column_description[0] for column_description in curs.description]
         rows = curs.fetchall()
-        write_csv(columns, rows, os.path.join(output_dir, f"hive_ms.csv"))
+        write_csv(columns, rows, os.path.join(output_dir, f"hive_ms.csv"), self.compression)
         conn.close()
         log.debug("Hive Metastore collection finished.")
 
@@ -0,0 +1,85 @@
+# Copyright 2022 Cloudera, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import time
+from threading import Event, Thread
+
+log = logging.getLogger('main')
+
+
+class Task:
+    def __init__(self, name, target, args, depends_on):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.depends_on = depends_on
+        self.finished = Event()
+        self.succeeded = False
+
+
+class TaskGraph:
+    """
+    Runs the modules of the discovery bundle on their own threads, named after the tasks. Every task starts as soon as
+    the tasks it depends on have finished, so the run takes as long as its longest chain of dependent tasks. Tasks
+    depending on a failed task are skipped. Dependencies have to be added before their dependents, which keeps the
+    graph free of cycles.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self.started = None
+
+    def add(self, name, target, args=(), depends_on=()):
+        unknown = [dependency for dependency in depends_on if dependency not in self.tasks]
+        if unknown:
+            raise KeyError(f"Task {name} depends on unknown tasks: {', '.join(unknown)}")
+        self.tasks[name] = Task(name, target, args, list(depends_on))
+
+    def __contains__(self, name):
+        return name in self.tasks
+
+    def run(self):
+        """
+        Runs all the tasks and waits for them, returns the names of the tasks that failed or were skipped.
+        """
+        self.started = time.monotonic()
+        threads = [Thread(target=self.__run_task, args=(task,), name=task.name) for task in self.tasks.values()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        failed = [task.name for task in self.tasks.values() if not task.succeeded]
+        log.info(f"Finished {len(self.tasks)} tasks in {time.monotonic() - self.started:.0f} seconds"
+                 + (f", failed or skipped: {', '.join(failed)}" if failed else ""))
+        return failed
+
+    def __run_task(self, task):
+        try:
+            for dependency in task.depends_on:
+                self.tasks[dependency].finished.wait()
+            failed_dependencies = [dependency for dependency in task.depends_on
+                                   if not self.tasks[dependency].succeeded]
+            if failed_dependencies:
+                log.error(f"Skipping {task.name}, it depends on failed tasks: {', '.join(failed_dependencies)}")
+                return
+            task_started = time.monotonic()
+            log.info(f"Started {task.name} {task_started - self.started:.0f} seconds into the run")
+            task.target(*task.args)
+            task.succeeded = True
+            log.info(f"Finished {task.name} in {time.monotonic() - task_started:.0f} seconds")
+        except Exception:
+            log.exception(f"{task.name} failed")
+        finally:
+            task.finished.set()
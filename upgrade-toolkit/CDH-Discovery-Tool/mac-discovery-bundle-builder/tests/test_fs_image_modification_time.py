@@ -0,0 +1,174 @@
+# Copyright 2022 Cloudera, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Checks that the native FSImage reader and the conversion of the 'hdfs oiv' CSV store the same ModificationTime, UTC
+epoch millis, for the same inodes whatever the local timezone is.
+
+    python3 -m unittest discover -s tests
+"""
+
+import csv
+import datetime
+import os
+import struct
+import sys
+import tempfile
+import time
+import unittest
+
+import pyarrow.parquet as pq
+import tzlocal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fs_image_reader import FsImageReader, root_inode_id
+from hdfs_fs_image_extractor import HdfsFsImageExtractor
+
+block_size = 134217728
+oiv_header = ["Path", "Replication", "ModificationTime", "AccessTime", "PreferredBlockSize", "BlocksCount",
+              "FileSize", "NSQUOTA", "DSQUOTA", "Permission", "UserName", "GroupName"]
+# (name, modification time in UTC), oiv only prints minutes, so the times are on minute boundaries
+files = [("winter", datetime.datetime(2026, 1, 15, 12, 34)),
+         ("summer", datetime.datetime(2026, 7, 4, 3, 0)),
+         ("new_year", datetime.datetime(2025, 12, 31, 23, 59))]
+directory_modification_time = datetime.datetime(2026, 3, 1, 8, 15)
+
+
+def varint(value):
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if not value:
+            encoded.append(byte)
+            return bytes(encoded)
+        encoded.append(byte | 0x80)
+
+
+def varint_field(field, value):
+    return varint(field << 3) + varint(value)
+
+
+def bytes_field(field, value):
+    return varint(field << 3 | 2) + varint(len(value)) + value
+
+
+def fixed64_field(field):
+    return varint(field << 3 | 1) + b"\0" * 8
+
+
+def delimited(message):
+    return varint(len(message)) + message
+
+
+def epoch_millis(utc_time):
+    return int(utc_time.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+def write_fs_image(image_path):
+    """
+    Writes an uncompressed fsimage holding the root directory, /data and the files below it.
+    """
+    directory_id = root_inode_id + 1
+    inodes = [delimited(varint_field(1, 2) + varint_field(2, root_inode_id) + bytes_field(3, b"") +
+                        bytes_field(5, varint_field(1, epoch_millis(directory_modification_time)) +
+                                    fixed64_field(4))),
+              delimited(varint_field(1, 2) + varint_field(2, directory_id) + bytes_field(3, b"data") +
+                        bytes_field(5, varint_field(1, epoch_millis(directory_modification_time)) +
+                                    fixed64_field(4)))]
+    file_ids = []
+    for index, (name, modification_time) in enumerate(files):
+        file_ids.append(directory_id + 1 + index)
+        block = bytes_field(6, varint_field(1, index) + varint_field(2, 1) + varint_field(3, 1024))
+        inodes.append(delimited(varint_field(1, 1) + varint_field(2, file_ids[-1]) + bytes_field(3, name.encode()) +
+                                bytes_field(4, varint_field(1, 3) + varint_field(2, epoch_millis(modification_time)) +
+                                            varint_field(3, 0) + varint_field(4, block_size) + fixed64_field(5) +
+                                            block)))
+    inode_section = delimited(varint_field(1, file_ids[-1]) + varint_field(2, len(inodes))) + b"".join(inodes)
+    directory_section = delimited(varint_field(1, root_inode_id) + bytes_field(2, varint(directory_id))) + \
+        delimited(varint_field(1, directory_id) + bytes_field(2, b"".join(map(varint, file_ids))))
+    image = b"HDFSIMG1"
+    sections = []
+    for name, content in [("INODE", inode_section), ("INODE_DIR", directory_section)]:
+        sections.append(bytes_field(4, bytes_field(1, name.encode()) + varint_field(2, len(content)) +
+                                    varint_field(3, len(image))))
+        image += content
+    summary = delimited(varint_field(1, 1) + varint_field(2, 65) + b"".join(sections))
+    with open(image_path, "wb") as image_file:
+        image_file.write(image + summary + struct.pack(">i", len(summary)))
+
+
+def write_oiv_csv(csv_path):
+    """
+    Writes the CSV 'hdfs oiv -p Delimited' prints for the same image, times formatted in the local timezone.
+    """
+    def local_time(utc_time):
+        return datetime.datetime.fromtimestamp(epoch_millis(utc_time) / 1000).strftime("%Y-%m-%d %H:%M")
+
+    with open(csv_path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file, lineterminator="\n")
+        writer.writerow(oiv_header)
+        for path in ["/", "/data"]:
+            writer.writerow([path, 0, local_time(directory_modification_time), "1970-01-01 00:00", 0, 0, 0, -1, -1,
+                             "drwxr-xr-x", "hdfs", "supergroup"])
+        for name, modification_time in files:
+            writer.writerow([f"/data/{name}", 3, local_time(modification_time), "1970-01-01 00:00", block_size, 1,
+                             1024, 0, 0, "-rw-r--r--", "hdfs", "supergroup"])
+
+
+def read_modification_times(parquet_path):
+    table = pq.read_table(parquet_path, columns=["ParentPath", "Name", "ModificationTime"]).to_pandas()
+    return {(str(parent_path), name): modification_time
+            for parent_path, name, modification_time in table.itertuples(index=False)}
+
+
+class FsImageModificationTimeTest(unittest.TestCase):
+    def setUp(self):
+        self.timezone = os.environ.get("TZ")
+        self.work_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        if self.timezone is None:
+            os.environ.pop("TZ", None)
+        else:
+            os.environ["TZ"] = self.timezone
+        time.tzset()
+        tzlocal.reload_localzone()
+        self.work_dir.cleanup()
+
+    def test_native_reader_and_oiv_conversion_store_the_same_times(self):
+        image_path = os.path.join(self.work_dir.name, "fsimage")
+        write_fs_image(image_path)
+        native_path = os.path.join(self.work_dir.name, "native.parquet")
+        FsImageReader(image_path, workers=1).write_parquet(native_path)
+        native_times = read_modification_times(native_path)
+        for name, modification_time in files:
+            self.assertEqual(epoch_millis(modification_time), native_times[("/data", name)])
+
+        extractor = HdfsFsImageExtractor(self.work_dir.name, topology=object())
+        for timezone in ["UTC", "America/New_York", "Asia/Tokyo", "Australia/Sydney"]:
+            with self.subTest(timezone=timezone):
+                os.environ["TZ"] = timezone
+                time.tzset()
+                tzlocal.reload_localzone()
+                csv_path = os.path.join(self.work_dir.name, f"oiv-{timezone.replace('/', '_')}.csv")
+                oiv_path = os.path.join(self.work_dir.name, f"oiv-{timezone.replace('/', '_')}.parquet")
+                write_oiv_csv(csv_path)
+                extractor.convert_to_parquet(csv_path, oiv_path)
+                self.assertEqual(native_times, read_modification_times(oiv_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,37 +13,58 @@
 # limitations under the License.
 
 import calendar
+import collections
 import datetime
+import io
 import logging.config
 import os
 import os.path
+import posixpath
 import re
 import shutil
 import tarfile
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from threading import Thread
 
 import cm_client
 
-from discovery_bundle_builder_utils import create_directory, _make_tarfile, check_if_dir_exists, copy_to_local, \
+from cm_topology_cache import CmTopologyCache
+from discovery_bundle_builder_utils import create_directory, _make_tarfile, archive_suffixes, open_archive, \
     retrieve_hdfs_username_group
+from hdfs_transfer import TransferManifest, create_hdfs_transfer
 
 log = logging.getLogger('main')
 
+profile_read_ahead_size = 8 * 1024 * 1024
+
 
 class YarnWorkloadExtractor:
-    def __init__(self, output_dir, time_range_in_days):
+    def __init__(self, output_dir, time_range_in_days, topology=None, hdfs_transfer_mode="webhdfs",
+                 hdfs_transfer_workers=8, previous_bundle_dir=None, archive_codec="gzip", archive_threads=None,
+                 archive_mode="staged", webhdfs_verify=None):
         self.output_dir = output_dir
+        self.archive_codec = archive_codec
+        self.archive_threads = archive_threads
+        self.archive_mode = archive_mode
+        self.manifest = TransferManifest(output_dir, previous_bundle_dir if archive_mode == "staged" else None)
+        self.hdfs_transfer_mode = hdfs_transfer_mode
+        self.hdfs_transfer_workers = hdfs_transfer_workers
+        self.webhdfs_verify = webhdfs_verify
+        self.topology = topology or CmTopologyCache()
         self.time_range_in_days = time_range_in_days
         self.services_resource = cm_client.ServicesResourceApi()
         self.role_config_groups_resource = cm_client.RoleConfigGroupsResourceApi()
-        self.workload_dates = self.__get_workload_dates()
+        self.end_date = datetime.date.today()
+        self.start_date = self.end_date - datetime.timedelta(days=time_range_in_days - 1)
 
     def collect_workloads(self, workloads_to_collect):
-        cm_deployment = cm_client.ClouderaManagerResourceApi().get_deployment2()
-        for cluster in cm_deployment.clusters:
+        for cluster in self.topology.get_clusters():
             self.collect_workloads_from_cluster(cluster, workloads_to_collect)
+        # Streamed archives are read from HDFS directly, there are no local files to list in the manifest
+        if self.archive_mode == "staged":
+            self.manifest.save()
 
     def collect_workloads_from_cluster(self, cluster, workloads_to_collect):
         cluster_name = cluster.display_name
@@ -56,18 +77,20 @@ class YarnWorkloadExtractor:
         client_config_path = self.fetch_client_config(cluster_name, hdfs_service.name)
         retrieve_hdfs_username_group(client_config_path)
         log.debug(f"Extracted client config path: {client_config_path}")
+        hdfs_transfer = create_hdfs_transfer(client_config_path, self.hdfs_transfer_mode, self.hdfs_transfer_workers,
+                                             self.webhdfs_verify)
         workload_extraction_threads = []
         if "spark" in workloads_to_collect:
             workload_extraction_threads.append(
-                Thread(target=self.collect_spark_history, args=(cluster, client_config_path,),
+                Thread(target=self.collect_spark_history, args=(cluster, hdfs_transfer,),
                        name=f"{cluster_name}-spark_history_thread"))
         if "mapreduce" in workloads_to_collect:
             workload_extraction_threads.append(
-                Thread(target=self.collect_mapreduce_history, args=(cluster, client_config_path,),
+                Thread(target=self.collect_mapreduce_history, args=(cluster, hdfs_transfer,),
                        name=f"{cluster_name}-mapreduce_history_thread"))
         if "tez" in workloads_to_collect:
             workload_extraction_threads.append(
-                Thread(target=self.collect_tez_history, args=(cluster, client_config_path,),
+                Thread(target=self.collect_tez_history, args=(cluster, hdfs_transfer,),
                        name=f"{cluster_name}-tez_history_thread"))
         for thread in workload_extraction_threads:
             thread.start()
@@ -110,7 +133,7 @@ class YarnWorkloadExtractor:
         except:
             log.error(f"Unable to copy file from source: {ssl_config_path}")
 
-    def collect_spark_history(self, cluster, client_config_path):
+    def collect_spark_history(self, cluster, hdfs_transfer):
         spark_services = list(filter(lambda service: "SPARK" in service.type, cluster.services))
         if not spark_services:
             log.debug(f"SPARK is not deployed on cluster service deployed on cluster: {cluster.display_name}")
@@ -121,15 +144,22 @@ class YarnWorkloadExtractor:
             spark_service_configs = self.services_resource.read_service_config(cluster.display_name, spark_service.name,
                                                                                view="FULL").items
             spark_log_history_dir = self.__get_config_value(spark_service_configs, "spark_history_log_dir")
-            check_if_dir_exists(client_config_path, spark_log_history_dir)
+            if not spark_log_history_dir:
+                log.warning(f"No event log directory is configured for {spark_service.name} on "
+                            f"{cluster.display_name}, skipping its Spark history.")
+                continue
             spark_output_dir = os.path.join(self.output_dir, "workload", cluster.display_name.replace(" ", "_"), "service",
                                             spark_service.name)
-            create_directory(spark_output_dir)
-            copy_to_local(spark_log_history_dir, spark_output_dir, client_config_path)
-            target_file = os.path.join(spark_output_dir, "SPARK_APP_HISTORY.tar.gz")
-            _make_tarfile(target_file, spark_output_dir)
+            spark_log_history_dir = spark_log_history_dir.rstrip("/")
+            # Event logs are not partitioned by date, the ones last modified before the time range are skipped
+            start_time_millis = datetime.datetime.combine(self.start_date, datetime.time()).timestamp() * 1000
+            spark_event_logs = [status for status in hdfs_transfer.walk([spark_log_history_dir])
+                                if status.modification_time >= start_time_millis]
+            self.archive_workload_files(hdfs_transfer,
+                                        [(spark_event_logs, posixpath.dirname(spark_log_history_dir), "")],
+                                        spark_output_dir, "SPARK_APP_HISTORY")
 
-    def collect_tez_history(self, cluster, client_config_path):
+    def collect_tez_history(self, cluster, hdfs_transfer):
         tez_service = self.__get_service_by_service_type(cluster, "TEZ")
         hive_on_tez = self.__get_service_by_service_type(cluster, "HIVE_ON_TEZ")
         if not tez_service or not hive_on_tez:
@@ -142,78 +172,116 @@ class YarnWorkloadExtractor:
         hive_on_tez_log_history_dir = self.__get_config_value(hive_on_tez_service_configs,
                                                               "hive_hook_proto_base_directory")
 
+        if not tez_log_history_dir or not hive_on_tez_log_history_dir:
+            log.warning(f"No Tez or Hive on Tez history directory is configured on {cluster.display_name}, "
+                        f"skipping the Tez history.")
+            return
         tez_output_dir = os.path.join(self.output_dir, "workload", cluster.display_name.replace(" ", "_"), "service",
                                       tez_service.name)
 
-        self.collect_hive_on_tez_files(tez_output_dir, hive_on_tez_log_history_dir, client_config_path)
-        self.collect_tez_files(tez_output_dir, tez_log_history_dir, client_config_path)
+        self.collect_hive_on_tez_files(tez_output_dir, hive_on_tez_log_history_dir, hdfs_transfer)
+        self.collect_tez_files(tez_output_dir, tez_log_history_dir, hdfs_transfer)
 
-    def collect_tez_files(self, tez_output_dir, tez_location, client_config):
+    def collect_tez_files(self, tez_output_dir, tez_location, hdfs_transfer):
         app_data = "app_data"
         dag_data = "dag_data"
         dag_meta = "dag_meta"
         tez_protobuf = "tez_protobuf_app_files"
-        create_directory(f"{tez_output_dir}/{tez_protobuf}/sys.db/{app_data}")
-        create_directory(f"{tez_output_dir}/{tez_protobuf}/sys.db/{dag_data}")
-        create_directory(f"{tez_output_dir}/{tez_protobuf}/sys.db/{dag_meta}")
-        for directory_date in self.workload_dates:
-            if check_if_dir_exists(client_config,
-                                   os.path.join(tez_location, app_data,
-                                                f"date={directory_date['year']}-{directory_date['month']}-{directory_date['day']}")):
-                copy_to_local(
-                    os.path.join(tez_location, app_data,
-                                 f"date={directory_date['year']}-{directory_date['month']}-{directory_date['day']}"),
-                    f"{tez_output_dir}/{tez_protobuf}/sys.db/{app_data}",
-                    client_config)
-            if check_if_dir_exists(client_config,
-                                   os.path.join(tez_location, dag_data,
-                                                f"date={directory_date['year']}-{directory_date['month']}-{directory_date['day']}")):
-                copy_to_local(
-                    os.path.join(tez_location, dag_data,
-                                 f"date={directory_date['year']}-{directory_date['month']}-{directory_date['day']}"),
-                    f"{tez_output_dir}/{tez_protobuf}/sys.db/{dag_data}",
-                    client_config)
-            if check_if_dir_exists(client_config,
-                                   os.path.join(tez_location, dag_meta,
-                                                f"date={directory_date['year']}-{directory_date['month']}-{directory_date['day']}")):
-                copy_to_local(
-                    os.path.join(tez_location, dag_meta,
-                                 f"date={directory_date['year']}-{directory_date['month']}-{directory_date['day']}"),
-                    f"{tez_output_dir}/{tez_protobuf}/sys.db/{dag_meta}",
-                    client_config)
-        target_file = os.path.join(f"{tez_output_dir}/{tez_protobuf}", "TEZ_PROTOBUF_APPLICATIONS.tar.gz")
-        _make_tarfile(target_file, f"{tez_output_dir}/{tez_protobuf}")
-
-    def collect_hive_on_tez_files(self, tez_output_dir, hive_on_tez_location, client_config):
+        sources = [(self.list_date_files(hdfs_transfer, posixpath.join(tez_location, data_dir), "date=%Y-%m-%d"),
+                    posixpath.join(tez_location, data_dir), f"sys.db/{data_dir}")
+                   for data_dir in (app_data, dag_data, dag_meta)]
+        self.archive_workload_files(hdfs_transfer, sources, f"{tez_output_dir}/{tez_protobuf}",
+                                    "TEZ_PROTOBUF_APPLICATIONS")
+
+    def collect_hive_on_tez_files(self, tez_output_dir, hive_on_tez_location, hdfs_transfer):
         hive_on_tez_protobuf = "hive_on_tez_protoquery_databuf_app_files"
-        create_directory(f"{tez_output_dir}/{hive_on_tez_protobuf}/query_data")
-        for directory_date in self.workload_dates:
-            if check_if_dir_exists(client_config,
-                                   os.path.join(hive_on_tez_location,
-                                                f"date={directory_date['year']}-{directory_date['month']}-{directory_date['day']}")):
-                copy_to_local(
-                    os.path.join(hive_on_tez_location,
-                                 f"date={directory_date['year']}-{directory_date['month']}-{directory_date['day']}"),
-                    f"{tez_output_dir}/{hive_on_tez_protobuf}/query_data",
-                    client_config)
-        target_file = os.path.join(f"{tez_output_dir}/{hive_on_tez_protobuf}", "HIVE_PROTOBUF_APPLICATIONS.tar.gz")
-        _make_tarfile(target_file, f"{tez_output_dir}/{hive_on_tez_protobuf}")
-
-    def collect_mapreduce_history(self, cluster, client_config_path):
+        query_data = self.list_date_files(hdfs_transfer, hive_on_tez_location, "date=%Y-%m-%d")
+        self.archive_workload_files(hdfs_transfer, [(query_data, hive_on_tez_location, "query_data")],
+                                    f"{tez_output_dir}/{hive_on_tez_protobuf}", "HIVE_PROTOBUF_APPLICATIONS")
+
+    def archive_workload_files(self, hdfs_transfer, sources, output_dir, archive_name):
+        """
+        Archives the HDFS files of sources, (files, hdfs_parent, relative_dir) tuples, into archive_name in output_dir.
+        Every file keeps its path relative to hdfs_parent below relative_dir. In staged mode the files are downloaded
+        into output_dir and archived from there, in streamed mode they are read from HDFS into the archive directly.
+        """
+        target_file = os.path.join(output_dir, f"{archive_name}{archive_suffixes[self.archive_codec]}")
+        create_directory(output_dir)
+        if self.archive_mode == "staged":
+            for files, hdfs_parent, relative_dir in sources:
+                local_dir = os.path.join(output_dir, relative_dir)
+                create_directory(local_dir)
+                self.manifest.sync(hdfs_transfer, files, hdfs_parent, local_dir)
+            _make_tarfile(target_file, output_dir, codec=self.archive_codec, threads=self.archive_threads)
+            return
+        log.info(f"Streaming workload files from HDFS into {target_file}")
+        archived_files = 0
+        archived_bytes = 0
+        with open_archive(target_file, self.archive_codec, self.archive_threads) as tar:
+            for files, hdfs_parent, relative_dir in sources:
+                for file, file_object in hdfs_transfer.iter_files(files):
+                    member = tarfile.TarInfo(posixpath.join(relative_dir, posixpath.relpath(file.path, hdfs_parent)))
+                    member.size = file.length
+                    member.mtime = file.modification_time // 1000
+                    member.mode = 0o644
+                    tar.addfile(member, file_object)
+                    archived_files += 1
+                    archived_bytes += file.length
+        log.info(f"Tarball created at: {target_file}, {archived_files} files ({archived_bytes} bytes) of "
+                 f"{sum(len(files) for files, hdfs_parent, relative_dir in sources)} archived.")
+
+    def list_date_files(self, hdfs_transfer, hdfs_root, date_format):
+        """
+        Returns the files of the date partitioned directories below hdfs_root that fall into the collected time range.
+        """
+        directories = self.list_date_directories(hdfs_transfer, hdfs_root, date_format)
+        log.debug(f"Directories to collect from {hdfs_root}: {directories}")
+        return hdfs_transfer.walk(directories)
+
+    def list_date_directories(self, hdfs_transfer, hdfs_root, date_format):
+        """
+        Returns the directories below hdfs_root whose path relative to it, parsed with date_format, is a date of the
+        collected time range. date_format has one directory level per '/', every level is listed once and years or
+        months outside of the time range are not descended into.
+        """
+        levels = date_format.split("/")
+        directories = [hdfs_root]
+        for depth in range(1, len(levels) + 1):
+            level_format = "/".join(levels[:depth])
+            directories = [status.path for directory in directories for status in hdfs_transfer.list_status(directory)
+                           if status.type == "DIRECTORY"
+                           and self.is_in_time_range(posixpath.relpath(status.path, hdfs_root), level_format)]
+        return directories
+
+    def is_in_time_range(self, name, date_format):
+        """
+        Tells whether the period named by name overlaps the collected time range. The period is a day, or a month or
+        year if date_format has no day or month.
+        """
+        try:
+            period_start = datetime.datetime.strptime(name, date_format).date()
+        except ValueError:
+            return False
+        if "%d" in date_format:
+            period_end = period_start
+        elif "%m" in date_format:
+            period_end = period_start.replace(day=calendar.monthrange(period_start.year, period_start.month)[1])
+        else:
+            period_end = period_start.replace(month=12, day=31)
+        return period_start <= self.end_date and period_end >= self.start_date
+
+    def collect_mapreduce_history(self, cluster, hdfs_transfer):
         mapreduce_logs_dir = self.fetch_mapreduce_history_dir_config_value(cluster)
+        if not mapreduce_logs_dir:
+            log.warning(f"No MapReduce job history directory found on {cluster.display_name}, "
+                        f"skipping the MapReduce history.")
+            return
         mapreduce_output_dir = os.path.join(self.output_dir, "workload", cluster.display_name.replace(" ", "_"),
                                             "service",
                                             "MAPREDUCE")
-        for directory_date in self.workload_dates:
-            create_directory(f"{mapreduce_output_dir}/done/{directory_date['year']}/{directory_date['month']}")
-            if check_if_dir_exists(client_config_path,
-                                   f"{mapreduce_logs_dir}/{directory_date['year']}/{directory_date['month']}/{directory_date['day']}"):
-                copy_to_local(
-                    f"{mapreduce_logs_dir}/{directory_date['year']}/{directory_date['month']}/{directory_date['day']}",
-                    f"{mapreduce_output_dir}/done/{directory_date['year']}/{directory_date['month']}",
-                    client_config_path)
-        target_file = os.path.join(mapreduce_output_dir, "MR_JOB_HISTORY.tar.gz")
-        _make_tarfile(target_file, mapreduce_output_dir)
+        job_histories = self.list_date_files(hdfs_transfer, mapreduce_logs_dir, "%Y/%m/%d")
+        self.archive_workload_files(hdfs_transfer, [(job_histories, mapreduce_logs_dir, "done")],
+                                    mapreduce_output_dir, "MR_JOB_HISTORY")
 
     def fetch_mapreduce_history_dir_config_value(self, cluster):
         yarn_service = self.__get_service_by_service_type(cluster, "YARN")
@@ -239,44 +307,18 @@ class YarnWorkloadExtractor:
         job_history_role_config_group = next(
             filter(lambda role_config_group: "JOBHISTORY" == role_config_group.role_type, role_config_groups.items),
             None)
+        if not job_history_role_config_group:
+            return
         job_history_configs = self.role_config_groups_resource.read_config(cluster_name=cluster.display_name,
                                                                            service_name=yarn_service.name,
                                                                            role_config_group_name=job_history_role_config_group.name,
                                                                            view="FULL").items
         yarn_app_mapreduce_am_staging_dir = self.__get_config_value(job_history_configs,
                                                                     "yarn_app_mapreduce_am_staging_dir")
+        if not yarn_app_mapreduce_am_staging_dir:
+            return
         return os.path.join(yarn_app_mapreduce_am_staging_dir, "history", "done")
 
-    def __get_workload_dates(self):
-        directory_dates = []
-        start_date = datetime.date.today()
-        end_date = start_date - datetime.timedelta(days=self.time_range_in_days - 1)
-        log.debug(f"Staring from: {start_date}, latest mapreduce history dir is created at : {end_date}")
-        range_pointer = self.time_range_in_days
-        date_pointer = start_date
-        while range_pointer > 0:
-            days_in_month = calendar.monthrange(date_pointer.year, date_pointer.month)[1]
-            if date_pointer.year == date_pointer.year and date_pointer.month == start_date.month and date_pointer.day <= range_pointer:
-                month = str(date_pointer.month) if date_pointer.month >= 10 else f"0{date_pointer.month}"
-                directory_dates.append({"year": date_pointer.year, "month": month, "day": "*"})
-                date_pointer = date_pointer - datetime.timedelta(days=start_date.day)
-                range_pointer = range_pointer - start_date.day
-            elif days_in_month < range_pointer:
-                month = str(date_pointer.month) if date_pointer.month >= 10 else f"0{date_pointer.month}"
-                directory_dates.append({"year": date_pointer.year, "month": month, "day": "*"})
-                date_pointer = date_pointer - datetime.timedelta(days=days_in_month)
-                range_pointer = range_pointer - days_in_month
-            else:
-                for i in range(0, range_pointer):
-                    delta = datetime.timedelta(days=i)
-                    calculated_date = date_pointer - delta
-                    month = str(calculated_date.month) if calculated_date.month >= 10 else f"0{calculated_date.month}"
-                    day = str(calculated_date.day) if calculated_date.day >= 10 else f"0{calculated_date.day}"
-                    directory_dates.append({"year": date_pointer.year, "month": month, "day": day})
-                range_pointer = 0
-        log.debug(f"Directories to download created at: {directory_dates}")
-        return directory_dates
-
     def __get_service_by_service_type(self, cluster, service_type):
         fetched_service = next(filter(lambda service: service_type == service.type, cluster.services), None)
         if not fetched_service:
@@ -296,14 +338,16 @@ class YarnWorkloadExtractor:
 
 
 class ImpalaProfilesExtractor:
-    def __init__(self, output_dir):
+    def __init__(self, output_dir, topology=None, archive_codec="gzip", archive_threads=None, workers=None):
         self.output_dir = output_dir
-        self.cloudera_manager_resource = cm_client.ClouderaManagerResourceApi()
+        self.topology = topology or CmTopologyCache()
+        self.archive_codec = archive_codec
+        self.archive_threads = archive_threads
+        self.workers = workers or min(32, (os.cpu_count() or 1) + 4)
 
     def collect_impala_profiles(self):
         log.info("Started IMPALA workload extraction")
-        cm_deployment = self.cloudera_manager_resource.get_deployment2()
-        for cluster in cm_deployment.clusters:
+        for cluster in self.topology.get_clusters():
             log.debug(f"Checking if Impala daemons are deployed on {cluster.display_name}")
             for service in cluster.services:
                 impala_demon_roles = list(filter(lambda rcg: rcg.type == "IMPALAD", service.roles))
@@ -315,12 +359,12 @@ class ImpalaProfilesExtractor:
                                                       service.name)
                     create_directory(impalad_output_dir)
 
-                    self.collect_impala_profiles_for_role(cm_deployment.hosts, impala_demon_roles, impalad_output_dir)
+                    self.collect_impala_profiles_for_role(self.topology.get_hosts(), impala_demon_roles, impalad_output_dir)
                     break
 
     def collect_impala_profiles_for_role(self, cluster_hosts, impala_demon_roles, impalad_output_dir):
         impalad_profile_dir_prefix = "var/log/impalad"
-        non_empty_impala_profiles = []
+        impala_profile_parent_paths = []
         for impala_demon_role in impala_demon_roles:
             impala_host = next(filter(lambda host: host.host_id == impala_demon_role.host_ref.host_id, cluster_hosts),
                                None)
@@ -328,14 +372,62 @@ class ImpalaProfilesExtractor:
                                                       "impala-query-logs",
                                                       f"{impala_host.hostname}-{impala_host.ip_address}")
             log.debug(f"impala_profile_parent_path: {impala_profile_parent_path}")
-            all_impala_profiles_for_role = Path(impala_profile_parent_path).rglob("impala_profile*")
-            non_empty_impala_profiles_for_role = list(
-                filter(lambda profile: os.stat(profile).st_size != 0, all_impala_profiles_for_role))
-            non_empty_impala_profiles.extend(non_empty_impala_profiles_for_role)
-        impala_profiles_dest = os.path.join(impalad_output_dir, impalad_profile_dir_prefix)
-        Path(impala_profiles_dest).mkdir(parents=True, exist_ok=True)
-        for i in non_empty_impala_profiles:
-            shutil.copy(i, impala_profiles_dest)
-        with tarfile.open(impalad_output_dir + "/IMPALA_PROFILE_LOGS.tar.gz", "w:gz") as tar:
-            for i in non_empty_impala_profiles:
-                tar.add(i, arcname=impalad_profile_dir_prefix + "/" + os.path.basename(i))
+            impala_profile_parent_paths.append(impala_profile_parent_path)
+        target_file = f"{impalad_output_dir}/IMPALA_PROFILE_LOGS{archive_suffixes[self.archive_codec]}"
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="impala_profiles") as executor:
+            non_empty_impala_profiles = [profile for profiles in executor.map(self.scan_impala_profiles,
+                                                                              impala_profile_parent_paths)
+                                         for profile in profiles]
+            log.info(f"Archiving {len(non_empty_impala_profiles)} non-empty Impala profile logs of "
+                     f"{len(impala_demon_roles)} Impala daemons into {target_file}")
+            with open_archive(target_file, self.archive_codec, self.archive_threads) as tar:
+                for path, stat, content in self.read_impala_profiles(executor, non_empty_impala_profiles,
+                                                                     2 * self.workers):
+                    member = tarfile.TarInfo(f"{impalad_profile_dir_prefix}/{os.path.basename(path)}")
+                    member.size = stat.st_size
+                    member.mtime = int(stat.st_mtime)
+                    member.mode = stat.st_mode & 0o7777
+                    if content is not None:
+                        tar.addfile(member, io.BytesIO(content))
+                        continue
+                    with open(path, "rb") as profile:
+                        tar.addfile(member, profile)
+        log.info(f"Tarball created at: {target_file}")
+
+    @staticmethod
+    def scan_impala_profiles(directory):
+        """
+        Returns (path, stat) of the non-empty impala_profile* files below directory. The directory tree is walked once
+        with os.scandir, the sizes come from the cached stat of the directory entries.
+        """
+        profiles = []
+        directories = [directory]
+        while directories:
+            try:
+                with os.scandir(directories.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(entry.path)
+                        elif entry.name.startswith("impala_profile") and entry.is_file() and entry.stat().st_size:
+                            profiles.append((entry.path, entry.stat()))
+            except OSError as error:
+                log.debug(f"Unable to scan for Impala profiles: {error}")
+        return profiles
+
+    @staticmethod
+    def read_impala_profiles(executor, profiles, read_ahead):
+        """
+        Yields (path, stat, content) of the profiles in order. Up to read_ahead profiles of at most
+        profile_read_ahead_size bytes are read ahead by the threads of executor, the content of larger ones is None and
+        they are read while archived.
+        """
+        pending = collections.deque()
+        for path, stat in profiles:
+            pending.append((path, stat, executor.submit(Path(path).read_bytes)
+                            if stat.st_size <= profile_read_ahead_size else None))
+            if len(pending) > read_ahead:
+                path, stat, content = pending.popleft()
+                yield path, stat, content.result() if content else None
+        while pending:
+            path, stat, content = pending.popleft()
+            yield path, stat, content.result() if content else None
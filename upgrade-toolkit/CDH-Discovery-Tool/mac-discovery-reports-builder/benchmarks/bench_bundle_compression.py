@@ -0,0 +1,129 @@
+# Copyright 2022 Cloudera, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares plain, gzip and zstd bundle files, as written with --bundle-compression: synthetic CM metrics JSON and an
+hdfs_fs.csv are written with each compression, then read back through bundle_files the way the reports builder reads
+them. Prints the file sizes and the write and read times, and checks that every variant reads back the same.
+
+    python3 benchmarks/bench_bundle_compression.py --hosts=200 --csv-rows=500000
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bundle_files import find_bundle_file, open_bundle_file
+
+fs_image_header = ["Path", "Replication", "ModificationTime", "AccessTime", "PreferredBlockSize", "BlocksCount",
+                   "FileSize", "NSQUOTA", "DSQUOTA", "Permission", "UserName", "GroupName"]
+compression_suffixes = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def generate_metrics(hosts, hours):
+    random.seed(1)
+    return {"items": [{"timeSeries": [{
+        "metadata": {"metricName": "cpu_percent", "entityName": f"host-{host}.example.com"},
+        "data": [{"timestamp": f"2026-01-{hour // 24 + 1:02d}T{hour % 24:02d}:00:00.000Z",
+                  "value": random.random() * 100, "type": "SAMPLE"} for hour in range(hours)]
+    } for host in range(hosts)]}]}
+
+
+def generate_fs_image_rows(rows):
+    random.seed(1)
+    for row in range(rows):
+        yield [f"/user/u{row % 50}/d{row % 1000}/f{row}.parq", 3, f"2026-01-0{row % 9 + 1} 10:00",
+               "2026-01-01 10:00", 134217728, 1, random.randint(0, 1 << 30), 0, 0, "-rw-r--r--", "hdfs",
+               "supergroup"]
+
+
+def open_for_writing(path, compression):
+    """
+    Opens path for writing the way the bundle builder does for --bundle-compression.
+    """
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    if compression == 'zstd':
+        import pyarrow as pa
+
+        return io.TextIOWrapper(pa.CompressedOutputStream(path, 'zstd'), encoding='utf-8', newline='')
+    return open(path, 'w', encoding='utf-8', newline='')
+
+
+def run(work_dir, compression, metrics, csv_rows):
+    json_path = os.path.join(work_dir, f"cpu_percent.json{compression_suffixes[compression]}")
+    csv_path = os.path.join(work_dir, f"hdfs_fs.csv{compression_suffixes[compression]}")
+    started = time.monotonic()
+    with open_for_writing(json_path, compression) as json_file:
+        json.dump(metrics, json_file)
+    with open_for_writing(csv_path, compression) as csv_file:
+        writer = csv.writer(csv_file, lineterminator="\n")
+        writer.writerow(fs_image_header)
+        writer.writerows(generate_fs_image_rows(csv_rows))
+    write_time = time.monotonic() - started
+
+    started = time.monotonic()
+    with open_bundle_file(find_bundle_file(os.path.join(work_dir, "cpu_percent.json"))) as json_file:
+        loaded_metrics = json.load(json_file)
+    with open_bundle_file(find_bundle_file(os.path.join(work_dir, "hdfs_fs.csv"))) as csv_file:
+        fs_image = pd.read_csv(csv_file)
+    read_time = time.monotonic() - started
+
+    print(f"{compression or 'none':5s} JSON {os.path.getsize(json_path) / 2 ** 20:6.1f} MiB  "
+          f"CSV {os.path.getsize(csv_path) / 2 ** 20:6.1f} MiB  write {write_time:5.1f} s  read {read_time:5.2f} s")
+    os.remove(json_path)
+    os.remove(csv_path)
+    return loaded_metrics == metrics, fs_image
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--hosts', action='store', type='int', dest='hosts', default=200,
+                      help='Number of hosts in the metrics JSON, each with 30 days of hourly points. Defaults to 200.')
+    parser.add_option('--csv-rows', action='store', type='int', dest='csv_rows', default=500000,
+                      help='Number of rows of hdfs_fs.csv. Defaults to 500000.')
+    parser.add_option('--work-dir', action='store', dest='work_dir', default=None,
+                      help='Scratch directory for the bundle files. Defaults to a new temp directory.')
+    (options, args) = parser.parse_args()
+
+    metrics = generate_metrics(options.hosts, 30 * 24)
+    work_dir = tempfile.mkdtemp(dir=options.work_dir, prefix="bench_bundle_compression_")
+    identical = True
+    try:
+        expected_fs_image = None
+        for compression in compression_suffixes:
+            metrics_identical, fs_image = run(work_dir, compression, metrics, options.csv_rows)
+            if expected_fs_image is None:
+                expected_fs_image = fs_image
+            identical &= metrics_identical and fs_image.equals(expected_fs_image)
+    finally:
+        shutil.rmtree(work_dir)
+    print(f"read back {'identical' if identical else 'DIFFERENT'}")
+    sys.exit(0 if identical else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+# Copyright 2022 Cloudera, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures HdfsTreeRollup on a synthetic fsimage of --rows rows, fed in chunks the way the streaming report builder
+reads them, and reports the throughput and peak memory. The first --check-rows rows are also aggregated row by row in
+plain Python, the way depths and parent paths were computed before, and both results are compared.
+
+    python3 benchmarks/bench_hdfs_tree_rollup.py --rows=50000000 --depth=3
+"""
+
+import os
+import resource
+import sys
+import time
+from optparse import OptionParser
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hdfs_report_builder import HdfsTreeRollup, default_chunk_size, tree_metric_columns
+
+block_size = 128 * 1024 * 1024
+top_level_directories = np.array(['user', 'data', 'tmp', 'warehouse', 'apps'])
+
+
+def generate_chunks(rows, chunk_size):
+    """
+    Yields fsimage chunks of chunk_size rows: files 2 to 7 levels deep, each chunk preceded by the directory rows of
+    the directories not seen in an earlier chunk.
+    """
+    random = np.random.default_rng(1)
+    seen_directories = set()
+    generated = 0
+    while generated < rows:
+        size = min(chunk_size, rows - generated)
+        depths = random.integers(2, 8, size)
+        components = [top_level_directories[random.integers(0, len(top_level_directories), size)],
+                      np.char.add('u', random.integers(0, 50, size).astype(str)),
+                      np.char.add('d', random.integers(0, 100, size).astype(str)),
+                      np.char.add('p', random.integers(0, 5, size).astype(str)),
+                      np.char.add('q', random.integers(0, 3, size).astype(str)),
+                      np.char.add('r', random.integers(0, 2, size).astype(str))]
+        paths = pd.Series('', index=range(size))
+        for level, component in enumerate(components, start=1):
+            paths = paths.where(depths <= level, paths + '/' + component)
+        parents = paths.unique()
+        paths = paths + '/f' + pd.Series(np.arange(generated, generated + size).astype(str))
+        directories = sorted({ancestor for parent in parents for ancestor in ancestor_paths(parent)}
+                             - seen_directories)
+        seen_directories.update(directories)
+        file_sizes = random.lognormal(16, 3, size).astype('int64')
+        yield pd.DataFrame({
+            'Path': np.concatenate([directories, paths.values]),
+            'Replication': np.concatenate([np.zeros(len(directories), 'int64'), np.full(size, 3)]),
+            'PreferredBlockSize': np.concatenate([np.zeros(len(directories), 'int64'), np.full(size, block_size)]),
+            'BlocksCount': np.concatenate([np.zeros(len(directories), 'int64'), file_sizes // block_size + 1]),
+            'FileSize': np.concatenate([np.zeros(len(directories), 'int64'), file_sizes])
+        })
+        generated += size
+
+
+def ancestor_paths(path):
+    parts = path.split('/')
+    return ['/'.join(parts[:length]) for length in range(2, len(parts) + 1)]
+
+
+def rollup_row_by_row(chunks, max_depth):
+    """
+    Reference aggregation, one Python loop iteration per row.
+    """
+    levels = {}
+    for chunk in chunks:
+        for path, replication, preferred_block_size, blocks_count, file_size in chunk.itertuples(index=False):
+            depth = 0 if path == '/' else path.count('/')
+            if replication == 0 and 0 < depth <= max_depth:
+                levels.setdefault((path, depth), [0] * len(tree_metric_columns))
+            parts = path.split('/')
+            for level in range(min(depth, max_depth + 1)):
+                metrics = levels.setdefault(('/' if level == 0 else '/'.join(parts[:level + 1]), level),
+                                            [0] * len(tree_metric_columns))
+                for index, value in enumerate([file_size, blocks_count, int(replication > 0), int(replication == 0),
+                                               int(file_size < preferred_block_size),
+                                               int(file_size < preferred_block_size / 10),
+                                               int(file_size < preferred_block_size / 1000)]):
+                    metrics[index] += value
+    return sorted((path, depth, *metrics) for (path, depth), metrics in levels.items())
+
+
+def rollup_report(rollup):
+    report = rollup.to_frame()
+    return sorted(zip(report['Path'], report['Depth'].astype(int),
+                      *(report[column].astype(int) for column in tree_metric_columns)))
+
+
+def peak_memory_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--rows', action='store', type='int', dest='rows', default=50000000,
+                      help='Number of file rows of the synthetic fsimage. Defaults to 50000000.')
+    parser.add_option('--depth', action='store', type='int', dest='depth', default=3,
+                      help='Depth of the HDFS structure report. Defaults to 3.')
+    parser.add_option('--chunk-size', action='store', type='int', dest='chunk_size', default=default_chunk_size,
+                      help=f'Rows per chunk, as read by the streaming report builder. Defaults to {default_chunk_size}.')
+    parser.add_option('--check-rows', action='store', type='int', dest='check_rows', default=300000,
+                      help='Rows also aggregated row by row, to compare the timing and the results. 0 skips the check. Defaults to 300000.')
+    (options, args) = parser.parse_args()
+
+    identical = True
+    if options.check_rows:
+        chunks = list(generate_chunks(options.check_rows, options.chunk_size))
+        started = time.monotonic()
+        expected = rollup_row_by_row(chunks, options.depth)
+        row_by_row_time = time.monotonic() - started
+        started = time.monotonic()
+        rollup = HdfsTreeRollup(options.depth)
+        for chunk in chunks:
+            rollup.add(chunk)
+        actual = rollup_report(rollup)
+        rollup_time = time.monotonic() - started
+        identical = actual == expected
+        print(f"{options.check_rows} rows: row by row {row_by_row_time:.1f} s, HdfsTreeRollup {rollup_time:.1f} s, "
+              f"{len(actual)} directories, results {'identical' if identical else 'DIFFERENT'}")
+        del chunks
+
+    generation_time = 0
+    rollup = HdfsTreeRollup(options.depth)
+    started = time.monotonic()
+    rows = 0
+    chunk_started = time.monotonic()
+    for chunk in generate_chunks(options.rows, options.chunk_size):
+        generation_time += time.monotonic() - chunk_started
+        rollup.add(chunk)
+        rows += len(chunk)
+        chunk_started = time.monotonic()
+    directories = len(rollup.to_frame())
+    rollup_time = time.monotonic() - started - generation_time
+    print(f"{rows} rows ({options.rows} files) at depth {options.depth}: HdfsTreeRollup {rollup_time:.1f} s "
+          f"({rows / rollup_time:,.0f} rows/s), {directories} directories, generating the rows took "
+          f"{generation_time:.1f} s, peak memory {peak_memory_mb():.0f} MiB")
+    sys.exit(0 if identical else 1)
+
+
+if __name__ == '__main__':
+    main()
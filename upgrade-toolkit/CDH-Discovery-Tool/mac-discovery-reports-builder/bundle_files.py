@@ -0,0 +1,62 @@
+# Copyright 2022 Cloudera, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import io
+import os
+import re
+from pathlib import Path
+
+compression_suffixes = {'.gz': 'gzip', '.zst': 'zstd'}
+
+
+def find_bundle_file(path):
+    """
+    Returns path, or its compressed variant if the bundle was built with --bundle-compression.
+    """
+    path = str(path)
+    if not os.path.exists(path):
+        for suffix in compression_suffixes:
+            if os.path.exists(f"{path}{suffix}"):
+                return f"{path}{suffix}"
+    return path
+
+
+def find_bundle_files(directory, pattern):
+    """
+    Recursively finds the files matching pattern and their compressed variants.
+    """
+    files = list(Path(directory).rglob(pattern))
+    for suffix in compression_suffixes:
+        files.extend(Path(directory).rglob(f"{pattern}{suffix}"))
+    return files
+
+
+def strip_compression_suffix(path):
+    return re.sub(r"(\.gz|\.zst)$", "", str(path))
+
+
+def open_bundle_file(path, newline=None):
+    """
+    Opens a bundle file for reading as text, decompressing gzip (.gz) and zstd (.zst) files on the fly.
+    """
+    path = str(path)
+    compression = compression_suffixes.get(Path(path).suffix)
+    if compression == 'gzip':
+        return gzip.open(path, 'rt', encoding='utf-8', newline=newline)
+    if compression == 'zstd':
+        import pyarrow as pa
+
+        return io.TextIOWrapper(pa.CompressedInputStream(pa.OSFile(path), 'zstd'), encoding='utf-8', newline=newline)
+    return open(path, encoding='utf-8', newline=newline)
@@ -56,6 +56,16 @@ if __name__ == '__main__':
                       metavar='<compute_hdfs_structure>',
                       help='Computes HDFS structure, it may take a long time.')
 
+    parser.add_option('--hdfs-report-chunk-size', action='store', type='int',
+                      dest='hdfs_report_chunk_size',
+                      metavar='<rows>',
+                      default=1000000,
+                      help='Number of fsimage rows read at once while computing the HDFS structure. Defaults to 1000000.')
+
+    parser.add_option('--hdfs-report-in-memory', action='store_true',
+                      dest='hdfs_report_in_memory', default=False,
+                      help='Loads the whole fsimage CSV into memory instead of streaming it in chunks.')
+
     #parser.add_option("--wxm-upload",
     #                  action="store_true", dest="wxm_upload", default=False,
     #                  help="Use this flag to upload the tarballs to WXM")
@@ -80,6 +90,8 @@ if __name__ == '__main__':
     log.info("*** reports-path: %s", options.output_path)
     log.info("*** hdfs-report-depth: %s", options.hdfs_report_depth)
     log.info("*** compute-hdfs-structure: %s", options.compute_hdfs_structure)
+    log.info("*** hdfs-report-chunk-size: %s", options.hdfs_report_chunk_size)
+    log.info("*** hdfs-report-in-memory: %s", options.hdfs_report_in_memory)
     #log.info("*** wxm-upload: %s", options.wxm_upload)
     log.info("*** INVOCATION PARAMETERS END   ***")
 
@@ -102,7 +114,8 @@ if __name__ == '__main__':
     ]
     if options.compute_hdfs_structure:
         threads.append(Thread(target=mac_reports_builder.create_hdfs_report, name="hdfs_report_builder_thread",
-                              args=(options.hdfs_report_depth,)))
+                              args=(options.hdfs_report_depth, options.hdfs_report_chunk_size,
+                                    options.hdfs_report_in_memory)))
 
     # if options.wxm_upload:
     #    threads.append(Thread(target=WxmUploader(options.input_path, wb).upload_workloads, name="wxm_uploader_thread"))
@@ -12,87 +12,162 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
 import os
-import re
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 
+from bundle_files import open_bundle_file
+
+log = logging.getLogger('main')
+
+default_chunk_size = 1000000
+
+fs_image_columns = ['Path', 'Replication', 'ModificationTime', 'PreferredBlockSize', 'BlocksCount', 'FileSize']
+parquet_columns = ['ParentPath', 'Name', 'Replication', 'ModificationTime', 'PreferredBlockSize', 'BlocksCount',
+                   'FileSize']
+tree_metric_columns = ['FileSize', 'BlocksCount', 'FileCount', 'DirectoryCount', 'SmallFile', 'SmallFile10',
+                       'SmallFile1000']
+tree_report_columns = ["Path", "FileSize", "BlocksCount", "Depth", "FileCount", "DirectoryCount", "SmallFile",
+                       "SmallFile10", "SmallFile1000", "AvgFileSize"]
+
+
+class HdfsTreeRollup:
+    """
+    Aggregates fsimage rows to every ancestor directory up to max_depth. Each row is added once to each of its
+    ancestors, so the cost is proportional to rows x report depth regardless of how deep the tree is.
+    """
+
+    def __init__(self, max_depth):
+        self.max_depth = max_depth
+        self.levels = [pd.DataFrame(columns=tree_metric_columns, dtype='int64') for _ in range(max_depth + 1)]
+        self.directories = [[] for _ in range(max_depth + 1)]
+
+    @staticmethod
+    def count_depths(paths):
+        return paths.str.count('/').where(paths != '/', 0)
+
+    @staticmethod
+    def get_ancestor_paths(paths, level):
+        if level == 0:
+            return pd.Series('/', index=paths.index)
+        return paths.str.extract(f'^((?:/[^/]*){{{level}}})', expand=False)
+
+    def add(self, df):
+        paths = df['Path'].astype(str)
+        depths = self.count_depths(paths)
+        metrics = pd.DataFrame({
+            'FileSize': df['FileSize'],
+            'BlocksCount': df['BlocksCount'],
+            'FileCount': (df['Replication'] > 0).astype('int64'),
+            'DirectoryCount': (df['Replication'] == 0).astype('int64'),
+            'SmallFile': (df['FileSize'] < df['PreferredBlockSize']).astype('int64'),
+            'SmallFile10': (df['FileSize'] < df['PreferredBlockSize'] / 10).astype('int64'),
+            'SmallFile1000': (df['FileSize'] < df['PreferredBlockSize'] / 1000).astype('int64')
+        }, index=df.index)
+        for level in range(1, self.max_depth + 1):
+            level_directories = paths[(depths == level) & (metrics['DirectoryCount'] > 0)]
+            if not level_directories.empty:
+                self.directories[level].append(level_directories)
+        for level in range(self.max_depth + 1):
+            descendants = depths > level
+            if not descendants.any():
+                break
+            ancestors = self.get_ancestor_paths(paths[descendants], level)
+            aggregated = metrics[descendants].groupby(ancestors.values).sum()
+            self.levels[level] = pd.concat([self.levels[level], aggregated]).groupby(level=0).sum()
+
+    def to_frame(self, empty_directory_count=0):
+        """
+        Returns one row per directory up to max_depth, parents before children. Directories without children are
+        reported with zero counts, except for DirectoryCount which is set to empty_directory_count.
+        """
+        report_parts = []
+        for level in range(self.max_depth + 1):
+            aggregated = self.levels[level]
+            if self.directories[level]:
+                level_directories = pd.concat(self.directories[level])
+                empty_directories = level_directories[~level_directories.isin(aggregated.index)]
+                if not empty_directories.empty:
+                    empty_df = pd.DataFrame(0, index=empty_directories.values, columns=tree_metric_columns)
+                    empty_df['DirectoryCount'] = empty_directory_count
+                    empty_df['Depth'] = level
+                    empty_df['AvgFileSize'] = np.nan
+                    report_parts.append(empty_df.sort_index(ascending=False))
+            if not aggregated.empty:
+                aggregated = aggregated.astype('int64')
+                aggregated['Depth'] = level
+                aggregated['AvgFileSize'] = aggregated['FileSize'].div(aggregated['FileCount'])
+                report_parts.append(aggregated.sort_index(ascending=False))
+        report_df = pd.concat(report_parts) if report_parts else pd.DataFrame(columns=tree_report_columns[1:])
+        report_df.index.name = 'Path'
+        return report_df.reset_index()
+
 
 class HdfsReportBuilder:
-    def __init__(self, hdfs_report_depth):
-        self.prev_df = pd.DataFrame()
-        self.collector_df = pd.DataFrame()
+    def __init__(self, hdfs_report_depth, chunk_size=default_chunk_size, in_memory=False):
         self.default_level = hdfs_report_depth
+        self.chunk_size = chunk_size
+        self.in_memory = in_memory
 
-    def get_parent_path(self, path):
-        matched = re.match("((?:[^/]*/)*)(.*)?", path)
-        path = matched.group(1)
-        return path if path == "/" else path[:-1]
+    def create_report(self, hdfs_fs_path):
+        """
+        Builds both HDFS reports from an fsimage dump, either the oiv CSV (plain, .gz or .zst) or its Parquet
+        conversion. Unless in_memory is set the dump is read in chunks of chunk_size rows, and only the aggregates of
+        the directories up to the report depth and the daily modification counts are kept between chunks.
+        """
+        output_path = Path(hdfs_fs_path).parent
+        cluster_name = output_path.parent.parent.name
+        log.info(f"Building HDFS reports from {hdfs_fs_path}")
+        rollup = HdfsTreeRollup(self.default_level)
+        modification_times = pd.Series(dtype='int64')
+        rows = 0
+        for chunk in self.__read_fs_image(hdfs_fs_path):
+            rows += len(chunk)
+            modification_times = self.__add_modification_times(modification_times, chunk)
+            rollup.add(chunk)
+            log.debug(f"Processed {rows} rows of {hdfs_fs_path}")
+        self.__write_modification_report(modification_times, output_path, cluster_name)
+        rollup.to_frame().to_csv(os.path.join(output_path, "hdfs_structure_report.csv"), index=False,
+                                 columns=tree_report_columns)
+        log.info(f"HDFS reports created from {rows} rows at: {output_path}")
 
-    def count_depth(self, path):
-        return 0 if path == '/' else path.count('/')
+    def __read_fs_image(self, hdfs_fs_path):
+        if Path(hdfs_fs_path).suffix == '.parquet':
+            yield from self.__read_parquet_fs_image(hdfs_fs_path)
+            return
+        with open_bundle_file(hdfs_fs_path) as hdfs_fs_file:
+            if self.in_memory:
+                yield pd.read_csv(hdfs_fs_file, usecols=fs_image_columns)
+            else:
+                yield from pd.read_csv(hdfs_fs_file, usecols=fs_image_columns, chunksize=self.chunk_size)
 
-    def create_csv_report(self, hdfs_fs_csv_path):
-        output_path = Path(hdfs_fs_csv_path).parent
-        cluster_name = output_path.parent.parent.name
-        df = pd.read_csv(hdfs_fs_csv_path)
-        self.__create_hdfs_modification_report(df, output_path, cluster_name)
-        self.__create_hdfs_tree_report(df, output_path)
-
-    def __create_hdfs_tree_report(self, df, output_path):
-        reduced_df = df.loc[:, ('Path', 'FileSize', 'BlocksCount')]
-        reduced_df['Depth'] = (df.apply(lambda x: self.count_depth(x['Path']), axis=1))
-        reduced_df['FileCount'] = np.select([df['Replication'] > 0], [1], 0)
-        reduced_df['DirectoryCount'] = np.select([df['Replication'] == 0], [1], 0)
-        reduced_df['SmallFile'] = np.select([df['FileSize'] < df['PreferredBlockSize']], [1], 0)
-        reduced_df['SmallFile10'] = np.select([df['FileSize'] < df['PreferredBlockSize'] / 10], [1], 0)
-        reduced_df['SmallFile1000'] = np.select([df['FileSize'] < df['PreferredBlockSize'] / 1000], [1], 0)
-        depth_aggregated_groups = reduced_df.groupby('Depth')
-
-        for depth in sorted(depth_aggregated_groups.groups.keys(), reverse=True):
-            if depth == 0:
-                break
-            depth_aggregated_group = depth_aggregated_groups.get_group(depth)
-            self.__aggregate_tree_level(depth_aggregated_group, depth)
-        self.collector_df.iloc[::-1].to_csv(os.path.join(output_path, "hdfs_structure_report.csv"), index=False,
-                                            columns=["Path", "FileSize", "BlocksCount", "Depth", "FileCount",
-                                                     "DirectoryCount", "SmallFile", "SmallFile10", "SmallFile1000",
-                                                     "AvgFileSize"])
-
-    def __aggregate_tree_level(self, group, level):
-        group = group.append(self.prev_df, ignore_index=True)
-        directories = group.drop_duplicates(subset=['Path'], keep=False)
-        directories = directories[directories['DirectoryCount'] > 0]
-        if not directories.empty:
-            directories['DirectoryCount'] = 0
-            self.__add_to_collector(directories, level)
-        group['ParentPath'] = (group.apply(lambda x: self.get_parent_path(x['Path']), axis=1))
-        aggregated_df = group.groupby('ParentPath', as_index=False).agg(
-            DirectoryCount=pd.NamedAgg(column="DirectoryCount", aggfunc="sum"),
-            FileCount=pd.NamedAgg(column="FileCount", aggfunc="sum"),
-            SmallFile=pd.NamedAgg(column="SmallFile", aggfunc="sum"),
-            SmallFile10=pd.NamedAgg(column="SmallFile10", aggfunc="sum"),
-            SmallFile1000=pd.NamedAgg(column="SmallFile1000", aggfunc="sum"),
-            BlocksCount=pd.NamedAgg(column="BlocksCount", aggfunc="sum"),
-            FileSize=pd.NamedAgg(column="FileSize", aggfunc="sum")
-        )
-        aggregated_df.rename(columns={'ParentPath': 'Path'}, inplace=True)
-        parent_level = level - 1
-        aggregated_df["Depth"] = parent_level
-        self.prev_df = aggregated_df
-        aggregated_df["AvgFileSize"] = aggregated_df['FileSize'].div(aggregated_df['FileCount'])
-        self.__add_to_collector(aggregated_df, parent_level)
-
-    def __add_to_collector(self, group, level):
-        if level <= self.default_level:
-            self.collector_df = self.collector_df.append(group)
-
-    def __create_hdfs_modification_report(self, df, output_path, cluster_name):
-        modification_time_aggregation = (pd.to_datetime(df['ModificationTime'])
-                                         .dt.floor('d')
-                                         .value_counts()
+    def __read_parquet_fs_image(self, hdfs_fs_parquet_path):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(hdfs_fs_parquet_path)
+        if self.in_memory:
+            batches = [parquet_file.read(columns=parquet_columns)]
+        else:
+            batches = parquet_file.iter_batches(batch_size=self.chunk_size, columns=parquet_columns)
+        for batch in batches:
+            df = batch.to_pandas()
+            parent_paths = df['ParentPath'].astype(str)
+            df['Path'] = parent_paths.where(parent_paths != '/', '') + '/' + df['Name']
+            df['ModificationTime'] = pd.to_datetime(df['ModificationTime'], unit='ms')
+            yield df
+
+    @staticmethod
+    def __add_modification_times(modification_times, chunk):
+        chunk_counts = pd.to_datetime(chunk['ModificationTime']).dt.floor('d').value_counts()
+        return pd.concat([modification_times, chunk_counts]).groupby(level=0).sum()
+
+    @staticmethod
+    def __write_modification_report(modification_times, output_path, cluster_name):
+        modification_time_aggregation = (modification_times
+                                         .sort_values(ascending=False, kind='mergesort')
                                          .rename_axis('Date')
                                          .reset_index(name='Count'))
         modification_time_aggregation['ClusterName'] = cluster_name
@@ -24,12 +24,22 @@ import os.path
 import re
 from pathlib import Path
 
-from hdfs_report_builder import HdfsReportBuilder
+from bundle_files import find_bundle_file, find_bundle_files, open_bundle_file, strip_compression_suffix
+from hdfs_report_builder import HdfsReportBuilder, default_chunk_size
 
 import cm_client
 
 log = logging.getLogger('main')
 
+
+def load_api_response(path, response_type):
+    """
+    Loads a CM API response from the bundle, plain or compressed.
+    """
+    with open_bundle_file(find_bundle_file(path)) as f:
+        api_response_json = json.load(f)
+    return cm_client.ApiClient()._ApiClient__deserialize(api_response_json, response_type)
+
 role_assignments = {
     'master': ["NAMENODE", "JOURNALNODE", "FAILOVERCONTROLLER", "RESOURCEMANAGER", "SERVER", "JOBHISTORY",
                "KUDU_MASTER", "MASTER", "SCHEMA_REGISTRY_SERVER", "SPARK_YARN_HISTORY_SERVER"],
@@ -53,14 +63,12 @@ class MacReportBuilder:
         self.hosts = self.__setup_hosts()
 
     def __setup_deployment(self):
-        f = open(os.path.join(self.discovery_bundle_path, 'api_diagnostics/cm_deployment.json'))
-        deployment_json = json.load(f)
-        return cm_client.ApiClient()._ApiClient__deserialize(deployment_json, 'ApiDeployment2')
+        return load_api_response(os.path.join(self.discovery_bundle_path, 'api_diagnostics/cm_deployment.json'),
+                                 'ApiDeployment2')
 
     def __setup_hosts(self):
-        f = open(os.path.join(self.discovery_bundle_path, 'api_diagnostics/host/read_hosts.json'))
-        hosts_json = json.load(f)
-        return cm_client.ApiClient()._ApiClient__deserialize(hosts_json, 'ApiHostList')
+        return load_api_response(os.path.join(self.discovery_bundle_path, 'api_diagnostics/host/read_hosts.json'),
+                                 'ApiHostList')
 
     def __create_disk_report(self, hostname):
         disk_report_path = os.path.join(self.discovery_bundle_path, f'bundle/{hostname}/df_stdout')
@@ -160,22 +168,21 @@ class MacReportBuilder:
         log.debug("Configuration report building has been started.")
         for cluster in self.deployment.clusters:
 
-            all_configs = Path(
+            all_configs = find_bundle_files(
                 os.path.join(self.discovery_bundle_path,
                              "api_diagnostics",
                              "cluster",
                              cluster.display_name.replace(' ', '_'),
-                             "configs")).rglob("*.json")
+                             "configs"), "*.json")
 
             for service_config in all_configs:
-                api_config_list_json = json.load(open(service_config))
-                api_config_list = cm_client.ApiClient()._ApiClient__deserialize(api_config_list_json, 'ApiConfigList')
+                api_config_list = load_api_response(service_config, 'ApiConfigList')
                 for api_config in api_config_list.items:
                     self.workbook['Configurations'].append(
                         [cluster.display_name,
                          service_config.parent.parent.name,
                          service_config.parent.name,
-                         service_config.name.rstrip(".json"),
+                         re.sub(r"\.json$", "", strip_compression_suffix(service_config.name)),
                          api_config.name,
                          api_config.value,
                          api_config.default])
@@ -183,11 +190,9 @@ class MacReportBuilder:
 
     def create_service_metrics_report(self):
         log.debug("Service Metrics report building has been started.")
-        service_metrics = Path(os.path.join(self.discovery_bundle_path, "metrics/cluster")).rglob("service_*.json")
+        service_metrics = find_bundle_files(os.path.join(self.discovery_bundle_path, "metrics/cluster"), "service_*.json")
         for service_metric in service_metrics:
-            f = open(service_metric)
-            hosts_json = json.load(f)
-            timeseries_resource = cm_client.ApiClient()._ApiClient__deserialize(hosts_json, 'ApiTimeSeriesResponseList')
+            timeseries_resource = load_api_response(service_metric, 'ApiTimeSeriesResponseList')
             list_of_service_metrics = timeseries_resource.items[0].time_series
             for metric in list_of_service_metrics:
                 for data in metric.data:
@@ -206,15 +211,13 @@ class MacReportBuilder:
 
     def create_role_metrics_report(self):
         log.debug("Role CPU Metrics report building has been started.")
-        service_metrics = Path(os.path.join(self.discovery_bundle_path, "metrics/host")).rglob(
-            "role_cpu_usage_rate.json")
+        service_metrics = find_bundle_files(os.path.join(self.discovery_bundle_path, "metrics/host"),
+                                          "role_cpu_usage_rate.json")
         ws = self.workbook['Role Metrics']
         row = 2
 
         for service_metric in service_metrics:
-            f = open(service_metric)
-            hosts_json = json.load(f)
-            timeseries_resource = cm_client.ApiClient()._ApiClient__deserialize(hosts_json, 'ApiTimeSeriesResponseList')
+            timeseries_resource = load_api_response(service_metric, 'ApiTimeSeriesResponseList')
             for query_item in timeseries_resource.items:
                 list_of_service_metrics = query_item.time_series
                 for metric in list_of_service_metrics:
@@ -233,14 +236,12 @@ class MacReportBuilder:
 
     def create_workload_metrics_report(self):
         log.debug("Workload Metrics report building has been started.")
-        workload_metrics = Path(os.path.join(self.discovery_bundle_path, "metrics/cluster")).rglob("workload_*.json")
+        workload_metrics = find_bundle_files(os.path.join(self.discovery_bundle_path, "metrics/cluster"),
+                                           "workload_*.json")
         ws = self.workbook['YARN Workload Metrics']
         row = 2
         for workload_metric in workload_metrics:
-            f = open(workload_metric)
-            metric_json = json.load(f)
-            timeseries_resource = cm_client.ApiClient()._ApiClient__deserialize(metric_json,
-                                                                                'ApiTimeSeriesResponseList')
+            timeseries_resource = load_api_response(workload_metric, 'ApiTimeSeriesResponseList')
             list_of_workload_metrics = timeseries_resource.items[0].time_series
             for metric in list_of_workload_metrics:
                 for data in metric.data:
@@ -271,18 +272,21 @@ class MacReportBuilder:
         log.debug("Service report building has been finished.")
 
     def create_hive_metastore_report(self):
-        csv_files = Path(os.path.join(self.discovery_bundle_path, "workload/")).rglob("hive_ms.csv")
+        csv_files = find_bundle_files(os.path.join(self.discovery_bundle_path, "workload/"), "hive_ms.csv")
         for csv_file in csv_files:
-            f = open(csv_file)
+            f = open_bundle_file(csv_file, newline='')
             reader = csv.reader(f, delimiter=',')
             next(reader, None)
             for row in reader:
                 self.workbook['Hive Metastore'].append(row)
 
-    def create_hdfs_report(self, hdfs_report_depth):
-        raw_csv_files = Path(os.path.join(self.discovery_bundle_path, "workload/")).rglob("hdfs_fs.csv")
-        for raw_csv_file in raw_csv_files:
-            HdfsReportBuilder(hdfs_report_depth=hdfs_report_depth).create_csv_report(raw_csv_file)
+    def create_hdfs_report(self, hdfs_report_depth, chunk_size=default_chunk_size, in_memory=False):
+        raw_fs_image_files = Path(os.path.join(self.discovery_bundle_path, "workload/")).rglob("hdfs_fs.*")
+        for raw_fs_image_file in raw_fs_image_files:
+            if Path(strip_compression_suffix(raw_fs_image_file)).suffix not in ('.csv', '.parquet'):
+                continue
+            HdfsReportBuilder(hdfs_report_depth=hdfs_report_depth, chunk_size=chunk_size,
+                              in_memory=in_memory).create_report(raw_fs_image_file)
         self.__create_hdfs_structure_report()
         self.__create_hdfs_modification_time_report()
 
@@ -315,9 +319,9 @@ class MacReportBuilder:
                 row_index += 1
 
     def create_sentry_policies_report(self):
-        csv_files = Path(os.path.join(self.discovery_bundle_path, "workload/")).rglob("sentry_policies.csv")
+        csv_files = find_bundle_files(os.path.join(self.discovery_bundle_path, "workload/"), "sentry_policies.csv")
         for csv_file in csv_files:
-            f = open(csv_file)
+            f = open_bundle_file(csv_file, newline='')
             reader = csv.reader(f, delimiter=',')
             next(reader, None)
             for row in reader:
@@ -325,15 +329,12 @@ class MacReportBuilder:
 
     def create_cm_report(self):
         cm_url = open(os.path.join(self.discovery_bundle_path, "cm_url")).readline()
-        cm_version_json = json.load(
-            open(os.path.join(self.discovery_bundle_path, 'api_diagnostics/cluster/cm_version.json')))
-        cm_version = cm_client.ApiClient()._ApiClient__deserialize(cm_version_json, 'ApiVersionInfo')
-        cm_config_json = json.load(
-            open(os.path.join(self.discovery_bundle_path, 'api_diagnostics/cluster/cm_config.json')))
-        cm_config = cm_client.ApiClient()._ApiClient__deserialize(cm_config_json, 'ApiConfigList')
-        kerberos_config_json = json.load(
-            open(os.path.join(self.discovery_bundle_path, 'api_diagnostics/cluster/kerberos_info.json')))
-        kerberos_config = cm_client.ApiClient()._ApiClient__deserialize(kerberos_config_json, 'ApiKerberosInfo')
+        cm_version = load_api_response(
+            os.path.join(self.discovery_bundle_path, 'api_diagnostics/cluster/cm_version.json'), 'ApiVersionInfo')
+        cm_config = load_api_response(
+            os.path.join(self.discovery_bundle_path, 'api_diagnostics/cluster/cm_config.json'), 'ApiConfigList')
+        kerberos_config = load_api_response(
+            os.path.join(self.discovery_bundle_path, 'api_diagnostics/cluster/kerberos_info.json'), 'ApiKerberosInfo')
 
         web_tls = next(filter(lambda config: config.name == "WEB_TLS", cm_config.items))
         agent_tls = next(filter(lambda config: config.name == "AGENT_TLS", cm_config.items))
@@ -398,10 +399,11 @@ class MacReportBuilder:
 
     def __fetch_latest_hms_deployment_info(self, cluster_name):
         table_counter = {"table": 0, "view": 0}
-        hms_csv_path = f"{self.discovery_bundle_path}/workload/{cluster_name.replace(' ', '_')}/service/HIVE-1/hive_ms.csv"
+        hms_csv_path = find_bundle_file(
+            f"{self.discovery_bundle_path}/workload/{cluster_name.replace(' ', '_')}/service/HIVE-1/hive_ms.csv")
         if not os.path.exists(hms_csv_path):
             return table_counter
-        f = open(hms_csv_path)
+        f = open_bundle_file(hms_csv_path, newline='')
         reader = csv.reader(f, delimiter=',')
         next(reader, None)
         for row in reader:
@@ -439,10 +441,8 @@ class MacReportBuilder:
         if not os.path.exists(hdfs_metric_path):
             return hdfs_data
         for hdfs_metric in hdfs_data.keys():
-            f = open(os.path.join(hdfs_metric_path, f"service_{hdfs_metric}.json"))
-            metric_json = json.load(f)
-            timeseries_resource = cm_client.ApiClient()._ApiClient__deserialize(metric_json,
-                                                                                'ApiTimeSeriesResponseList')
+            timeseries_resource = load_api_response(os.path.join(hdfs_metric_path, f"service_{hdfs_metric}.json"),
+                                                    'ApiTimeSeriesResponseList')
             list_of_service_metrics = timeseries_resource.items[0].time_series
             for metric in list_of_service_metrics:
                 if metric.data:
@@ -15,7 +15,6 @@
 import logging.config
 import os
 import os.path
-import re
 
 from pathlib import Path
 
@@ -31,14 +30,20 @@ log = logging.getLogger('main')
 module_output_prefix = "workload"
 
 
-def get_parent_path(path):
-    matched = re.match("((?:[^/]*/)*)(.*)?", path)
-    path = matched.group(1)
-    return path if path == "/" else path[:-1]
+report_columns = ['Path', 'FileSize', 'BlocksCount', 'Depth', 'FileCount', 'DirectoryCount', 'SmallFile',
+                  'SmallFile10', 'SmallFile1000', 'AvgFileSize']
+metric_columns = ['FileSize', 'BlocksCount', 'FileCount', 'DirectoryCount', 'SmallFile', 'SmallFile10',
+                  'SmallFile1000']
 
 
-def count_depth(path):
-    return 0 if path == '/' else path.count('/')
+def count_depths(paths):
+    return paths.str.count('/').where(paths != '/', 0)
+
+
+def get_ancestor_paths(paths, level):
+    if level == 0:
+        return pd.Series('/', index=paths.index)
+    return paths.str.extract(f'^((?:/[^/]*){{{level}}})', expand=False)
 
 
 class HdfsFsImageExtractor:
@@ -56,15 +61,11 @@ class HdfsFsImageExtractor:
         create_directory(self.api_output_dir + "/" + module_output_prefix)
         self.cluster_name = self.get_cluster_name()
         self.output_dir = self.api_output_dir
-        self.prev_df = pd.DataFrame()
-        self.collector_df = pd.DataFrame()
         self.default_level = default_level
 
     def collect_fs_image_reports(self):
         cluster = self.cluster_name
         hdfs_fs_csv_path = self.collect_fs_image_report_from_cluster(cluster)
-        self.prev_df = pd.DataFrame()
-        self.collector_df = pd.DataFrame()
         self.create_csv_report(hdfs_fs_csv_path)
 
     def collect_fs_image_report_from_cluster(self, cluster):
@@ -81,46 +82,42 @@ class HdfsFsImageExtractor:
         return hdfs_fs_csv_path
 
     def create_csv_report(self, hdfs_fs_csv_path):
+        """
+        Aggregates every row of the fsimage to each of its ancestor directories in a single pass. Directories deeper
+        than the report depth are never materialized, so deep trees cost rows x report depth.
+        """
         df = pd.read_csv(hdfs_fs_csv_path, on_bad_lines='skip')
-        reduced_df = df.loc[:, ('Path', 'FileSize', 'BlocksCount')]
-        reduced_df['Depth'] = (df.apply(lambda x: count_depth(x['Path']), axis=1))
-        reduced_df['FileCount'] = np.select([df['Replication'] > 0], [1], 0)
-        reduced_df['DirectoryCount'] = np.select([df['Replication'] == 0], [1], 0)
-        reduced_df['SmallFile'] = np.select([df['FileSize'] < df['PreferredBlockSize']], [1], 0)
-        reduced_df['SmallFile10'] = np.select([df['FileSize'] < df['PreferredBlockSize'] / 10], [1], 0)
-        reduced_df['SmallFile1000'] = np.select([df['FileSize'] < df['PreferredBlockSize'] / 1000], [1], 0)
-        groups = reduced_df.groupby('Depth')
-
-        for i in range(len(groups) - 1, 0, -1):
-            group = groups.get_group(i)
-            self.__aggregate_tree_level(group, i - 1)
-        self.collector_df.iloc[::-1].to_csv(os.path.join(Path(hdfs_fs_csv_path).parent, "hdfs_report.csv"), index=False)
-
-    def __aggregate_tree_level(self, group, level):
-        group = group.append(self.prev_df, ignore_index=True)
-        directories = group.drop_duplicates(subset=['Path'], keep=False)
-        directories = directories[directories['DirectoryCount'] > 0]
-        if not directories.empty:
-            self.__add_to_collector(directories, level)
-        group['ParentPath'] = (group.apply(lambda x: get_parent_path(x['Path']), axis=1))
-        aggregated_df = group.groupby('ParentPath', as_index=False).agg(
-            DirectoryCount=pd.NamedAgg(column="DirectoryCount", aggfunc="sum"),
-            FileCount=pd.NamedAgg(column="FileCount", aggfunc="sum"),
-            SmallFile=pd.NamedAgg(column="SmallFile", aggfunc="sum"),
-            SmallFile10=pd.NamedAgg(column="SmallFile10", aggfunc="sum"),
-            SmallFile1000=pd.NamedAgg(column="SmallFile1000", aggfunc="sum"),
-            BlocksCount=pd.NamedAgg(column="BlocksCount", aggfunc="sum"),
-            FileSize=pd.NamedAgg(column="FileSize", aggfunc="sum")
-        )
-        aggregated_df.rename(columns={'ParentPath': 'Path'}, inplace=True)
-        aggregated_df["Depth"] = level
-        self.prev_df = aggregated_df
-        aggregated_df["AvgFileSize"] = aggregated_df['FileSize'].div(aggregated_df['FileCount'])
-        self.__add_to_collector(aggregated_df, level)
-
-    def __add_to_collector(self, group, level):
-        if level < self.default_level:
-            self.collector_df = self.collector_df.append(group)
+        paths = df['Path'].astype(str)
+        depths = count_depths(paths)
+        metrics = pd.DataFrame({
+            'FileSize': df['FileSize'],
+            'BlocksCount': df['BlocksCount'],
+            'FileCount': np.select([df['Replication'] > 0], [1], 0),
+            'DirectoryCount': np.select([df['Replication'] == 0], [1], 0),
+            'SmallFile': np.select([df['FileSize'] < df['PreferredBlockSize']], [1], 0),
+            'SmallFile10': np.select([df['FileSize'] < df['PreferredBlockSize'] / 10], [1], 0),
+            'SmallFile1000': np.select([df['FileSize'] < df['PreferredBlockSize'] / 1000], [1], 0)
+        }, index=df.index)
+        report_parts = []
+        for level in range(self.default_level + 1):
+            descendants = depths > level
+            ancestors = get_ancestor_paths(paths[descendants], level)
+            if level > 0:
+                directories = paths[(depths == level) & (metrics['DirectoryCount'] > 0)]
+                empty_directories = directories[~directories.isin(ancestors)]
+                empty_df = metrics.loc[empty_directories.index]
+                empty_df.index = empty_directories.values
+                empty_df['Depth'] = level
+                report_parts.append(empty_df.sort_index(ascending=False))
+            if level < self.default_level and not ancestors.empty:
+                aggregated = metrics[descendants].groupby(ancestors.values).sum()
+                aggregated['Depth'] = level
+                aggregated['AvgFileSize'] = aggregated['FileSize'].div(aggregated['FileCount'])
+                report_parts.append(aggregated.sort_index(ascending=False))
+        report_df = pd.concat(report_parts) if report_parts else pd.DataFrame(columns=report_columns[1:])
+        report_df.index.name = 'Path'
+        report_df.reset_index().to_csv(os.path.join(Path(hdfs_fs_csv_path).parent, "hdfs_report.csv"), index=False,
+                                       columns=report_columns)
 
     def get_cluster_name(self):
         try:
@@ -0,0 +1,112 @@
+# Copyright 2022 Cloudera, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import os
+import tarfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Shared by the CDH and HDP discovery bundle builders, both keep an identical copy of this file
+archive_suffixes = {"gzip": ".tar.gz", "zstd": ".tar.zst"}
+
+
+def compress_gzip_member(block):
+    """
+    Returns block as a complete gzip member, with a zero modification time in its header.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+
+class ParallelCompressionWriter:
+    """
+    Write-only file object compressing its content on a pool of threads, zlib and zstd release the GIL while they
+    compress. The content is cut into blocks of block_size bytes, every block becomes a complete gzip member or zstd
+    frame and the blocks are written in order. Concatenated members and frames are read back as one stream by gzip,
+    tar and zstd.
+    """
+
+    def __init__(self, path, codec="gzip", threads=None, block_size=4 * 1024 * 1024):
+        self.file = open(path, "wb")
+        self.compress = self.__get_compressor(codec)
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="archive_compression")
+        self.chunks = []
+        self.buffered = 0
+        self.pending = collections.deque()
+        self.position = 0
+
+    @staticmethod
+    def __get_compressor(codec):
+        if codec == "zstd":
+            import pyarrow as pa
+
+            zstd = pa.Codec("zstd")
+            return lambda block: zstd.compress(block, asbytes=True)
+        return compress_gzip_member
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.buffered += len(data)
+        self.position += len(data)
+        if self.buffered >= self.block_size:
+            self.__submit_block()
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            self.__submit_block()
+            while self.pending:
+                self.file.write(self.pending.popleft().result())
+        finally:
+            self.executor.shutdown()
+            self.file.close()
+
+    def __submit_block(self):
+        if not self.chunks:
+            return
+        block = b"".join(self.chunks)
+        self.chunks = []
+        self.buffered = 0
+        self.pending.append(self.executor.submit(self.compress, block))
+        # Compressed blocks are written as soon as they are next in line, at most two blocks per thread are buffered
+        while self.pending and (self.pending[0].done() or len(self.pending) > 2 * self.threads):
+            self.file.write(self.pending.popleft().result())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+@contextmanager
+def open_archive(output_file_path, codec="gzip", threads=None):
+    """
+    Opens a tarball for writing, compressed with codec on threads threads by a ParallelCompressionWriter.
+    """
+    with ParallelCompressionWriter(output_file_path, codec, threads) as writer:
+        with tarfile.open(fileobj=writer, mode="w|") as tar:
+            yield tar
@@ -18,13 +18,13 @@ import logging
 import os
 import os.path
 import ssl
-import tarfile
 import urllib
 from logging import Logger
 
 import requests
 from requests.auth import HTTPBasicAuth
 
+from parallel_compression import open_archive
 from utility import create_directory
 from hdfs import InsecureClient
 from hdfs.ext.kerberos import KerberosClient
@@ -33,10 +33,10 @@ log: Logger = logging.getLogger('main')
 ssl._create_default_https_context = ssl._create_unverified_context
 
 
-def _make_tarfile(output_file_path, source_dir):
+def _make_tarfile(output_file_path, source_dir, threads=None):
     log.info("Creating tarball at " + output_file_path + " from " + source_dir)
     files = os.listdir(source_dir)
-    with tarfile.open(output_file_path, "w:gz") as tar:
+    with open_archive(output_file_path, "gzip", threads) as tar:
         for f in files:
             tar.add(os.path.join(source_dir, f),
                     os.path.basename(f))
@@ -50,6 +50,7 @@ class SparkHistoryExtractor:
         self.ambari_user = ambari_conf['ambari_user']
         self.ambari_pass = ambari_conf['ambari_pass']
         self.output_dir = ambari_conf['output_dir']
+        self.archive_compression_threads = ambari_conf['archive_compression_threads']
         self.ambari_server_timeout = ambari_conf['ambari_server_timeout']
         self.ambari_http_protocol = ambari_conf['ambari_http_protocol']
         self.ambari_api_version = "/api/v1"
@@ -76,7 +77,7 @@ class SparkHistoryExtractor:
                 log.error("Issue with webhdfs downloading " + default_history_dir)
                 log.error(e)
         try:
-            _make_tarfile(os.path.join(download_dir, "spark2-history.tar.gz"), download_dir)
+            _make_tarfile(os.path.join(download_dir, "spark2-history.tar.gz"), download_dir, self.archive_compression_threads)
         except Exception as e:
             log.error("Issue with taring the directory " + download_dir)
             log.error(e)
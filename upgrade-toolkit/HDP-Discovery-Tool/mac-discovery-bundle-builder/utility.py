@@ -15,6 +15,7 @@
 import csv
 import json
 import logging
+import os
 import subprocess
 import sys
 from configparser import ConfigParser
@@ -82,6 +83,9 @@ def get_config_params(config_file):
     ranger_ui_server_name = parser.get('ranger_config', 'ranger_ui_server_name')
     ranger_ui_port = parser.get('ranger_config', 'ranger_ui_port')
 
+    archive_compression_threads = parser.getint('archive_config', 'archive_compression_threads',
+                                                fallback=os.cpu_count() or 1)
+
     # Prepare dictionary object with config variables populated for both anmabri and ranger.
     config_dict = {}
     config_dict["ambari_server_host"] = ambari_server_host
@@ -103,6 +107,7 @@ def get_config_params(config_file):
     config_dict["ranger_ui_protocol"] = ranger_ui_protocol
     config_dict["ranger_ui_server_name"] = ranger_ui_server_name
     config_dict["ranger_ui_port"] = ranger_ui_port
+    config_dict["archive_compression_threads"] = archive_compression_threads
 
     return config_dict
 